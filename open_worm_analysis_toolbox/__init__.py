@@ -29,10 +29,12 @@ from .prefeatures.worm_plotter import NormalizedWormPlottable
 # to become WormFeatures
 from .features.worm_features import WormFeatures
 from .features.worm_features import get_feature_specs
+from .features.worm_features import select_feature_specs
 from .features import feature_manipulations
 
 from .features.worm_features import WormFeatures
 from .features.feature_processing_options import FeatureProcessingOptions
+from .features.feature_cache import FeatureCache
 
 from .statistics.histogram_manager import HistogramManager
 from .statistics.statistics_manager import StatisticsManager
@@ -57,6 +59,7 @@ __all__ = ['__version__',
            'VideoInfo',
            'WormFeatures',
            'FeatureProcessingOptions',
+           'FeatureCache',
            'NormalizedWormPlottable',
            'HistogramManager',
            'StatisticsManager',
@@ -71,7 +71,6 @@ import operator
 import h5py
 import warnings
 
-from itertools import groupby
 from .. import utils
 
 
@@ -272,45 +271,30 @@ class EventFinder:
         assert(event_mask.dtype == bool)
         assert(event_data.dtype == float)
 
-        # We concatenate falses to ensure event starts and stops at the edges
-        # are caught
-        bracketed_event_mask = np.concatenate([[False], event_mask, [False]])
-
-        # Let's obtain the "x-coordinates" of the True entries.
-        # e.g. If our bracketed_event_mask is
-        # [False, False, False, True, False True, True, True, False], then
-        # we obtain the array [3, 5, 6, 7]
-        x = np.flatnonzero(bracketed_event_mask) - 1
-
-        # Group these together using a fancy trick from
-        # http://stackoverflow.com/questions/2154249/, since
-        # the lambda function x:x[0]-x[1] on an enumerated list will
-        # group consecutive integers together
-        # e.g. [[(0, 3)], [(1, 5), (2, 6), (3, 7)]]
-        # list(group)
-        x_grouped = [list(group) for key, group in
-                     groupby(enumerate(x), lambda i:i[0] - i[1])]
+        # Let's obtain the runs of True entries, e.g. if our event_mask is
+        # [False, False, True, False, True, True, True, False], then
+        # the runs start at [2, 4] and stop at [3, 7]
+        starts, stops, _ = utils.get_runs(event_mask)
 
         # We want to know the first element from each "run", and the
-        # last element e.g. [[3, 4], [5, 7]]
-        event_candidates = [(i[0][1], i[-1][1]) for i in x_grouped]
+        # last element e.g. [[2, 2], [4, 6]]
+        event_candidates = np.column_stack((starts, stops - 1))
 
         # Early exit if we have no starts and stops at all
-        if not event_candidates:
-            return np.array(event_candidates)
+        if event_candidates.size == 0:
+            return np.array([])
 
         # If a run of NaNs precedes the first start index, all the way back to
         # the first element, then revise our first (start, stop) entry to
         # include all those NaNs.
-        if np.all(np.isnan(event_data[:event_candidates[0][0]])):
-            event_candidates[0] = (0, event_candidates[0][1])
+        if np.all(np.isnan(event_data[:event_candidates[0, 0]])):
+            event_candidates[0, 0] = 0
 
         # Same but with NaNs succeeding the final end index.
-        if np.all(np.isnan(event_data[event_candidates[-1][1] + 1:])):
-            event_candidates[-1] = (event_candidates[-1]
-                                    [0], event_data.size - 1)
+        if np.all(np.isnan(event_data[event_candidates[-1, 1] + 1:])):
+            event_candidates[-1, 1] = event_data.size - 1
 
-        return np.array(event_candidates)
+        return event_candidates
 
     def remove_gaps(self, event_candidates, threshold,
                     comparison_operator):
@@ -341,26 +325,21 @@ class EventFinder:
                comparison_operator == operator.gt or
                comparison_operator == operator.ge)
 
-        new_event_candidates = []
-        num_groups = np.shape(event_candidates)[0]
-
-        i = 0
-        while(i < num_groups):
-            # Now advance through groups to the right,
-            # continuing as long as they satisfy our comparison operator
-            ii = i
-            while(ii + 1 < num_groups and comparison_operator(
-                    event_candidates[ii + 1][0] - event_candidates[ii][1] - 1,
-                    threshold)):
-                ii += 1
+        event_candidates = np.asarray(event_candidates)
+        if event_candidates.size == 0:
+            return np.array([])
 
-            # Add this largest possible start/stop duple to our NEW revised
-            # list
-            new_event_candidates.append((event_candidates[i][0],
-                                         event_candidates[ii][1]))
-            i = ii + 1
+        # An event is joined to the one before it if the gap between them
+        # satisfies our comparison operator, so each new event starts
+        # with a group for which it doesn't
+        gaps = event_candidates[1:, 0] - event_candidates[:-1, 1] - 1
+        is_new_event = np.concatenate(
+            ([True], ~comparison_operator(gaps, threshold)))
+        is_last_of_event = np.concatenate((is_new_event[1:], [True]))
 
-        return np.array(new_event_candidates)
+        # The largest possible start/stop duples make our NEW revised list
+        return np.column_stack((event_candidates[is_new_event, 0],
+                                event_candidates[is_last_of_event, 1]))
 
     def remove_too_small_events(self, event_candidates):
         """
@@ -708,6 +687,41 @@ class EventList(object):
         return (EventList(starts_stops), is_from_first_object)
 
 
+def _h_cumulative_sum(data):
+    """
+    The cumulative sum of data, ignoring NaN values, with a leading 0 so
+    that np.nansum(data[start:stop]) is (up to rounding)
+    cum_sum[stop] - cum_sum[start]
+
+    Parameters
+    ---------------------------------------
+    data: 1-d numpy array
+
+    Returns
+    ---------------------------------------
+    cum_sum: 1-d float numpy array of length len(data) + 1
+
+    """
+    cum_sum = np.zeros(len(data) + 1)
+    np.cumsum(np.where(np.isnan(data), 0, data), out=cum_sum[1:])
+    return cum_sum
+
+
+def _h_range_sums(cum_sum, starts, stops):
+    """
+    The sums of the data of the cumulative sum cum_sum (see
+    _h_cumulative_sum) over the ranges data[starts[i]:stops[i]].
+
+    Ranges are clipped to the data, and empty ranges (stops[i] <=
+    starts[i]) sum to 0, as for slices.
+
+    """
+    n = len(cum_sum) - 1
+    starts = np.clip(starts, 0, n)
+    stops = np.clip(stops, starts, n)
+    return cum_sum[stops] - cum_sum[starts]
+
+
 class EventListWithFeatures(EventList):
 
     """
@@ -864,14 +878,15 @@ class EventListWithFeatures(EventList):
         self.time_between_events = (
             self.start_frames[1:] - self.end_frames[:-1] - 1) / fps
 
+        # The distance moved over any stretch of frames is a difference
+        # of the cumulative distance, with NaN frames not moving the worm
+        cum_distance = _h_cumulative_sum(self.distance_per_frame)
+
         # Old Name: interDistance
         # Distance moved during events
         if compute_distance_during_event:
-            self.distance_during_events = np.zeros(self.__len__)
-            for i in range(self.__len__):
-                self.distance_during_events[i] = np.nansum(
-                    self.distance_per_frame[
-                        self.start_frames[i]:self.end_frames[i] + 1])
+            self.distance_during_events = _h_range_sums(
+                cum_distance, self.start_frames, self.end_frames + 1)
             self.data_ratio = np.nansum(self.distance_during_events) \
                 / np.nansum(self.distance_per_frame)
         else:
@@ -880,16 +895,8 @@ class EventListWithFeatures(EventList):
 
         # Old Name: distance
         # Distance moved between events
-        self.distance_between_events = np.zeros(self.__len__ - 1)
-        for i in range(self.__len__ - 1):
-            # Suppress "FutureWarning: In Numpy 1.9 the sum along empty
-            # slices will be zero."
-            with warnings.catch_warnings():
-                warnings.simplefilter('ignore', category=FutureWarning)
-                self.distance_between_events[i] = \
-                    np.nansum(
-                        self.distance_per_frame[self.end_frames[i] + 1:
-                                                self.start_frames[i + 1]])
+        self.distance_between_events = _h_range_sums(
+            cum_distance, self.end_frames[:-1] + 1, self.start_frames[1:])
 
         #self.distance_between_events[-1] = np.NaN
 
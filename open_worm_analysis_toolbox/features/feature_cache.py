@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+A persistent, content-addressed cache of computed features
+
+Each computed feature is pickled to its own file in the cache directory.
+The name of the file is a hash of everything the feature's value depends
+on:
+
+- the arrays and video info of the NormalizedWorm
+- the feature processing options
+- the feature's specification (its row in features_list.csv)
+- the version of the toolbox
+
+so that a feature is only taken from the cache if it would be computed
+the same way again, and there is no need to invalidate entries.
+
+The cache can be limited in size, in which case the least recently used
+entries are removed when it grows beyond that size. Each FeatureCache
+keeps a running total of the size instead of looking at the whole
+directory on every write, so when several processes share a directory
+it can briefly grow beyond that size by what the others wrote.
+
+Several processes (e.g. the workers of WormFeatures.compute_many) can
+share a cache directory: entries are written to a temporary file and then
+renamed, so that an entry is never read half written, and entries that
+are removed by another process while being read or evicted are treated
+as missing. Temporary files left behind by processes that crashed are
+removed by evict and clear.
+
+Usage
+-----
+cache = FeatureCache('/path/to/cache', max_size=2 * 1024 ** 3)
+wf = WormFeatures(nw, cache=cache)
+# Much faster the second time
+wf = WormFeatures(nw, cache=cache)
+
+"""
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import time
+import numpy as np
+
+from ..version import __version__
+
+
+class FeatureCache(object):
+    """
+    Attributes
+    ----------
+    directory : string
+    max_size : int or None
+        The maximum total size of the cache files, in bytes. If None the
+        cache is not limited in size.
+
+    """
+
+    file_extension = '.pkl'
+    temp_extension = '.tmp'
+    # Temporary files older than this (in seconds) are from a writer that
+    # crashed
+    max_temp_age = 3600
+
+    def __init__(self, directory, max_size=None):
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created at the same time by another process
+                if not os.path.isdir(directory):
+                    raise
+
+        self.directory = directory
+        self.max_size = max_size
+        # The total size of the entries, as of the last time the directory
+        # was looked at plus what has been written since. None if unknown.
+        self._size = None
+
+    def get_key(self, wf, spec):
+        """
+        The key of the feature computed by spec from the worm of wf.
+
+        Parameters
+        ----------
+        wf : WormFeatures
+        spec : FeatureProcessingSpec
+
+        Returns
+        -------
+        string
+            A hexadecimal hash
+
+        """
+        # Hashing the worm's arrays is the expensive part, so it is only
+        # done once for each WormFeatures
+        worm_key = getattr(wf, '_feature_cache_worm_key', None)
+        if worm_key is None:
+            worm_key = get_worm_key(wf.nw)
+            wf._feature_cache_worm_key = worm_key
+
+        h = hashlib.sha1()
+        h.update(worm_key.encode('ascii'))
+        _h_update_hash(h, wf.options)
+        _h_update_hash(h, _h_spec_row(spec))
+        _h_update_hash(h, __version__)
+        return h.hexdigest()
+
+    def get(self, key):
+        """
+        Returns the feature with this key, or None if it isn't in the cache.
+        """
+        file_path = self._h_file_path(key)
+        try:
+            with open(file_path, 'rb') as f:
+                feature = pickle.load(f)
+        except (IOError, OSError):
+            # Not in the cache, or evicted by another process
+            return None
+        except Exception:
+            # e.g. written by an incompatible version of a dependency
+            self._h_remove(file_path)
+            return None
+
+        # The last modification time is used as the last access time, for
+        # the eviction of the least recently used entries
+        try:
+            os.utime(file_path, None)
+        except OSError:
+            pass
+
+        return feature
+
+    def put(self, key, feature):
+        """
+        Add a feature to the cache, then evict the least recently used
+        entries if the cache is too big.
+        """
+        file_handle, temp_path = tempfile.mkstemp(dir=self.directory,
+                                                  suffix=self.temp_extension)
+        try:
+            with os.fdopen(file_handle, 'wb') as f:
+                pickle.dump(feature, f, pickle.HIGHEST_PROTOCOL)
+                file_size = f.tell()
+            _h_replace(temp_path, self._h_file_path(key))
+        except Exception:
+            self._h_remove(temp_path)
+            raise
+
+        if self.max_size is not None:
+            if self._size is not None:
+                self._size += file_size
+            if self._size is None or self._size > self.max_size:
+                self.evict(self.max_size)
+
+    def evict(self, max_size):
+        """
+        Remove the least recently used entries until the cache is no bigger
+        than max_size bytes, and the temporary files of writers that
+        crashed.
+        """
+        now = time.time()
+        entries = []
+        total_size = 0
+        for file_name in os.listdir(self.directory):
+            is_temp = file_name.endswith(self.temp_extension)
+            if not (is_temp or file_name.endswith(self.file_extension)):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, file_name))
+            except OSError:
+                continue
+            if is_temp:
+                if now - stat.st_mtime > self.max_temp_age:
+                    self._h_remove(os.path.join(self.directory, file_name))
+                continue
+            entries.append((stat.st_mtime, file_name, stat.st_size))
+            total_size += stat.st_size
+
+        entries.sort()
+        for _, file_name, size in entries:
+            if total_size <= max_size:
+                break
+            self._h_remove(os.path.join(self.directory, file_name))
+            total_size -= size
+
+        self._size = total_size
+
+    def clear(self):
+        """
+        Remove all entries, and the temporary files of writers that
+        crashed.
+        """
+        self.evict(0)
+
+    @property
+    def size(self):
+        """
+        The total size of the entries, in bytes.
+        """
+        total_size = 0
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith(self.file_extension):
+                try:
+                    total_size += os.path.getsize(
+                        os.path.join(self.directory, file_name))
+                except OSError:
+                    pass
+        self._size = total_size
+        return total_size
+
+    def _h_file_path(self, key):
+        return os.path.join(self.directory, key + self.file_extension)
+
+    def _h_remove(self, file_path):
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
+
+    def __repr__(self):
+        return "FeatureCache(%r, max_size=%r)" % (self.directory,
+                                                  self.max_size)
+
+
+def get_worm_key(nw):
+    """
+    A hash of the data of a NormalizedWorm that features are computed from.
+
+    Parameters
+    ----------
+    nw : NormalizedWorm
+
+    Returns
+    -------
+    string
+        A hexadecimal hash
+
+    """
+    h = hashlib.sha1()
+    for a in nw.array_store_attributes:
+        # The arrays that are otherwise computed when first asked for (e.g.
+        # _angles) are asked for, so that the key is the same before and
+        # after they have been computed
+        a = a.lstrip('_')
+        h.update(a.encode('ascii'))
+        _h_update_hash(h, getattr(nw, a, None))
+
+    video_info = nw.video_info
+    _h_update_hash(h, json.dumps(video_info.get_metadata(), sort_keys=True))
+    _h_update_hash(h, getattr(video_info, 'frame_code', None))
+    return h.hexdigest()
+
+
+def _h_replace(src, dst):
+    """
+    Rename src to dst, replacing dst if it exists, like os.replace (which
+    Python 2 doesn't have).
+    """
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+        return
+    try:
+        os.rename(src, dst)
+    except OSError:
+        # On Windows os.rename fails if dst exists
+        if not os.path.exists(dst):
+            raise
+        try:
+            os.remove(dst)
+        except OSError:
+            pass
+        os.rename(src, dst)
+
+
+def _h_spec_row(spec):
+    """
+    The values of a FeatureProcessingSpec that come from its row of the
+    specification file, plus its source.
+    """
+    return sorted((k, v) for k, v in vars(spec).items()
+                  if isinstance(v, (str, bool, int, float)))
+
+
+def _h_update_hash(h, value):
+    """
+    Add a value to a hash, in a way that doesn't depend on e.g. the
+    order of the keys of a dictionary or the memory layout of an array.
+    """
+    if isinstance(value, np.ndarray):
+        h.update(('array %s %s;' % (value.dtype.str, value.shape))
+                 .encode('ascii'))
+        if value.dtype == object:
+            for x in value.ravel():
+                _h_update_hash(h, x)
+        else:
+            h.update(np.ascontiguousarray(value).ravel().view(np.uint8).data)
+    elif isinstance(value, dict):
+        h.update(('dict %d;' % len(value)).encode('ascii'))
+        for k in sorted(value, key=repr):
+            _h_update_hash(h, k)
+            _h_update_hash(h, value[k])
+    elif isinstance(value, (list, tuple)):
+        h.update(('%s %d;' % (type(value).__name__, len(value)))
+                 .encode('ascii'))
+        for x in value:
+            _h_update_hash(h, x)
+    elif hasattr(value, '__dict__'):
+        # e.g. FeatureProcessingOptions
+        h.update(('object %s;' % type(value).__name__).encode('ascii'))
+        _h_update_hash(h, vars(value))
+    else:
+        h.update(('%s %r;' % (type(value).__name__, value)).encode('utf-8'))
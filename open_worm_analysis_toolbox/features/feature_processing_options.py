@@ -44,6 +44,7 @@ class FeatureProcessingOptions(object):
 
         self.locomotion = LocomotionOptions()
         self.posture = PostureOptions()
+        self.path = PathOptions()
 
         # TODO: Implement this.
         # This is not yet implemented. The idea is to support not
@@ -110,6 +111,28 @@ class FeatureProcessingOptions(object):
         return utils.print_object(self)
 
 
+class PathOptions(object):
+
+    def __init__(self):
+        # The arena is a grid over the whole track of the worm, with cells
+        # about the size of the worm's width. The time spent in each cell
+        # is either counted for all cells of the arena (dense), or only
+        # for the cells that are occupied (sparse), which bounds the
+        # memory used for the large arenas of long wandering tracks, but
+        # is slower for small arenas.
+        #
+        # True or False to always use the sparse or dense counting, or
+        # None to use the sparse counting for arenas of more than
+        # max_dense_arena_cells cells.
+        #
+        # Used by: path.duration
+        self.sparse_arena = None
+        self.max_dense_arena_cells = 10 ** 6
+
+    def __repr__(self):
+        return utils.print_object(self)
+
+
 class PostureOptions(object):
 
     def __init__(self):
@@ -129,6 +152,14 @@ class PostureOptions(object):
         # Used by: posture.eigenprojections
         self.n_eigenworms_use = 6
 
+        # The file of the eigenworms the angles are projected on, e.g. to
+        # use eigenworms computed for another strain. It must be a Matlab
+        # 7.3 (HDF5) file with an 'eigenWorms' dataset [48 x n_eigenworms],
+        # like config.EIGENWORM_FILE, the N2 eigenworms used if this is None
+        #
+        # Used by: posture.eigenprojections
+        self.eigen_worms_file = None
+
         # This the fraction of the worm length that a bend must be
         # in order to be counted. The # of worm points
         # (this_value*worm_length_in_samples) is rounded to an integer
@@ -32,6 +32,10 @@ from .generic_features import Feature
 from .. import utils
 
 class BendHelper(object):
+
+    # The number of frames whose STFT is computed at once
+    batch_size = 256
+
     def h__getBendData(self, avg_bend_angles, bound_info, options, fps):
         """
         Compute the bend amplitude and frequency.
@@ -88,64 +92,83 @@ class BendHelper(object):
         right_bounds = right_bounds.astype(int)
         left_bounds = left_bounds.astype(int)
 
-        for iFrame in np.flatnonzero(~is_bad_mask):
-            windowed_data = avg_bend_angles[
-                left_bounds[iFrame]:right_bounds[iFrame]]
-            data_win_length = len(windowed_data)
-
-            #
-            # fft frequency and bandwidth
-            #
-            # Compute the real part of the STFT.
-            # These two steps take a lot of time ...
-
-            # New code:
-            fft_data = abs(np.fft.rfft(windowed_data, fft_n_samples))
-
-            # Find the peak frequency.
-            maxPeakI = np.argmax(fft_data)
-            maxPeak = fft_data[maxPeakI]
-
-            # NOTE: If this is true, we'll never bound the peak on the left.
-            # We are looking for a hump with a peak, not just a decaying
-            # signal.
-            if maxPeakI == 0:
-                continue
-
-            unsigned_freq = freq_scalar * maxPeakI
-
-            if not (min_freq <= unsigned_freq <= max_freq):
-                continue
-
-            peakStartI, peakEndI = \
-                self.h__getBandwidth(data_win_length,
-                                     fft_data,
-                                     maxPeakI,
-                                     INIT_MAX_I_FOR_BANDWIDTH)
-            
-            if np.isnan(peakStartI) or np.isnan(peakEndI):
-                #wrong indexes, next loop
+        # The frames are grouped by the length of their window, and the
+        # windows of each group are transformed together
+        good_frames_I = np.flatnonzero(~is_bad_mask)
+        win_lengths = right_bounds[good_frames_I] - left_bounds[good_frames_I]
+        for data_win_length in np.unique(win_lengths):
+            if data_win_length <= 0:
                 continue
-
-            # Store data
-            #------------------------------------------------------------------
-            fenergy = fft_data**2
-            tot_energy = np.sum(fenergy)
-            peak_energy = np.sum(fenergy[peakStartI:peakEndI])
-
-            peak_amplitud_treshold = (max_amp_pct_bandwidth * maxPeak)
-            if not (# The minima can't be too big:
-                    fft_data[peakStartI] > peak_amplitud_treshold or
-                    fft_data[peakEndI] > peak_amplitud_treshold or
+            group_I = good_frames_I[win_lengths == data_win_length]
+            for batch_start in range(0, group_I.size, self.batch_size):
+                frames_I = group_I[batch_start:batch_start + self.batch_size]
+                windowed_data = avg_bend_angles[
+                    left_bounds[frames_I, None] + np.arange(data_win_length)]
+
+                #
+                # fft frequency and bandwidth
+                #
+                # Compute the real part of the STFT.
+                # These two steps take a lot of time ...
+                fft_data = np.abs(np.fft.rfft(windowed_data, fft_n_samples,
+                                              axis=1))
+
+                # Find the peak frequency.
+                maxPeakI = np.argmax(fft_data, axis=1)
+                maxPeak = fft_data[np.arange(frames_I.size), maxPeakI]
+
+                unsigned_freq = freq_scalar * maxPeakI
+
+                # NOTE: If maxPeakI is 0, we'll never bound the peak on the
+                # left. We are looking for a hump with a peak, not just a
+                # decaying signal.
+                is_valid = (maxPeakI != 0) & \
+                    (min_freq <= unsigned_freq) & (unsigned_freq <= max_freq)
+
+                fft_data = fft_data[is_valid]
+                maxPeakI = maxPeakI[is_valid]
+                maxPeak = maxPeak[is_valid]
+                unsigned_freq = unsigned_freq[is_valid]
+                windowed_data = windowed_data[is_valid]
+                frames_I = frames_I[is_valid]
+
+                peakStartI, peakEndI = \
+                    self.h__getBandwidth(data_win_length,
+                                         fft_data,
+                                         maxPeakI,
+                                         INIT_MAX_I_FOR_BANDWIDTH)
+
+                # -1 for wrong indexes
+                is_valid = (peakStartI != -1) & (peakEndI != -1)
+                row_I = np.flatnonzero(is_valid)
+                peakStartI = peakStartI[is_valid]
+                peakEndI = peakEndI[is_valid]
+
+                # Store data
+                #--------------------------------------------------------------
+                fenergy = fft_data[row_I] ** 2
+                tot_energy = np.sum(fenergy, axis=1)
+                cum_energy = np.cumsum(fenergy, axis=1)
+                peak_energy = \
+                    cum_energy[np.arange(row_I.size), peakEndI - 1] - \
+                    np.where(peakStartI > 0, cum_energy[
+                        np.arange(row_I.size), peakStartI - 1], 0)
+
+                peak_amplitud_treshold = max_amp_pct_bandwidth * maxPeak[row_I]
+                is_bend = ~(
+                    # The minima can't be too big:
+                    (fft_data[row_I, peakStartI] > peak_amplitud_treshold) |
+                    (fft_data[row_I, peakEndI] > peak_amplitud_treshold) |
                     # Needs to have enough energy:
-                    (peak_energy < (peak_energy_threshold * tot_energy))
-                    ):
+                    (peak_energy < (peak_energy_threshold * tot_energy)))
+                row_I = row_I[is_bend]
 
                 # Convert the peak to a time frequency.
-                dataSign = np.sign(np.nanmean(windowed_data))  # sign the data
-                amps[iFrame] = (2 * fft_data[maxPeakI] /
-                                data_win_length) * dataSign
-                freqs[iFrame] = unsigned_freq * dataSign
+                dataSign = np.sign(np.nanmean(windowed_data[row_I],
+                                              axis=1))  # sign the data
+                amps[frames_I[row_I]] = (2 * maxPeak[row_I] /
+                                         data_win_length) * dataSign
+                freqs[frames_I[row_I]] = unsigned_freq[row_I] * dataSign
 
         return amps, freqs
 
@@ -166,13 +189,13 @@ class BendHelper(object):
         ----------
         data_win_length
           Length of real data (ignoring zero padding) that
-          went into computing the FFT
+          went into computing the FFT, the same for all frames
 
         fft_data
-          Output of the fft function
+          Output of the fft function, [n_frames x n_samples]
 
         max_peak_I
-          Location (index) of the maximum of fft_data
+          Location (index) of the maximum of fft_data, for each frame
 
         INIT_MAX_I_FOR_BANDWIDTH
           See code
@@ -180,9 +203,11 @@ class BendHelper(object):
 
         Returns
         -------
-        peak_start_I: scalar
+        peak_start_I: numpy array of int, [n_frames]
+            -1 if there is no minimum before the peak
 
-        peak_end_I: scalar
+        peak_end_I: numpy array of int, [n_frames]
+            -1 if there is no minimum after the peak
 
 
         Notes
@@ -195,54 +220,55 @@ class BendHelper(object):
 
         """
 
-        peakWinSize = round(np.sqrt(data_win_length))
+        peakWinSize = int(round(np.sqrt(data_win_length)))
+        INIT_MAX_I_FOR_BANDWIDTH = int(INIT_MAX_I_FOR_BANDWIDTH)
+
+        def get_bounding_minima(fft_data, max_peak_I):
+            # TODO: This is wrong, the first minimum of all those before
+            # the peak is used rather than the one closest to it
+            min_peaks_mask = utils.separated_peaks_2D(
+                fft_data, peakWinSize, use_max=False, value_cutoff=np.inf)
+            I = np.arange(fft_data.shape[1])
+            is_start = min_peaks_mask & (I < max_peak_I[:, None])
+            is_end = min_peaks_mask & (I > max_peak_I[:, None])
+            peak_start_I = np.where(np.any(is_start, axis=1),
+                                    np.argmax(is_start, axis=1), -1)
+            peak_end_I = np.where(np.any(is_end, axis=1),
+                                  np.argmax(is_end, axis=1), -1)
+            return peak_start_I, peak_end_I
+
+        peak_start_I = np.full(max_peak_I.size, -1)
+        peak_end_I = np.full(max_peak_I.size, -1)
 
         # Find the peak bandwidth.
-        if max_peak_I < INIT_MAX_I_FOR_BANDWIDTH:
-            # NOTE: It is incorrect to filter by the maximum here, as we want to
-            # allow matching a peak that will later be judged invalid. If we
-            # filter here we may find another smaller peak which will not be
-            # judged invalid later on.
-            min_peaks, min_peaks_I = utils.separated_peaks(
-                fft_data[:INIT_MAX_I_FOR_BANDWIDTH],
-                peakWinSize,
-                use_max=False,
-                value_cutoff=np.inf)
-
-            del min_peaks   # this part of max_peaks_dist's return is unused
-
-            # TODO: This is wrong, replace add find to utils ...
-            peak_start_I = min_peaks_I[utils.find(min_peaks_I < max_peak_I, 1)]
-            peak_end_I = min_peaks_I[utils.find(min_peaks_I > max_peak_I, 1)]
-        else:
-            peak_start_I = np.array([])
-            peak_end_I = np.array([])
+        #
+        # NOTE: It is incorrect to filter by the maximum here, as we want to
+        # allow matching a peak that will later be judged invalid. If we
+        # filter here we may find another smaller peak which will not be
+        # judged invalid later on.
+        I = np.flatnonzero(max_peak_I < INIT_MAX_I_FOR_BANDWIDTH)
+        peak_start_I[I], peak_end_I[I] = get_bounding_minima(
+            fft_data[I, :INIT_MAX_I_FOR_BANDWIDTH], max_peak_I[I])
 
         # NOTE: Besides checking for an empty value, we also need to ensure that
         # the minimum didn't come too close to the data border, as more data
         # could invalidate the result we have.
         #
         # NOTE: In order to save time we only look at a subset of the FFT data.
-        if (peak_end_I.size == 0) | \
-                (peak_end_I + peakWinSize >= INIT_MAX_I_FOR_BANDWIDTH):
-            # If true, then rerun on the full set of data
-            [min_peaks, min_peaks_I] = utils.separated_peaks(
-                fft_data, peakWinSize, use_max=False, value_cutoff=np.inf)
-
-            del(min_peaks)  # This part of max_peaks_dist's return is unused
-
-            peak_start_I = min_peaks_I[utils.find(min_peaks_I < max_peak_I, 1)]
-            peak_end_I = min_peaks_I[utils.find(min_peaks_I > max_peak_I, 1)]
-
-        assert peak_start_I.size <= 1
-        assert peak_end_I.size <= 1
-        
-        #return an array it is problematic, and can give rise to deprecation errors. Let's return a tuple instead.
-        peak_start_Int = int(peak_start_I[0]) if peak_start_I.size == 1 else np.nan
-        peak_end_Int = int(peak_end_I[0]) if peak_end_I.size == 1 else np.nan
+        # If true, then rerun on the full set of data
+        #
+        # TODO: The frame by frame code this replaces never reran when no
+        # end was found (its test of an empty array was False), so neither
+        # does this, and these frames have no bend. Rerunning them would
+        # match the comment above, but change the features.
+        I = np.flatnonzero(
+            (peak_end_I != -1) &
+            (peak_end_I + peakWinSize >= INIT_MAX_I_FOR_BANDWIDTH))
+        peak_start_I[I], peak_end_I[I] = get_bounding_minima(
+            fft_data[I], max_peak_I[I])
+
+        return (peak_start_I, peak_end_I)
 
-        # TODO: Why is this not a tuple - tuple would be more consistent
-        return (peak_start_Int, peak_end_Int)
 
 class LocomotionBend(object):
     """
@@ -180,75 +180,65 @@ class Duration(Feature):
         arena_size = (int(y_scaled_max - y_scaled_min + 1), int(x_scaled_max - x_scaled_min + 1))
         ar = Arena(sx, sy, arena_size)
 
+        # The index of the cell of each skeleton point in the flattened
+        # arena, with the y-axis flipped to maintain consistency with
+        # Matlab, or -1 for invalid points
+        #
+        # NOTE: All skeleton points have been rounded to integer values for
+        # assignment to the matrix based on their values being treated as
+        # indices
+        cells = (arena_size[0] - 1 - scaled_zeroed_sy) * arena_size[1] + \
+            scaled_zeroed_sx
+        cells[isnan_mask] = -1
+
+        sparse_arena = options.path.sparse_arena
+        if sparse_arena is None:
+            sparse_arena = arena_size[0] * arena_size[1] > \
+                options.path.max_dense_arena_cells
+
         #----------------------------------------------------------------------
-        def h__populateArenas(arena_size, sys, sxs, s_points, isnan_mask):
+        def h__getRegionCells(cells, s_indices):
             """
+            The cells occupied by a region of the body, once for each frame
+            in which the region is in them, even if several of its points
+            are in the same cell
 
             Attributes:
             ----------------------------
-            arena_size: list
-              [2]
-            sys : numpy.int32
-              [49, n_frames]
-            sxs : numpy.int32
+            cells : numpy.int
               [49, n_frames]
-            s_points: list
-              [4]
-            isnan_mask: bool
-              [49, n_frames]
-
+            s_indices: tuple
+              [2], the skeleton indices of the region
 
             """
+            # Sorting the cells of each frame puts those occupied by several
+            # points next to each other
+            region_cells = np.sort(cells[s_indices[0]:s_indices[1]].T, axis=1)
+            is_new_cell = np.ones(region_cells.shape, dtype=bool)
+            is_new_cell[:, 1:] = region_cells[:, 1:] != region_cells[:, :-1]
 
-            # NOTE: All skeleton points have been rounded to integer values for
-            # assignment to the matrix based on their values being treated as
-            # indices
-
-            # Filter out frames which have no valid values
-            #----------------------------------------------------------
-            frames_run = np.flatnonzero(np.any(~isnan_mask, axis=0))
-            n_frames_run = len(frames_run)
-
-            # 1 area for each set of skeleton indices
-            #-----------------------------------------
-            n_points = len(s_points)
-            arenas = [None] * n_points
-
-            # Loop over the different regions of the body
-            #------------------------------------------------
-            for iPoint in range(n_points):
-
-                temp_arena = np.zeros(arena_size)
-                s_indices = s_points[iPoint]
-
-                # For each frame, add +1 to the arena each time a chunk of the skeleton
-                # is located in that part
-                #--------------------------------------------------------------
-                for iFrame in range(n_frames_run):
-                    cur_frame = frames_run[iFrame]
-                    cur_x = sxs[s_indices[0]:s_indices[1], cur_frame]
-                    cur_y = sys[s_indices[0]:s_indices[1], cur_frame]
-                    
-                    temp_arena[cur_y, cur_x] += 1
-
-                # Flip y-axis to maintain consistency with Matlab
-                arenas[iPoint] = temp_arena[::-1, :]
-
-            return arenas
+            return region_cells[is_new_cell & (region_cells >= 0)]
         #----------------------------------------------------------------------
 
-        temp_arenas = h__populateArenas(
-            arena_size,
-            scaled_zeroed_sy,
-            scaled_zeroed_sx,
-            s_points,
-            isnan_mask)
-
-        # For looking at the data
-        #------------------------------------
-        # utils.imagesc(temp_arenas[0])
-
-        temp_duration = [DurationElement(x, fps) for x in temp_arenas]
+        # 1 area for each set of skeleton indices, with the number of frames
+        # in which each cell of the arena was occupied
+        temp_duration = []
+        for s_indices in s_points:
+            region_cells = h__getRegionCells(cells, s_indices)
+            if sparse_arena:
+                indices, n_frames = np.unique(region_cells, return_counts=True)
+                temp_duration.append(DurationElement.from_cell_counts(
+                    indices, n_frames.astype(float), fps))
+            else:
+                temp_arena = np.bincount(
+                    region_cells, minlength=arena_size[0] * arena_size[1])
+                temp_arena = temp_arena.reshape(arena_size).astype(float)
+
+                # For looking at the data
+                #------------------------------------
+                # utils.imagesc(temp_arena)
+
+                temp_duration.append(DurationElement(temp_arena, fps))
 
         self.arena = ar
         self.worm = temp_duration[0]
@@ -334,6 +324,28 @@ class DurationElement(object):
             other.times,
             'Duration.times')
 
+    @classmethod
+    def from_cell_counts(cls, indices, arena_coverage, fps):
+        """
+        The same as DurationElement(arena_coverage, fps) but from only the
+        occupied cells of the arena.
+
+        Parameters
+        ----------
+        indices : numpy.array
+            The sorted indices of the occupied cells, in the flattened
+            arena
+        arena_coverage : numpy.array
+            The number of frames each cell was occupied in
+        fps : float
+
+        """
+        self = cls.__new__(cls)
+        self.indices = indices
+        self.times = arena_coverage / fps
+
+        return self
+
     @classmethod
     def from_disk(cls, saved_duration_elem):
 
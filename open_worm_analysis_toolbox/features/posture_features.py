@@ -13,11 +13,6 @@ import warnings
 import os
 import h5py
 
-try:
-    import cv2
-except ModuleNotFoundError:
-    raise Exception("OpenCV not installed")
-
 from . import generic_features
 from .generic_features import Feature
 from .. import config, utils
@@ -362,6 +357,78 @@ def get_worm_coils(features_ref, midbody_distance):
 #=====================================================================
 
 
+def _h_contour_moments(contour):
+    """
+    The second order central moments of the polygon of each frame, as
+    calculated by opencv moments(), from Green's theorem.
+
+    Parameters
+    ----------
+    contour : numpy array of shape (k,2,n)
+        The k points of the polygon of each of n frames. The polygon is
+        closed, i.e. the last point is joined to the first one.
+
+    Returns
+    -------
+    (mu11, mu20, mu02) : numpy arrays of shape (n,)
+        Of the area enclosed by the polygon, whichever its orientation.
+        Zero for a polygon with no area.
+
+    """
+    x = contour[:, 0, :]
+    y = contour[:, 1, :]
+    # The previous point of each point
+    x_1 = np.roll(x, 1, axis=0)
+    y_1 = np.roll(y, 1, axis=0)
+
+    dxy = x_1 * y - x * y_1
+    xx_1 = x_1 + x
+    yy_1 = y_1 + y
+
+    m00 = np.sum(dxy, axis=0) / 2
+    m10 = np.sum(dxy * xx_1, axis=0) / 6
+    m01 = np.sum(dxy * yy_1, axis=0) / 6
+    m20 = np.sum(dxy * (x_1 * xx_1 + x * x), axis=0) / 12
+    m11 = np.sum(dxy * (x_1 * (yy_1 + y_1) + x * (yy_1 + y)), axis=0) / 24
+    m02 = np.sum(dxy * (y_1 * yy_1 + y * y), axis=0) / 12
+
+    # As opencv, a polygon with (almost) no area has no moments
+    has_area = np.abs(2 * m00) > np.finfo(np.float32).eps
+    m00_I = np.where(has_area, m00, 1)
+    mu20 = m20 - m10 * (m10 / m00_I)
+    mu11 = m11 - m10 * (m01 / m00_I)
+    mu02 = m02 - m01 * (m01 / m00_I)
+
+    # The sign of the moments depends on the orientation of the polygon
+    sign = np.where(has_area, np.sign(m00), 0)
+    return mu11 * sign, mu20 * sign, mu02 * sign
+
+
+def _h_points_moments(points):
+    """
+    The covariance of the points of each frame, as second order central
+    moments.
+
+    Parameters
+    ----------
+    points : numpy array of shape (k,2,n)
+
+    Returns
+    -------
+    (mu11, mu20, mu02) : numpy arrays of shape (n,)
+
+    """
+    points = points - np.mean(points, axis=0)
+    x = points[:, 0, :]
+    y = points[:, 1, :]
+    n_points = points.shape[0]
+
+    mu20 = np.sum(x * x, axis=0) / (n_points - 1)
+    mu11 = np.sum(x * y, axis=0) / (n_points - 1)
+    mu02 = np.sum(y * y, axis=0) / (n_points - 1)
+    return mu11, mu20, mu02
+
+
 class EccentricityAndOrientationProcessor(Feature):
 
     """
@@ -379,51 +446,18 @@ class EccentricityAndOrientationProcessor(Feature):
 
         http://en.wikipedia.org/wiki/Image_moment
 
-        Calculated by opencv moments():
+        The moments of the contour polygon are calculated for all frames
+        at once, see _h_contour_moments. They are the moments calculated
+        by opencv moments():
         http://docs.opencv.org/modules/imgproc/doc/structural_analysis_and_shape_descriptors.html
-        
-        
-        This code might not work if there are redundant points in the contour (green approximation fails if the).
-        
-        If there are not contours the code will use the minimal rectangular area.
-        http://docs.opencv.org/2.4/modules/imgproc/doc/structural_analysis_and_shape_descriptors.html?highlight=minarearect#minarearect
-        The function moments only work on a close non overlaping contour.
-        The box width and length are used instead of the ellipse minor and major axis
-        to get an estimate of the eccentricity.
+
+        This code might not work if there are redundant points in the
+        contour (the Green's theorem approximation fails if the contour
+        crosses itself).
+
+        If there are no contours, the covariance of the skeleton points is
+        used instead, see _h_points_moments.
         """
-        
-        def _cnt_momentum(cnt):
-            moments = cv2.moments(cnt)
-            return moments['mu11'], moments['mu20'], moments['mu02']
-            
-        def _skel_momentum(skel):
-            mat_cov = np.cov(skel.T)
-            mu20 = mat_cov[0,0]
-            mu02 = mat_cov[1,1]
-            mu11 = mat_cov[0,1]
-            return mu11, mu20, mu02
-            
-            
-        def _momentum_eccentricty_orientation(mu11, mu20, mu02):
-            a1 = (mu20 + mu02) / 2
-            a2 = np.sqrt(4 * mu11**2 +
-                         (mu20 - mu02)**2) / 2
-
-            minor_axis = a1 - a2
-            major_axis = a1 + a2
-            
-            ecc = np.sqrt(1 - minor_axis / major_axis)
-            ang = np.arctan2(2 * mu11, (mu20 - mu02)) / 2
-            ang *= 180 / np.pi
-            return ecc, ang
-
-        def _box_eccentricity_orientation(skel):
-            (CMx, CMy), (L, W), angle = cv2.minAreaRect(skel)
-            if W > L:
-                L, W = W, L  # switch if width is larger than length
-                angle += 90 # this means that the angle is shifted too
-            quirkiness = np.sqrt(1 - W**2 / L**2)
-            return quirkiness, angle
 
         self.name = feature_name
 
@@ -432,31 +466,28 @@ class EccentricityAndOrientationProcessor(Feature):
         #Try to use the contour, otherwise use the skeleton
         try:
             points = wf.nw.contour_without_redundant_points
-            _get_momentum = _cnt_momentum
-            
+            _get_moments = _h_contour_moments
         except:
             points = wf.nw.skeleton
-            _get_momentum = _skel_momentum
-        
-        
-        
-        # OpenCV does not like float64, this actually make sense for image
-        # data where we do not require a large precition in the decimal part.
-        # This could save quite a lot of space
-        points = points.astype(np.float32)
-        
-        tot = points.shape[-1]
-
-        eccentricity = np.full(tot, np.nan)
-        orientation = np.full(tot, np.nan)
-        for ii in range(tot):
-            frame_points = points[:, :, ii]
-            
-            if ~np.any(np.isnan(frame_points)):
-                mu11, mu20, mu02 = _get_momentum(frame_points)
-                eccentricity[ii], orientation[ii] = \
-                _momentum_eccentricty_orientation(mu11, mu20, mu02)
-                
+            _get_moments = _h_points_moments
+
+        eccentricity = np.full(points.shape[-1], np.nan)
+        orientation = np.full(points.shape[-1], np.nan)
+
+        frame_I = np.flatnonzero(~np.any(np.isnan(points), axis=(0, 1)))
+        mu11, mu20, mu02 = _get_moments(points[:, :, frame_I])
+
+        a1 = (mu20 + mu02) / 2
+        a2 = np.sqrt(4 * mu11**2 + (mu20 - mu02)**2) / 2
+
+        minor_axis = a1 - a2
+        major_axis = a1 + a2
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            eccentricity[frame_I] = np.sqrt(1 - minor_axis / major_axis)
+        orientation[frame_I] = \
+            np.arctan2(2 * mu11, (mu20 - mu02)) / 2 * (180 / np.pi)
+
         wf.timer.toc(self.name)
 
         self.eccentricity = eccentricity
@@ -489,6 +520,68 @@ class Eccentricity(Feature):
         return cls(wf, feature_name)
 
 
+def _h_resample_evenly(x, y, ds):
+    """
+    Linearly interpolate y at evenly spaced values of x, for each frame.
+
+    For each frame this is:
+
+        xx = utils.colon(x[0], ds, x[-1])
+        np.interp(xx, x, y)
+
+    with x reversed first (along with y) if it is decreasing.
+
+    Parameters
+    ----------
+    x : numpy array of shape (k,n)
+        Strictly increasing or strictly decreasing for each of n frames
+    y : numpy array of shape (k,n)
+    ds : numpy array of shape (n,)
+        The spacing of the samples of each frame
+
+    Returns
+    -------
+    (samples, n_samples)
+        samples : numpy array of shape (n,m)
+            The samples of each frame, followed by zeros, m being the
+            largest number of samples of a frame
+        n_samples : numpy array of shape (n,)
+            The number of samples of each frame
+
+    """
+    is_decreasing = x[0] > x[-1]
+    x = np.where(is_decreasing, x[::-1], x).T
+    y = np.where(is_decreasing, y[::-1], y).T
+
+    # As utils.colon, with np.linspace
+    r1 = x[:, 0]
+    r2 = x[:, -1]
+    n = ((r2 - r1) + 2 * np.spacing(r2 - r1)) // ds
+    n_samples = n.astype(int) + 1
+
+    stop = r1 + ds * n
+    with np.errstate(invalid='ignore', divide='ignore'):
+        step = np.where(n > 0, (stop - r1) / n, 0)
+    sample_I = np.arange(np.max(n_samples, initial=1))
+    xx = sample_I[None, :] * step[:, None] + r1[:, None]
+    xx[np.arange(xx.shape[0]), n_samples - 1] = stop
+
+    # As np.interp, i.e. using the points either side of each value, or
+    # the last point for values at or beyond it
+    k = x.shape[1]
+    j = np.sum(x[:, None, :] <= xx[:, :, None], axis=2) - 1
+    j0 = np.minimum(np.maximum(j, 0), k - 2)
+    x0 = np.take_along_axis(x, j0, axis=1)
+    x1 = np.take_along_axis(x, j0 + 1, axis=1)
+    y0 = np.take_along_axis(y, j0, axis=1)
+    y1 = np.take_along_axis(y, j0 + 1, axis=1)
+    samples = (y1 - y0) / (x1 - x0) * (xx - x0) + y0
+    samples = np.where(j >= k - 1, y[:, -1:], samples)
+
+    samples[sample_I[None, :] >= n_samples[:, None]] = 0
+    return samples, n_samples
+
+
 class AmplitudeAndWavelengthProcessor(Feature):
 
     """
@@ -503,6 +596,9 @@ class AmplitudeAndWavelengthProcessor(Feature):
     track_length
     """
 
+    # The number of frames whose spectra are computed at once
+    batch_size = 4096
+
     def __init__(self, wf, feature_name):
         """
         Calculates amplitude of rotated worm (relies on orientation
@@ -610,35 +706,37 @@ class AmplitudeAndWavelengthProcessor(Feature):
         frames_to_calculate = \
             (np.logical_not(bad_worm_orientation)).nonzero()[0]
 
-        for cur_frame in frames_to_calculate:
+        # The frames are processed in batches, to limit the memory used
+        # for their spectra
+        for batch_start in range(0, frames_to_calculate.size,
+                                 self.batch_size):
+            frame_I = frames_to_calculate[
+                batch_start:batch_start + self.batch_size]
+
             # Create an evenly sampled x-axis, note that ds varies
-            xx = wwx[:, cur_frame]
-            yy = wwy[:, cur_frame]
-            if xx[0] > xx[-1]: #switch we want to have monotonically inceasing values
-                xx = xx[::-1]
-                yy = yy[::-1]
-            
-            iwwx = utils.colon(xx[0], ds[cur_frame], xx[-1])
-            iwwy = np.interp(iwwx, xx, yy)
-            iwwy = iwwy[::-1]
-            
-            temp = np.fft.fft(iwwy, N_POINTS_FFT)
+            iwwy, n_samples = _h_resample_evenly(
+                wwx[:, frame_I], wwy[:, frame_I], ds[frame_I])
+
+            # The samples of each frame are reversed, then padded with
+            # zeros to N_POINTS_FFT
+            sample_I = n_samples[:, None] - 1 - \
+                np.arange(iwwy.shape[1])[None, :]
+            iwwy = np.where(sample_I >= 0, np.take_along_axis(
+                iwwy, np.maximum(sample_I, 0), axis=1), 0)
 
+            temp = np.fft.rfft(iwwy, N_POINTS_FFT, axis=1)[:, 0:HALF_N_FFT]
 
             if options.mimic_old_behaviour:
-                iY = temp[0:HALF_N_FFT]
-                iY = iY * np.conjugate(iY) / N_POINTS_FFT
+                # i.e. temp * np.conjugate(temp) / N_POINTS_FFT
+                iY = (temp.real ** 2 + temp.imag ** 2) / N_POINTS_FFT
             else:
-                iY = np.abs(temp[0:HALF_N_FFT])
-            
-            
+                iY = np.abs(temp)
+
             # Find peaks that are greater than the cutoff
-            peaks, indx = utils.separated_peaks(iY,
-                                                MIN_DIST_PEAKS,
-                                                True,
-                                                (WAVELENGTH_PCT_MAX_CUTOFF *
-                                                 np.amax(iY)))
-            
+            is_peak = utils.separated_peaks_2D(
+                iY, MIN_DIST_PEAKS, True,
+                WAVELENGTH_PCT_MAX_CUTOFF * np.amax(iY, axis=1))
+
             # This is what the supplemental says, not what was done in
             # the previous code. I'm not sure what was done for the actual
             # paper, but I would guess they used power.
@@ -656,36 +754,35 @@ class AmplitudeAndWavelengthProcessor(Feature):
             # We sort the peaks so that the largest is at the first index
             # and will be primary, this was not done in the previous
             # version of the code
-            I = np.argsort(-1 * peaks)
-            indx = indx[I]
+            n_peaks = np.sum(is_peak, axis=1)
+            indx = np.argsort(np.where(is_peak, -iY, np.inf),
+                              axis=1)[:, 0:2]
 
             frequency_values = (indx - 1) / N_POINTS_FFT * \
-                spatial_sampling_frequency[cur_frame]
+                spatial_sampling_frequency[frame_I, None]
 
-            all_wavelengths = 1 / frequency_values
+            with np.errstate(divide='ignore'):
+                all_wavelengths = 1 / frequency_values
 
-            p_temp = all_wavelengths[0]
-
-            if indx.size > 1:
-                s_temp = all_wavelengths[1]
-            else:
-                s_temp = np.NaN
+            p_temp = np.where(n_peaks > 0, all_wavelengths[:, 0], np.NaN)
+            s_temp = np.where(n_peaks > 1, all_wavelengths[:, 1], np.NaN)
 
             worm_wavelength_max = (WAVELENGTH_PCT_CUTOFF *
-                                   worm_lengths[cur_frame])
+                                   worm_lengths[frame_I])
 
             # Cap wavelengths ...
-            if p_temp > worm_wavelength_max:
-                p_temp = worm_wavelength_max
-
-            # ??? Do we really want to keep this as well if p_temp == worm_2x?
-            # i.e., should the secondary wavelength be valid if the primary is
-            # also limited in this way ?????
-            if s_temp > worm_wavelength_max:
-                s_temp = worm_wavelength_max
+            #
+            # ??? Do we really want to keep this as well if p_temp ==
+            # worm_2x? i.e., should the secondary wavelength be valid if the
+            # primary is also limited in this way ?????
+            with np.errstate(invalid='ignore'):
+                p_temp = np.where(p_temp > worm_wavelength_max,
+                                  worm_wavelength_max, p_temp)
+                s_temp = np.where(s_temp > worm_wavelength_max,
+                                  worm_wavelength_max, s_temp)
 
-            primary_wavelength[cur_frame] = p_temp
-            secondary_wavelength[cur_frame] = s_temp
+            primary_wavelength[frame_I] = p_temp
+            secondary_wavelength[frame_I] = s_temp
 
         if options.mimic_old_behaviour:
             # In the old code, the first peak (i.e. larger wavelength,
@@ -847,40 +944,30 @@ class Coils(Feature):
 
         # Algorithm: Whenever a new start is found, find the
         # first segmented frame; that's the end.
-
-        # Add on a frame to allow closing a coil at the end ...
-        coil_start_mask = (frame_code == COIL_START_CODES[0]) | (
-            frame_code == COIL_START_CODES[1])
-        np_false = np.zeros((1,), dtype=bool)
-        coil_start_mask = np.concatenate((coil_start_mask, np_false))
-
-        # NOTE: These are not guaranteed ends, just possible ends ...
-        end_coil_mask = frame_code == FRAME_SEGMENTED
-        np_true = ~np_false
-        end_coil_mask = np.concatenate((end_coil_mask, np_true))
-
-        in_coil = False
-        coil_frame_start = -1
-        n_coils = 0
-        n_frames_plus1 = len(frame_code) + 1
-
-        starts = []
-        ends = []
-
-        for iFrame in range(n_frames_plus1):
-            if in_coil:
-                if end_coil_mask[iFrame]:
-                    n_coil_frames = iFrame - coil_frame_start
-                    if n_coil_frames >= COIL_FRAME_THRESHOLD:
-                        n_coils += 1
-
-                        starts.append(coil_frame_start)
-                        ends.append(iFrame - 1)
-
-                    in_coil = False
-            elif coil_start_mask[iFrame]:
-                in_coil = True
-                coil_frame_start = iFrame
+        #
+        # So each run of frames that weren't segmented holds at most one
+        # coil, from its first start code to the end of the run. A run at
+        # the end of the video is closed by the frame after it.
+        run_starts, run_stops, _ = utils.get_runs(
+            frame_code != FRAME_SEGMENTED)
+
+        coil_start_I = np.flatnonzero(
+            (frame_code == COIL_START_CODES[0]) |
+            (frame_code == COIL_START_CODES[1]))
+
+        # The first start code of each run, if it has one
+        next_start_I = np.searchsorted(coil_start_I, run_starts)
+        has_coil = next_start_I < coil_start_I.size
+        has_coil[has_coil] = coil_start_I[next_start_I[has_coil]] < \
+            run_stops[has_coil]
+
+        starts = coil_start_I[next_start_I[has_coil]]
+        end_coil_I = run_stops[has_coil]
+
+        n_coil_frames = end_coil_I - starts
+        is_long_enough = n_coil_frames >= COIL_FRAME_THRESHOLD
+        starts = starts[is_long_enough]
+        ends = end_coil_I[is_long_enough] - 1
 
         if options.mimic_old_behaviour:
             if (len(starts) > 0) and (ends[-1] == len(frame_code) - 1):
@@ -906,6 +993,83 @@ class Coils(Feature):
         return self
 
 
+def _h_count_kinks(smoothed_bend_angles, length_threshold):
+    """
+    The number of kinks of each frame, i.e. of stretches of bend angles
+    of the same sign that are at least length_threshold long.
+
+    Parameters
+    ----------
+    smoothed_bend_angles : numpy.array
+        [n_angles x n_frames]
+    length_threshold : float
+
+    Returns
+    -------
+    numpy.array
+        [n_frames], NaN for the frames with a zero angle or with NaN
+        values in the middle of the worm, which are not handled
+
+    """
+    angles = smoothed_bend_angles.T
+    n_frames, n_angles = angles.shape
+
+    is_nan = np.isnan(angles)
+    with np.errstate(invalid='ignore'):
+        data_sign = np.sign(angles)
+
+    # The first and last angles which are not NaN
+    first_I = np.argmax(~is_nan, axis=1)
+    last_I = n_angles - 1 - np.argmax(~is_nan[:, ::-1], axis=1)
+    has_data = ~np.all(is_nan, axis=1)
+
+    # I don't expect that we'll ever actually reach 0
+    # The code for zero was a bit weird, it keeps counting if no sign
+    # change i.e. + + + 0 + + + => all +
+    #
+    # but it counts for both if sign change
+    # + + 0 - - - => 3 +s and 4 -s
+    #
+    # The old code had a provision for having NaN values in the middle
+    # of the worm. I have not translated that feature to the newer code.
+    #
+    # Both cases do happen, their frames are left as NaN (AEJ)
+    is_unhandled = np.any(data_sign == 0, axis=1) | \
+        (has_data & (np.sum(~is_nan, axis=1) != last_I - first_I + 1))
+
+    # A stretch starts at each sign change. All NaN values are considered
+    # sign changes, but don't start a stretch.
+    is_start = ~is_nan
+    is_start[:, 1:] &= data_sign[:, 1:] != data_sign[:, :-1]
+
+    # Sorted by frame then angle
+    frame_I, start_I = is_start.nonzero()
+
+    is_first = np.ones(frame_I.size, dtype=bool)
+    is_first[1:] = frame_I[1:] != frame_I[:-1]
+    is_last = np.ones(frame_I.size, dtype=bool)
+    is_last[:-1] = frame_I[1:] != frame_I[:-1]
+
+    # Each stretch ends where the next one starts.
+    #
+    # We allow NaN values to count towards the length of the first and
+    # last stretches. The last stretch is counted one longer when it
+    # reaches the last angle, as in the frame by frame code this replaces.
+    stretch_start_I = np.where(is_first, 0, start_I)
+    next_start_I = np.append(start_I[1:], 0)
+    lengths = np.where(
+        ~is_last, next_start_I - stretch_start_I,
+        np.where(last_I[frame_I] == n_angles - 1,
+                 n_angles + 1 - stretch_start_I,
+                 n_angles - start_I))
+
+    n_kinks = np.bincount(frame_I, weights=lengths >= length_threshold,
+                          minlength=n_frames)
+    n_kinks[is_unhandled] = np.nan
+
+    return n_kinks
+
+
 class Kinks(Feature):
 
     def __init__(self, wf, feature_name):
@@ -952,76 +1116,12 @@ class Kinks(Feature):
         n_frames = bend_angles.shape[1]
         n_kinks_all = np.full(n_frames, np.nan, dtype=float)
 
-        #(np.any(np.logical_or(mask_pos,mask_neg),axis=0)).nonzero()[0]
-
-        nan_mask = np.isnan(bend_angles)
-
-        for iFrame in (~np.all(nan_mask, axis=0)).nonzero()[0]:
-            smoothed_bend_angles = filters.convolve1d(
-                bend_angles[:, iFrame], gauss_filter, cval=0, mode='constant')
-
-            # This code is nearly identical in getForaging
-            #-------------------------------------------------------
-            n_frames = smoothed_bend_angles.shape[0]
-
-            with np.errstate(invalid='ignore'):
-                dataSign = np.sign(smoothed_bend_angles)
-
-            if np.any(np.equal(dataSign, 0)):
-                # I don't expect that we'll ever actually reach 0
-                # The code for zero was a bit weird, it keeps counting if no sign
-                # change i.e. + + + 0 + + + => all +
-                #
-                # but it counts for both if sign change
-                # + + 0 - - - => 3 +s and 4 -s
-                
-                #this case does happend. I will continue (default nan) instead of risign an error (AEJ)
-                #raise Exception("Unhandled code case")
-                continue
-
-            sign_change_I = (
-                np.not_equal(dataSign[1:], dataSign[0:-1])).nonzero()[0]
-
-            end_I = np.concatenate(
-                (sign_change_I,
-                 n_frames * np.ones(1, dtype=np.result_type(sign_change_I))))
-
-            wtf1 = np.zeros(1, dtype=np.result_type(sign_change_I))
-            wtf2 = sign_change_I + 1
-            # +2? due to inclusion rules???
-            start_I = np.concatenate((wtf1, wtf2))
-
-            # All NaN values are considered sign changes, remove these ...
-            keep_mask = np.logical_not(np.isnan(smoothed_bend_angles[start_I]))
-
-            start_I = start_I[keep_mask]
-            end_I = end_I[keep_mask]
-
-            # The old code had a provision for having NaN values in the middle
-            # of the worm. I have not translated that feature to the newer code. I
-            # don't think it will ever happen though for a valid frame, only on the
-            # edges should you have NaN values.
-            if start_I.size != 0 and \
-               np.any(np.isnan(smoothed_bend_angles[start_I[0]:end_I[-1]])):
-                #this case does happend. I will continue (default nan) instead of risign an error (AEJ)
-                #raise Exception("Unhandled code case")
-                continue
-
-            #-------------------------------------------------------
-            # End of identical code ...
-
-            lengths = end_I - start_I + 1
-
-            # Adjust lengths for first and last:
-            # Basically we allow NaN values to count towards the length for the
-            # first and last stretches
-            if lengths.size != 0:
-                if start_I[0] != 0:  # Due to leading NaNs
-                    lengths[0] = end_I[0] + 1
-                if end_I[-1] != n_frames:  # Due to trailing NaNs
-                    lengths[-1] = n_frames - start_I[-1]
-
-            n_kinks_all[iFrame] = np.sum(lengths >= length_threshold)
+        frames_I = (~np.all(np.isnan(bend_angles), axis=0)).nonzero()[0]
+        smoothed_bend_angles = filters.convolve1d(
+            bend_angles[:, frames_I], gauss_filter, axis=0, cval=0,
+            mode='constant')
+        n_kinks_all[frames_I] = _h_count_kinks(smoothed_bend_angles,
+                                               length_threshold)
 
         timer.toc('posture.kinks')
 
@@ -1035,28 +1135,49 @@ class Kinks(Feature):
         return self
 
 
-def load_eigen_worms():
+# The eigenworms loaded so far, by file path
+_eigen_worms_cache = {}
+
+
+def load_eigen_worms(file_path=None):
     """
     Load the eigen_worms, which are stored in a Matlab data file
 
-    The eigenworms were computed by the Schafer lab based on N2 worms
+    The eigenworms are only read from the file the first time they are
+    asked for, then kept in memory.
+
+    Parameters
+    ----------
+    file_path : string (optional)
+        The file of the eigenworms. If not given the eigenworms computed
+        by the Schafer lab based on N2 worms (config.EIGENWORM_FILE) are
+        loaded.
 
     Returns
     ----------
     eigen_worms: [7 x 48]
+        A read-only array, as it is shared by all callers
 
     From http://stackoverflow.com/questions/50499/
 
     """
+    if file_path is None:
+        file_path = os.path.join(
+            os.path.dirname(os.path.realpath(__file__)),
+            config.EIGENWORM_FILE)
 
-    eigen_worm_file_path = os.path.join(
-    os.path.dirname(os.path.realpath(__file__)),
-    config.EIGENWORM_FILE)
+    try:
+        return _eigen_worms_cache[file_path]
+    except KeyError:
+        pass
 
-    h = h5py.File(eigen_worm_file_path, 'r')
-    eigen_worms = h['eigenWorms'].value
+    with h5py.File(file_path, 'r') as h:
+        eigen_worms = np.ascontiguousarray(np.transpose(h['eigenWorms'][()]))
 
-    return np.transpose(eigen_worms)
+    eigen_worms.setflags(write=False)
+    _eigen_worms_cache[file_path] = eigen_worms
+
+    return eigen_worms
 
 
 class EigenProjectionProcessor(Feature):
@@ -1080,11 +1201,9 @@ class EigenProjectionProcessor(Feature):
         posture_options = wf.options.posture
         N_EIGENWORMS_USE = posture_options.n_eigenworms_use
         timer = wf.timer
-        timer.toc
+        timer.tic()
         # eigen_worms: [7,48]
-        eigen_worms = load_eigen_worms()
-
-        
+        eigen_worms = load_eigen_worms(posture_options.eigen_worms_file)
 
         sx = wf.nw.skeleton_x
         sy = wf.nw.skeleton_y
@@ -1095,44 +1214,20 @@ class EigenProjectionProcessor(Feature):
             #switch in the angle sign in case of the contour orientation is anticlockwise
             angles = -angles
 
-        n_frames = angles.shape[1]
-
         # need to deal with cases where angle changes discontinuously from -pi
         # to pi and pi to -pi.  In these cases, subtract 2pi and add 2pi
         # respectively to all remaining points.  This effectively extends the
         # range outside the -pi to pi range.  Everything is re-centred later
         # when we subtract off the mean.
-        false_row = np.zeros((1, n_frames), dtype=bool)
-
-        # NOTE: By adding the row of falses, we shift the trues
-        # to the next value, which allows indices to match. Otherwise after every
-        # find statement we would need to add 1, I think this is a bit faster
-        # ...
-
+        #
+        # The correction of each point is the sum of the corrections of the
+        # jumps before it, for all frames at once. The first point has none.
         with np.errstate(invalid='ignore'):
-            mask_pos = np.concatenate(
-                (false_row, np.diff(angles, n=1, axis=0) > np.pi), axis=0)
-            mask_neg = np.concatenate(
-                (false_row, np.diff(angles, n=1, axis=0) < -np.pi), axis=0)
-
-        # Only fix the frames we need to, in which there is a jump in going
-        # from one segment to the next ...
-        fix_frames_I = (
-            np.any(np.logical_or(mask_pos, mask_neg), axis=0)).nonzero()[0]
-
-        for cur_frame in fix_frames_I:
-
-            positive_jump_I = (mask_pos[:, cur_frame]).nonzero()[0]
-            negative_jump_I = (mask_neg[:, cur_frame]).nonzero()[0]
-
-            # subtract 2pi from remainging data after positive jumps
-            # Note that the jumps impact all subsequent frames
-            for cur_pos_jump in positive_jump_I:
-                angles[cur_pos_jump:, cur_frame] -= 2 * np.pi
-
-            # add 2pi to remaining data after negative jumps
-            for cur_neg_jump in negative_jump_I:
-                angles[cur_neg_jump:, cur_frame] += 2 * np.pi
+            angle_changes = np.diff(angles, n=1, axis=0)
+            jump_corrections = 2 * np.pi * (
+                (angle_changes < -np.pi).astype(float) -
+                (angle_changes > np.pi))
+        angles[1:] += np.cumsum(jump_corrections, axis=0)
 
         angles = angles - np.mean(angles, axis=0)
         
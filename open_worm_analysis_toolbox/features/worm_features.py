@@ -26,7 +26,12 @@ SegwormMatlabClasses/+seg_worm/@feature_calculator/features.m
 
 import copy
 import csv
+import fnmatch
 import os
+import re
+import pickle
+import threading
+import traceback
 import warnings
 import h5py  # For loading from disk
 import numpy as np
@@ -34,9 +39,11 @@ import collections  # For namedtuple, OrderedDict
 import pandas as pd
 
 from .. import utils
+from ..prefeatures.normalized_worm import NormalizedWorm
 
 from . import feature_manipulations
 from . import feature_processing_options as fpo
+from . import feature_cache
 from . import events
 from . import generic_features
 from . import path_features
@@ -659,19 +666,43 @@ class WormFeatures(object):
 
     """
 
-    def __init__(self, nw, processing_options=None, specs='all'):
+    # The dependencies of each feature, as recorded by Feature.get_feature,
+    # from all the WormFeatures computed so far in this process.  Used to
+    # schedule the features when they are computed in parallel.
+    recorded_dependencies = {}
+
+    def __init__(self, nw, processing_options=None, specs='all',
+                 workers=None, cache=None, lazy=False):
         """
 
         Parameters
         ----------
         nw : NormalizedWorm object
-        specs :
+        specs : 'all', pandas.DataFrame, or string or list of strings
+            The features to compute: all of them, the rows of
+            get_feature_specs(), e.g. as returned by select_feature_specs,
+            or feature names, which may contain wildcards, see
+            select_feature_specs
 
         #The options will most likely change. We should have the options
         #be accessible from the specs
         processing_options: movement_validation.features.feature_processing_options
 
-        #TODO: Expose just passing in feature names as well
+        workers : int (optional)
+            If greater than 1, features which don't depend on each other
+            are computed at the same time, on this many threads.
+            See _retrieve_features_parallel
+
+        cache : FeatureCache (optional)
+            Features are taken from this cache if they have already been
+            computed for the same worm and options, and are added to it
+            otherwise. See feature_cache.FeatureCache
+
+        lazy : bool (default False)
+            If True nothing is computed here. A feature, and the features
+            it depends on, are computed when it is first asked for, by
+            get_features or by iterating over this object. timer then
+            only lists the features that have been computed.
 
 
         """
@@ -686,24 +717,67 @@ class WormFeatures(object):
         self.nw = nw
         self.timer = utils.ElementTimer()
 
+        self.cache = cache
+        if cache is not None:
+            # Up front, rather than by the first feature that is computed,
+            # so that it isn't done by each thread of a parallel computation
+            self._feature_cache_worm_key = feature_cache.get_worm_key(nw)
+
         self.initialize_features()
 
+        if isinstance(specs, (str, list, tuple)) and specs != 'all':
+            specs = select_feature_specs(names=specs)
+
+        # The features yielded when iterating over a lazy WormFeatures
+        self.lazy = lazy
+        if isinstance(specs, pd.core.frame.DataFrame):
+            self._lazy_feature_names = list(specs['feature_name'])
+        else:
+            self._lazy_feature_names = [name for name in self.specs
+                                        if not self.specs[name].is_temporary]
+
         # TODO: We should eventually support a list of specs as well
         # TODO: We might also allow transforming the specs (like changing options),
         # which this doesn't handle since we are only extracting the names
-        if isinstance(specs, pd.core.frame.DataFrame):
+        if lazy:
+            pass
+        elif isinstance(specs, pd.core.frame.DataFrame):
             # This wouldn't be good if the specs have changed.
             # We would need to change the initialize_features() call
             self.get_features(specs['feature_name'])
         else:
-            self._retrieve_all_features()
+            self._retrieve_all_features(workers)
 
     def __iter__(self):
         """  Let's allow iteration over the features """
+        # Not set when loaded from disk
+        if getattr(self, 'lazy', False):
+            for temp in self._iter_lazy_features():
+                yield temp
+            return
+
         all_features = self.features
         for temp in all_features:
             yield temp
 
+    def _iter_lazy_features(self):
+        """
+        Compute and yield each feature, when lazy. As in
+        _retrieve_all_features, a feature that can't be computed is
+        skipped with a warning.
+        """
+        for feature_name in self._lazy_feature_names:
+            try:
+                temp = self._get_and_log_feature(feature_name)
+            except Exception as e:
+                msg_warn = '{} was NOT calculated. {}'.format(feature_name, e)
+                warnings.warn(msg_warn)
+                continue
+            if temp is not None:
+                yield temp
+
+        self._record_dependencies()
+
     def copy(self, new_features):
         """
         This method was introduced for "feature expansion"
@@ -723,7 +797,8 @@ class WormFeatures(object):
         d = self.__dict__
         for key in d:
             temp = d[key]
-            if key in ['features', 'specs', 'h', '_temp_features']:
+            if key in ['features', 'specs', 'h', '_temp_features',
+                       '_feature_locks', '_feature_locks_lock']:
                 pass
                 # do nothing
                 # setattr(new_self,'spec',temp.copy())
@@ -741,9 +816,102 @@ class WormFeatures(object):
 
         new_self._features = temp_features
         new_self.specs = new_specs
+        new_self.lazy = False
 
         return new_self
 
+    @classmethod
+    def compute_many(cls, normalized_worms_or_paths, workers=None,
+                     processing_options=None, cache=None):
+        """
+        Compute the features of many worms, spread over worker processes.
+
+        Results are yielded as each worm finishes, which is not
+        necessarily in the order they were given. A worm whose loading or
+        feature computation fails is reported as such, without stopping
+        the others.
+
+        If a worker process dies (e.g. it runs out of memory), the worms
+        that weren't finished yet are all reported as failed, since which
+        of them killed the worker isn't known. With the futures backport
+        of Python 2 a dead worker process can instead make this wait
+        forever.
+
+        Parameters
+        ----------
+        normalized_worms_or_paths : iterable of NormalizedWorm or paths
+            A path is loaded in the worker process, so that the worm's data
+            isn't sent between processes, see load_normalized_worm
+        workers : int (optional)
+            The number of processes. If None or 1, the worms are computed
+            one after the other in this process.
+        processing_options : FeatureProcessingOptions (optional)
+        cache : FeatureCache (optional)
+            Shared by all the worker processes
+
+        Yields
+        ------
+        (index, worm_features, error)
+            index : int
+                The position of the worm in normalized_worms_or_paths
+            worm_features : WormFeatures, or None if the worm failed
+                The nw attribute is the NormalizedWorm if one was given, or
+                None if the worm was loaded from a path.
+            error : string, or None
+                The traceback of the failure
+
+        Example
+        -------
+        for index, wf, error in WormFeatures.compute_many(paths, workers=4):
+            if error is not None:
+                print('%s failed: %s' % (paths[index], error))
+
+        """
+        inputs = list(normalized_worms_or_paths)
+        jobs = [(index, x, processing_options, cache)
+                for index, x in enumerate(inputs)]
+
+        if workers is None or workers <= 1:
+            results = (_h_compute_features_worker(job) for job in jobs)
+            for index, worm_features, error in results:
+                if worm_features is not None and \
+                        isinstance(inputs[index], NormalizedWorm):
+                    worm_features.nw = inputs[index]
+                yield (index, worm_features, error)
+            return
+
+        # Python 2 needs the futures backport for this, see
+        # _retrieve_features_parallel
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+
+        executor = ProcessPoolExecutor(workers)
+        futures = {}
+        try:
+            for job in jobs:
+                futures[executor.submit(
+                    _h_compute_features_worker_pickled, job)] = job[0]
+            for future in as_completed(futures):
+                try:
+                    index, worm_features, error = future.result()
+                except Exception:
+                    # The worker process died (BrokenProcessPool), which
+                    # fails all the worms that weren't finished
+                    index = futures[future]
+                    worm_features = None
+                    error = traceback.format_exc()
+                if worm_features is not None:
+                    worm_features = pickle.loads(worm_features)
+                if worm_features is not None and \
+                        isinstance(inputs[index], NormalizedWorm):
+                    worm_features.nw = inputs[index]
+                yield (index, worm_features, error)
+        finally:
+            # If the results stop being asked for, don't start any more
+            # worms
+            for future in futures:
+                future.cancel()
+            executor.shutdown()
+
     @classmethod
     def from_disk(cls, data_file_path):
         """
@@ -797,10 +965,19 @@ class WormFeatures(object):
             d[x] for x in d if (
                 x is not None and not d[x].is_temporary and d[x].is_user_requested)]
 
-    def _retrieve_all_features(self):
+    def _retrieve_all_features(self, workers=None):
         """
         Simple function for retrieving all features.
+
+        Parameters
+        ----------
+        workers : int (optional)
+            If greater than 1, see _retrieve_features_parallel
         """
+        if workers is not None and workers > 1:
+            self._retrieve_features_parallel(list(self.specs), workers)
+            return
+
         spec_dict = self.specs
         # Trying to avoid 2v3 differences in Python dict iteration
         for key in spec_dict:
@@ -815,6 +992,179 @@ class WormFeatures(object):
                 msg_warn = '{} was NOT calculated. {}'.format(spec.name, e)
                 warnings.warn(msg_warn)
             
+        self._record_dependencies()
+
+    def _retrieve_features_parallel(self, feature_names, workers):
+        """
+        Compute features on a pool of threads.
+
+        A feature is only started once the features it depends on (as
+        recorded in WormFeatures.recorded_dependencies) have been computed,
+        so independent features are computed at the same time. A
+        dependency that hasn't been recorded (e.g. on the first run) is
+        computed when it is requested, as in the serial case; a lock per
+        feature ensures that each feature is only computed once.
+
+        Features which fail are warned about as in _retrieve_all_features.
+        Once done, self._features is put in the order the serial
+        computation would have given.
+
+        Parameters
+        ----------
+        feature_names : list of strings
+        workers : int
+            The number of threads
+
+        """
+        # Python 2 needs the futures backport for this, so it is only
+        # imported when features are computed in parallel
+        from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, \
+            wait
+
+        self._feature_locks = {}
+        self._feature_locks_lock = threading.Lock()
+
+        def retrieve_feature(feature_name):
+            try:
+                self._get_and_log_feature(feature_name)
+            except Exception as e:
+                msg_warn = '{} was NOT calculated. {}'.format(feature_name, e)
+                warnings.warn(msg_warn)
+
+        # Only dependencies between the requested features are waited on
+        requested = set(feature_names)
+        dependencies = dict(
+            (name, set(self.recorded_dependencies.get(name, [])) & requested)
+            for name in feature_names)
+        dependents = dict((name, []) for name in feature_names)
+        for name in feature_names:
+            for dependency in dependencies[name]:
+                dependents[dependency].append(name)
+        n_waiting_for = dict((name, len(dependencies[name]))
+                             for name in feature_names)
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                running = {}
+                for name in feature_names:
+                    if n_waiting_for[name] == 0:
+                        running[executor.submit(retrieve_feature, name)] = \
+                            name
+                while running:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        name = running.pop(future)
+                        for dependent in dependents[name]:
+                            n_waiting_for[dependent] -= 1
+                            if n_waiting_for[dependent] == 0:
+                                running[executor.submit(
+                                    retrieve_feature, dependent)] = dependent
+        finally:
+            del self._feature_locks
+            del self._feature_locks_lock
+
+        self._record_dependencies()
+
+        # The order in which the serial computation would have added the
+        # features: each feature after the features it depends on
+        ordered_features = collections.OrderedDict()
+
+        def add_feature(name):
+            if name in ordered_features or name not in self._features:
+                return
+            for dependency in self.get_dependencies(name):
+                add_feature(dependency)
+            ordered_features[name] = self._features[name]
+
+        for name in feature_names:
+            add_feature(name)
+        for name in self._features:
+            add_feature(name)
+        self._features = ordered_features
+
+    def _record_dependencies(self):
+        """
+        Add the dependencies of the computed features to
+        WormFeatures.recorded_dependencies
+        """
+        for name in self._features:
+            dependencies = self.get_dependencies(name)
+            recorded = self.recorded_dependencies.setdefault(name, [])
+            for dependency in dependencies:
+                if dependency not in recorded:
+                    recorded.append(dependency)
+
+    def get_dependencies(self, feature_name):
+        """
+        The names of the features that a computed feature requested while
+        it was computed, in the order they were requested.
+        """
+        return list(getattr(self._features[feature_name], 'dependencies', []))
+
+    def get_dependency_graph(self):
+        """
+        Returns
+        -------
+        collections.OrderedDict
+            For each computed feature, the list of features it depends on
+        """
+        return collections.OrderedDict(
+            (name, self.get_dependencies(name)) for name in self._features)
+
+    def get_critical_path(self):
+        """
+        The chain of dependent features which takes the longest to compute,
+        i.e. the least time the features could be computed in, no matter
+        how many of them are computed at the same time.
+
+        Each feature is weighted by its exclusive_computation_time, the time
+        spent computing it excluding the features it depends on.
+
+        Returns
+        -------
+        (feature_names, critical_time, total_time)
+            feature_names : list of strings, from the first feature to
+                be computed to the last
+            critical_time : float, seconds to compute the critical path
+            total_time : float, seconds to compute all features one at
+                a time
+
+        """
+        path_times = {}
+        path_previous = {}
+
+        def get_path_time(name):
+            if name not in path_times:
+                previous = None
+                previous_time = 0
+                for dependency in self.get_dependencies(name):
+                    if dependency in self._features and \
+                            get_path_time(dependency) > previous_time:
+                        previous = dependency
+                        previous_time = path_times[dependency]
+                path_previous[name] = previous
+                path_times[name] = previous_time + getattr(
+                    self._features[name], 'exclusive_computation_time', 0)
+            return path_times[name]
+
+        total_time = 0
+        for name in self._features:
+            get_path_time(name)
+            total_time += getattr(self._features[name],
+                                  'exclusive_computation_time', 0)
+
+        if len(path_times) == 0:
+            return ([], 0, 0)
+
+        name = max(path_times, key=lambda x: path_times[x])
+        critical_time = path_times[name]
+        feature_names = []
+        while name is not None:
+            feature_names.insert(0, name)
+            name = path_previous[name]
+
+        return (feature_names, critical_time, total_time)
+
     def initialize_features(self):
         """
         Reads the feature specs and initializes necessary attributes.
@@ -896,6 +1246,22 @@ class WormFeatures(object):
         FeatureProcessingSpec.get_feature
         """
 
+        # When computing features in parallel, the feature is computed
+        # while holding its lock, so that other threads requesting it wait
+        # for it rather than computing it again
+        feature_locks = getattr(self, '_feature_locks', None)
+        if feature_locks is not None and feature_name not in self._features:
+            with self._feature_locks_lock:
+                lock = feature_locks.setdefault(feature_name,
+                                                threading.RLock())
+            with lock:
+                return self._get_and_log_feature_unlocked(feature_name,
+                                                          internal_request)
+
+        return self._get_and_log_feature_unlocked(feature_name,
+                                                  internal_request)
+
+    def _get_and_log_feature_unlocked(self, feature_name, internal_request):
         # Early return if already computed
         #----------------------------------
         if feature_name in self._features:
@@ -1038,6 +1404,65 @@ class WormFeatures(object):
             return feature_spec_expanded
 
 
+def load_normalized_worm(file_path):
+    """
+    Load a NormalizedWorm from a file, of any of the supported formats:
+
+    - a directory written by NormalizedWorm.save_to_array_store
+    - an HDF5 file written by NormalizedWorm.save_to_HDF5
+    - a Schafer lab .mat file
+
+    """
+    if os.path.isdir(file_path):
+        return NormalizedWorm.from_array_store(file_path)
+    elif h5py.is_hdf5(file_path):
+        return NormalizedWorm.from_HDF5_file_factory(file_path)
+    else:
+        return NormalizedWorm.from_schafer_file_factory(file_path)
+
+
+def _h_compute_features_worker(job):
+    """
+    Compute the features of one worm, for WormFeatures.compute_many
+
+    Parameters
+    ----------
+    job : (index, normalized_worm_or_path, processing_options, cache)
+
+    Returns
+    -------
+    (index, worm_features, error)
+        See WormFeatures.compute_many. worm_features is returned without
+        its NormalizedWorm, which the caller already has or doesn't need.
+
+    """
+    index, nw, processing_options, cache = job
+    try:
+        if not isinstance(nw, NormalizedWorm):
+            nw = load_normalized_worm(nw)
+        worm_features = WormFeatures(nw, processing_options, cache=cache)
+        worm_features.nw = None
+        return (index, worm_features, None)
+    except Exception:
+        return (index, None, traceback.format_exc())
+
+
+def _h_compute_features_worker_pickled(job):
+    """
+    As _h_compute_features_worker, but with worm_features already pickled,
+    so that a worm whose features can't be pickled fails on its own
+    rather than in the pool, which would stop all the other worms.
+    """
+    index, worm_features, error = _h_compute_features_worker(job)
+    if worm_features is not None:
+        try:
+            worm_features = pickle.dumps(worm_features,
+                                         pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return (index, None, traceback.format_exc())
+    return (index, worm_features, error)
+
+
 def get_feature_specs(as_table=True):
     """
 
@@ -1096,6 +1521,85 @@ def get_feature_specs(as_table=True):
         return f_specs
 
 
+def select_feature_specs(names=None, regex=None, query=None,
+                         include_temporary=False):
+    """
+    Select features from the feature specifications, e.g. to compute
+    only those features:
+
+        specs = select_feature_specs(names='locomotion.velocity.*')
+        wf = WormFeatures(nw, specs=specs)
+
+    A feature is selected if it matches any of names, regex or query.
+    Only the selected features are computed, plus the (temporary)
+    features that they request while they are computed, e.g.
+    posture.eccentricity_and_orientation for posture.eccentricity.
+
+    Parameters
+    ----------
+    names : string or list of strings (optional)
+        Feature names, which may contain shell-style wildcards (see
+        fnmatch), e.g. 'locomotion.velocity.*.speed'
+    regex : string or list of strings (optional)
+        Regular expressions, which match anywhere in the feature name
+    query : string (optional)
+        A pandas query of the specification table, see
+        pandas.DataFrame.query and get_feature_specs, e.g.
+        "category == 'posture'"
+    include_temporary : bool (default False)
+        Whether temporary features may be selected. They don't need to be
+        selected to be computed when needed.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The rows of get_feature_specs() for the selected features
+
+    """
+    df = get_feature_specs()
+
+    if names is None and regex is None and query is None:
+        is_selected = np.ones(len(df), dtype=bool)
+    else:
+        is_selected = np.zeros(len(df), dtype=bool)
+
+    if isinstance(names, str):
+        names = [names]
+    for pattern in names or []:
+        is_selected |= [fnmatch.fnmatchcase(name, pattern)
+                        for name in df.feature_name]
+
+    if isinstance(regex, str):
+        regex = [regex]
+    for pattern in regex or []:
+        pattern = re.compile(pattern)
+        is_selected |= [pattern.search(name) is not None
+                        for name in df.feature_name]
+
+    if query is not None:
+        is_selected |= df.index.isin(df.query(query).index)
+
+    if not include_temporary:
+        is_selected &= ~df.is_temporary.values
+
+    return df[is_selected]
+
+
+_thread_state = threading.local()
+
+
+def _h_dependency_times():
+    """
+    For the calling thread, the stack of the time spent computing the
+    dependencies of each feature currently being computed.
+    """
+    try:
+        return _thread_state.dependency_times
+    except AttributeError:
+        _thread_state.dependency_times = []
+        return _thread_state.dependency_times
+
+
 class FeatureProcessingSpec(object):
     """
     Information about a feature, including how to retrieve the feature.
@@ -1251,20 +1755,48 @@ class FeatureProcessingSpec(object):
 
         
         timer = wf.timer
-        timer.tic()
-
-        # The flags input is optional, if no flag is present
-        # we currently assume that the constructor doesn't require
-        # the input
-        if len(self.flags) == 0:
-            temp = final_method(wf, self.name)
-        else:
-            # NOTE: All current flags are just a single string. We don't have
-            # anything fancy in place for multiple parameters or for doing
-            # any fancy parsing
-            temp = final_method(wf, self.name, self.flags)
+        timer_depth = timer.tic()
+
+        # The time spent computing the features this feature requests
+        dependency_times = _h_dependency_times()
+        dependency_times.append(0)
+
+        # Only features computed from the normalized worm are cached
+        cache = getattr(wf, 'cache', None)
+        if self.source != 'new':
+            cache = None
+
+        try:
+            temp = None
+            if cache is not None:
+                cache_key = cache.get_key(wf, self)
+                temp = cache.get(cache_key)
+
+            if temp is None:
+                # The flags input is optional, if no flag is present
+                # we currently assume that the constructor doesn't require
+                # the input
+                if len(self.flags) == 0:
+                    temp = final_method(wf, self.name)
+                else:
+                    # NOTE: All current flags are just a single string. We
+                    # don't have anything fancy in place for multiple
+                    # parameters or for doing any fancy parsing
+                    temp = final_method(wf, self.name, self.flags)
+
+                # Before the attributes below are set, which are specific
+                # to this computation of the feature
+                if cache is not None and temp is not None:
+                    cache.put(cache_key, temp)
+        except:
+            timer.cancel(timer_depth)
+            raise
+        finally:
+            dependency_time = dependency_times.pop()
 
         elapsed_time = timer.toc(self.name)
+        if len(dependency_times) > 0:
+            dependency_times[-1] += elapsed_time
 
         # This is an assigment of global attributes that the spec knows about
         # This could eventually be handled by a super() call to Feature
@@ -1282,6 +1814,7 @@ class FeatureProcessingSpec(object):
         # We could allow children to copy the value from the parent but
         # then we would need to check for that here ...
         temp.computation_time = elapsed_time
+        temp.exclusive_computation_time = elapsed_time - dependency_time
 
         # We can get rid of the name assignments in class and use this ...
         temp.name = self.name
@@ -25,6 +25,8 @@ from collections import namedtuple, Iterable, OrderedDict
 
 from .. import config, utils
 from .pre_features import WormParsing
+from .ragged_frames import RaggedFrames
+from .hdf5_frames import read_referenced_frames, LazyReferencedFrames
 from .video_info import VideoInfo
 
 #%%
@@ -35,6 +37,10 @@ class JSON_Serializer():
     A class that can save all of its attributes to a JSON file, or
     load them from a JSON file.
 
+    The attributes can also be saved to a binary file, in which numpy
+    arrays are stored as raw buffers rather than as JSON lists, which is
+    much smaller and faster for large arrays.
+
     """
 
     def __init__(self):
@@ -55,6 +61,34 @@ class JSON_Serializer():
         for member in member_list:
             setattr(self, member[0], member[1])
 
+    def save_to_binary(self, file_path, compress=False):
+        """
+        Save all attributes to a binary (.npz) file.
+
+        Parameters
+        ----------
+        file_path: string
+        compress: bool
+            If True the file is zip compressed
+
+        """
+        data_to_binary(list(self.__dict__.items()), file_path, compress)
+
+    def load_from_binary(self, file_path):
+        """
+        Load all attributes from a file written by save_to_binary, or by
+        save_to_JSON.
+
+        """
+        if is_binary_file(file_path):
+            member_list = binary_to_data(file_path)
+        else:
+            with open(file_path, 'r') as infile:
+                member_list = json_to_data(infile.read())
+
+        for member in member_list:
+            setattr(self, member[0], member[1])
+
 #%%
 
 
@@ -192,6 +226,10 @@ class BasicWorm(JSON_Serializer):
         Where k_i is the number of skeleton points in frame i.
         The first axis of the numpy array, having len 2, is the x and y.
          Missing frames should be identified by None.
+        This is stored as a RaggedFrames instance, which can be indexed
+        and iterated like the list but holds all frames in one array
+        (or, from from_schafer_file_factory(lazy=True), as a
+        LazyReferencedFrames instance which reads frames from the file).
     h_ventral_contour:   Same type and shape as skeleton (see above)
         The vulva side of the contour.
     h_dorsal_contour: Same type and shape as skeleton (see above)
@@ -216,10 +254,24 @@ class BasicWorm(JSON_Serializer):
                 setattr(self, a, copy.deepcopy(getattr(other, a)))
 
     @classmethod
-    def from_schafer_file_factory(cls, data_file_path):
+    def from_schafer_file_factory(cls, data_file_path, lazy=False):
+        """
+        Load a BasicWorm from a Schafer lab (MATLAB 7.3, HDF5) file
+
+        Parameters
+        ----------
+        data_file_path: string
+        lazy: bool
+            If True the frames are only read from the file when they are
+            asked for (e.g. by the skeletonization), and the file is kept
+            open. The contours and the loaded skeleton are then
+            LazyReferencedFrames rather than RaggedFrames.
+
+        """
         bw = cls()
 
-        with h5py.File(data_file_path, 'r') as h:
+        h = h5py.File(data_file_path, 'r')
+        try:
             # These are all HDF5 'references'
             all_ventral_contours_refs = h['all_vulva_contours'].value
             all_dorsal_contours_refs = h['all_non_vulva_contours'].value
@@ -229,22 +281,21 @@ class BasicWorm(JSON_Serializer):
                 h, 'is_stage_movement')
             is_valid = utils._extract_time_from_disk(h, 'is_valid')
 
-            all_skeletons = []
-            all_ventral_contours = []
-            dorsal_contour = []
-
-            for valid_frame, iFrame in zip(is_valid, range(is_valid.size)):
-                if valid_frame:
-                    all_skeletons.append(
-                        h[all_skeletons_refs[iFrame][0]].value)
-                    all_ventral_contours.append(
-                        h[all_ventral_contours_refs[iFrame][0]].value)
-                    dorsal_contour.append(
-                        h[all_dorsal_contours_refs[iFrame][0]].value)
-                else:
-                    all_skeletons.append(None)
-                    all_ventral_contours.append(None)
-                    dorsal_contour.append(None)
+            if lazy:
+                read_frames = LazyReferencedFrames
+            else:
+                read_frames = read_referenced_frames
+
+            all_skeletons = read_frames(h, all_skeletons_refs, is_valid)
+            all_ventral_contours = read_frames(
+                h, all_ventral_contours_refs, is_valid)
+            dorsal_contour = read_frames(
+                h, all_dorsal_contours_refs, is_valid)
+        except:
+            h.close()
+            raise
+        if not lazy:
+            h.close()
 
         # Video Metadata
         is_stage_movement = is_stage_movement.astype(bool)
@@ -292,14 +343,15 @@ class BasicWorm(JSON_Serializer):
         
         
         if not isinstance(ventral_contour, (list,tuple)):
-            # we need to change the data from a (49,2,n) array to a list of (2,49)
+            # we need to change the data from a (49,2,n) array to frames
+            # of shape (2,49)
             assert(np.shape(ventral_contour) == np.shape(dorsal_contour))
             assert ventral_contour.shape[1] == 2
-            h_ventral_contour = WormParsing._h_array2list(ventral_contour)
-            h_dorsal_contour = WormParsing._h_array2list(dorsal_contour)
+            h_ventral_contour = RaggedFrames.from_array(ventral_contour)
+            h_dorsal_contour = RaggedFrames.from_array(dorsal_contour)
         else:
-            h_ventral_contour = ventral_contour
-            h_dorsal_contour = dorsal_contour
+            h_ventral_contour = RaggedFrames.from_list(ventral_contour)
+            h_dorsal_contour = RaggedFrames.from_list(dorsal_contour)
 
         # Here I am checking that the contour missing frames are aligned. 
         # I prefer to populate the frame_code in normalized worm.
@@ -329,10 +381,10 @@ class BasicWorm(JSON_Serializer):
             bw.h_ventral_contour = None 
             bw.h_dorsal_contour = None
             if isinstance(skeleton,  (list,tuple)):
-                bw._h_skeleton =  skeleton
+                bw._h_skeleton = RaggedFrames.from_list(skeleton)
             else:
                 assert skeleton.shape[1] == 2
-                bw._h_skeleton =  WormParsing._h_array2list(skeleton)
+                bw._h_skeleton = RaggedFrames.from_array(skeleton)
             return bw
 
         else:
@@ -377,7 +429,7 @@ class BasicWorm(JSON_Serializer):
 
     @h_ventral_contour.setter
     def h_ventral_contour(self, x):
-        self._h_ventral_contour = x
+        self._h_ventral_contour = self._as_ragged_frames(x)
         self.__remove_precalculated_skeleton()
 
     @property
@@ -386,9 +438,25 @@ class BasicWorm(JSON_Serializer):
 
     @h_dorsal_contour.setter
     def h_dorsal_contour(self, x):
-        self._h_dorsal_contour = x
+        self._h_dorsal_contour = self._as_ragged_frames(x)
         self.__remove_precalculated_skeleton()
 
+    @staticmethod
+    def _as_ragged_frames(frames):
+        """
+        Convert a list of frames, or a numpy array of shape (k,2,n), to
+        RaggedFrames. None, RaggedFrames and LazyReferencedFrames are
+        returned as is.
+
+        """
+        if frames is None or isinstance(frames, (RaggedFrames,
+                                                 LazyReferencedFrames)):
+            return frames
+        elif isinstance(frames, np.ndarray):
+            return RaggedFrames.from_array(frames)
+        else:
+            return RaggedFrames.from_list(frames)
+
     def __remove_precalculated_skeleton(self):
         """
         Removes the precalculated self._h_skeleton, if it exists.
@@ -425,8 +493,9 @@ class BasicWorm(JSON_Serializer):
         except AttributeError:
             # Extrapolate skeleton from contour
             # TODO: improve this: for now
-            self._h_widths, self._h_skeleton = \
+            self._h_widths, h_skeleton = \
             WormParsing.compute_skeleton_and_widths(self.h_ventral_contour, self.h_dorsal_contour)
+            self._h_skeleton = RaggedFrames.from_list(h_skeleton)
             #how can i call _h_widths???
 
             return self._h_skeleton
@@ -643,40 +712,76 @@ def isnamedtuple(obj):
         and callable(obj._asdict)
 
 
-def serialize(data):
-    """
+def serialize(data, arrays=None):
     """
+    Convert data to JSON serializable data.
+
+    Parameters
+    ----------
+    data: the data to serialize
+    arrays: list (optional)
+        If given, numpy arrays are appended to arrays and only referred to
+        by their index in it, rather than being converted to lists.
 
+    """
     if data is None or isinstance(data, (bool, int, float, str)):
         return data
     if isinstance(data, list):
-        return [serialize(val) for val in data]
+        return [serialize(val, arrays) for val in data]
     if isinstance(data, OrderedDict):
         return {"py/collections.OrderedDict":
-                [[serialize(k), serialize(v)] for k, v in data.items()]}
+                [[serialize(k, arrays), serialize(v, arrays)]
+                 for k, v in data.items()]}
     if isnamedtuple(data):
         return {"py/collections.namedtuple": {
             "type": type(data).__name__,
             "fields": list(data._fields),
-            "values": [serialize(getattr(data, f)) for f in data._fields]}}
+            "values": [serialize(getattr(data, f), arrays)
+                       for f in data._fields]}}
     if isinstance(data, dict):
         if all(isinstance(k, str) for k in data):
-            return {k: serialize(v) for k, v in data.items()}
-        return {"py/dict": [[serialize(k), serialize(v)]
+            return {k: serialize(v, arrays) for k, v in data.items()}
+        return {"py/dict": [[serialize(k, arrays), serialize(v, arrays)]
                             for k, v in data.items()]}
     if isinstance(data, tuple):
-        return {"py/tuple": [serialize(val) for val in data]}
+        return {"py/tuple": [serialize(val, arrays) for val in data]}
     if isinstance(data, set):
-        return {"py/set": [serialize(val) for val in data]}
+        return {"py/set": [serialize(val, arrays) for val in data]}
     if isinstance(data, np.ndarray):
+        if arrays is not None and data.dtype != object:
+            arrays.append(data)
+            return {"py/numpy.ndarray": {"array": len(arrays) - 1}}
         return {"py/numpy.ndarray": {
             "values": data.tolist(),
             "dtype": str(data.dtype)}}
+    if isinstance(data, (RaggedFrames, LazyReferencedFrames)):
+        if arrays is not None:
+            if isinstance(data, LazyReferencedFrames):
+                data = data.load()
+            return {"py/RaggedFrames": {
+                "data": serialize(data.data, arrays),
+                "offsets": serialize(data.offsets, arrays),
+                "is_valid": serialize(data.is_valid, arrays)}}
+        # Saved as the list of frames it stands in for
+        return serialize(data.to_list())
+    if isinstance(data, VideoInfo):
+        return {"py/VideoInfo": {
+            "metadata": serialize(data.get_metadata(), arrays),
+            "frame_code": serialize(getattr(data, 'frame_code', None),
+                                    arrays)}}
     raise TypeError("Type %s not data-serializable" % type(data))
 
 
-def restore(dct):
+def restore(dct, arrays=None):
     """
+    The object_hook for json.loads undoing serialize.
+
+    Parameters
+    ----------
+    dct: dict
+    arrays: list or numpy NpzFile (optional)
+        The arrays referred to by index, see serialize
+
     """
 
     if "py/dict" in dct:
@@ -690,9 +795,17 @@ def restore(dct):
         return namedtuple(data["type"], data["fields"])(*data["values"])
     if "py/numpy.ndarray" in dct:
         data = dct["py/numpy.ndarray"]
+        if "array" in data:
+            return arrays[_h_array_key(data["array"])]
         return np.array(data["values"], dtype=data["dtype"])
     if "py/collections.OrderedDict" in dct:
         return OrderedDict(dct["py/collections.OrderedDict"])
+    if "py/RaggedFrames" in dct:
+        data = dct["py/RaggedFrames"]
+        return RaggedFrames(data["data"], data["offsets"], data["is_valid"])
+    if "py/VideoInfo" in dct:
+        data = dct["py/VideoInfo"]
+        return VideoInfo.from_metadata(data["metadata"], data["frame_code"])
     return dct
 
 
@@ -710,6 +823,59 @@ def json_to_data(s):
     return json.loads(s, object_hook=restore)
 
 
+def _h_array_key(array_index):
+    return 'array_%d' % array_index
+
+
+def data_to_binary(data, file_path, compress=False):
+    """
+    Save data to an .npz file: the structure of the data as JSON, as in
+    data_to_json, with each numpy array stored as its own .npy entry,
+    i.e. as its raw buffer with its dtype and shape.
+
+    Parameters
+    ----------
+    data: the data to save
+    file_path: string
+    compress: bool
+        If True the file is zip compressed
+
+    """
+    arrays = []
+    structure = json.dumps(serialize(data, arrays)).encode('utf-8')
+
+    entries = {_h_array_key(i): a for i, a in enumerate(arrays)}
+    entries['structure'] = np.frombuffer(structure, dtype=np.uint8)
+
+    # Passing a file object stops numpy from appending '.npz' to the path
+    with open(file_path, 'wb') as outfile:
+        if compress:
+            np.savez_compressed(outfile, **entries)
+        else:
+            np.savez(outfile, **entries)
+
+
+def binary_to_data(file_path):
+    """
+    Load data saved with data_to_binary.
+
+    """
+    with np.load(file_path) as arrays:
+        structure = arrays['structure'].tobytes().decode('utf-8')
+        return json.loads(structure,
+                          object_hook=lambda dct: restore(dct, arrays))
+
+
+def is_binary_file(file_path):
+    """
+    Whether the file was written by data_to_binary (an .npz, i.e. zip,
+    file), rather than being a JSON file.
+
+    """
+    with open(file_path, 'rb') as infile:
+        return infile.read(4) == b'PK\x03\x04'
+
+
 def nested_equal(v1, v2):
     """
     Compares two complex data structures.
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Reading heterocardinal frames stored as HDF5 object references
+
+In the Schafer lab (MATLAB 7.3) files each frame of a heterocardinal
+skeleton or contour is its own small dataset, and e.g. 'all_skeletons'
+is an array of references to these datasets. Resolving each reference
+through the high level h5py interface (h[ref].value) costs several
+Python objects and HDF5 calls per frame, which dominates the loading
+time of long videos.
+
+read_referenced_frames resolves the references of a reference array with
+the low level h5py interface, in batches, reading the frames of each batch
+in the order in which they are stored in the file, into a RaggedFrames.
+
+LazyReferencedFrames instead only reads a frame when it is asked for.
+
+"""
+import numpy as np
+import h5py
+
+from .ragged_frames import RaggedFrames
+
+
+def _h_read_dataset(dataset_id):
+    frame = np.empty(dataset_id.shape)
+    dataset_id.read(h5py.h5s.ALL, h5py.h5s.ALL, frame)
+    return frame
+
+
+def read_referenced_frames(h, refs, is_valid, batch_size=256):
+    """
+    Read all valid frames pointed to by a reference array.
+
+    The references are resolved a batch at a time, and the frames of each
+    batch are read in the order in which they are stored in the file.
+    (Keeping the datasets of all frames open at once makes resolving
+    each reference slower.)
+
+    Parameters
+    ----------
+    h: h5py.File
+    refs: numpy array of h5py references, of shape (n,) or (n,1)
+    is_valid: numpy array of shape (n,)
+        Only the frames that are valid are read, the others are missing
+    batch_size: int
+        The number of references to resolve at a time
+
+    Returns
+    -------
+    RaggedFrames
+
+    """
+    refs = np.asarray(refs).ravel()
+    is_valid = np.asarray(is_valid).astype(bool)
+    frame_I = np.flatnonzero(is_valid)
+
+    frames = [None] * len(frame_I)
+    for start in range(0, len(frame_I), batch_size):
+        dataset_ids = [h5py.h5r.dereference(refs[frame_index], h.id)
+                       for frame_index in frame_I[start:start + batch_size]]
+
+        # get_offset is None for datasets which are not stored
+        # contiguously, these are read first
+        file_offsets = [dataset_id.get_offset() for dataset_id in
+                        dataset_ids]
+        file_offsets = [-1 if x is None else x for x in file_offsets]
+        for i in np.argsort(file_offsets, kind='mergesort'):
+            frames[start + i] = _h_read_dataset(dataset_ids[i])
+
+    n_points = np.zeros(len(is_valid), dtype=int)
+    n_points[frame_I] = [frame.shape[1] for frame in frames]
+    offsets = np.concatenate(([0], np.cumsum(n_points)))
+    if len(frames) > 0:
+        data = np.concatenate(frames, axis=1)
+    else:
+        data = np.empty((2, 0))
+
+    return RaggedFrames(data, offsets, is_valid)
+
+
+class LazyReferencedFrames(object):
+    """
+    A list-like container of the frames pointed to by a reference array,
+    which reads each frame from the file the first time it is asked for.
+
+    Frames that have been read are kept, so changes made to them (e.g.
+    the in place smoothing of the contours by the skeletonization) are
+    kept as well.
+
+    The file is kept open until close() is called, or the file object is
+    garbage collected.
+
+    Attributes
+    ----------
+    h: h5py.File
+    refs: numpy array of shape (n,) of h5py references
+    is_valid: numpy array of shape (n,) of bool
+
+    """
+
+    def __init__(self, h, refs, is_valid):
+        self.h = h
+        self.refs = np.asarray(refs).ravel()
+        self.is_valid = np.asarray(is_valid).astype(bool)
+        self._frames = {}
+
+    def __len__(self):
+        return len(self.is_valid)
+
+    def __getitem__(self, frame_index):
+        if isinstance(frame_index, slice):
+            return [self[i] for i in range(*frame_index.indices(len(self)))]
+
+        if not self.is_valid[frame_index]:
+            return None
+
+        if frame_index < 0:
+            frame_index += len(self)
+        try:
+            return self._frames[frame_index]
+        except KeyError:
+            frame = _h_read_dataset(h5py.h5r.dereference(
+                self.refs[frame_index], self.h.id))
+            self._frames[frame_index] = frame
+            return frame
+
+    def __iter__(self):
+        for frame_index in range(len(self)):
+            yield self[frame_index]
+
+    def load(self):
+        """
+        Read all frames at once.
+
+        Returns
+        -------
+        RaggedFrames
+            With the frames that had already been read (and possibly
+            changed) rather than their values in the file.
+
+        """
+        frames = read_referenced_frames(self.h, self.refs, self.is_valid)
+        for frame_index, frame in self._frames.items():
+            frames[frame_index][:] = frame
+        return frames
+
+    def to_list(self):
+        return list(self)
+
+    def close(self):
+        self.h.close()
+
+    def __deepcopy__(self, memo):
+        # A copy is no longer tied to the file
+        return self.load()
+
+    def __repr__(self):
+        return "LazyReferencedFrames(%d frames, %d valid, %d read)" % \
+            (len(self), np.sum(self.is_valid), len(self._frames))
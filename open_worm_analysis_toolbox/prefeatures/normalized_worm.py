@@ -6,8 +6,10 @@ This module defines the NormalizedWorm class
 
 import numpy as np
 import scipy.io
+import h5py
 
 import copy
+import json
 import warnings
 import os
 import matplotlib.pyplot as plt
@@ -40,6 +42,11 @@ class NormalizedWorm(WormPartition):
     It also contains video metadata, in :
         video_info : An instance of VideoInfo
 
+    The arrays can be saved to disk and loaded back memory-mapped, so
+    frames are only read when used, with save_to_array_store and
+    from_array_store, or saved to one HDF5 file with save_to_HDF5 and
+    from_HDF5_file_factory.
+
     """
 
     def __init__(self, other=None):
@@ -63,7 +70,8 @@ class NormalizedWorm(WormPartition):
                 setattr(self, a, copy.deepcopy(getattr(other, a)))
 
     @classmethod
-    def from_BasicWorm_factory(cls, basic_worm, frames_to_plot_widths=[]):
+    def from_BasicWorm_factory(cls, basic_worm, frames_to_plot_widths=[],
+                               batch_size=None, workers=None):
         """
         Factory classmethod for creating a normalized worm with a basic_worm
         as input.  This requires calculating all the "pre-features" of
@@ -77,6 +85,12 @@ class NormalizedWorm(WormPartition):
         frames_to_plot_widths: list of ints
             Optional list of frames to plot, to show exactly how the
             widths and skeleton were calculated.
+        batch_size: int (optional)
+            Passed to WormParsing.compute_skeleton_and_widths. If specified,
+            the skeleton is computed for many frames at a time.
+        workers: int (optional)
+            Passed to WormParsing.compute_skeleton_and_widths. If greater
+            than 1, the skeleton is computed using this many processes.
 
         Returns
         -----------
@@ -94,7 +108,9 @@ class NormalizedWorm(WormPartition):
             nw.widths, h_skeleton = \
                 WormParsing.compute_skeleton_and_widths(bw.h_ventral_contour,
                                                         bw.h_dorsal_contour,
-                                                        frames_to_plot_widths)
+                                                        frames_to_plot_widths,
+                                                        batch_size=batch_size,
+                                                        workers=workers)
             # 3. Normalize the skeleton, widths and contour to 49 points
             #    per frame
             nw.skeleton = WormParserHelpers.\
@@ -366,6 +382,191 @@ class NormalizedWorm(WormPartition):
             
             return nw
 
+    # The arrays kept in an array store. Those starting with '_' are
+    # otherwise calculated when they are first asked for.
+    array_store_attributes = ['skeleton', 'ventral_contour',
+                              'dorsal_contour', 'widths',
+                              '_angles', '_length', '_area']
+
+    def save_to_array_store(self, directory):
+        """
+        Save the arrays of this worm to a directory of .npy files, which
+        can be loaded back, memory-mapped, with from_array_store.
+
+        Each array is stored with the frames as the first axis, e.g. the
+        skeleton as shape (n,2,49), so that the data of a frame, or of a
+        range of frames, is in one place in the file.
+
+        Parameters
+        ----------------
+        directory: string
+            Created if it does not exist.  Any previous array store in it
+            is overwritten.
+
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        for a in self.array_store_attributes:
+            data = getattr(self, a, None)
+            file_path = os.path.join(directory, a.lstrip('_') + '.npy')
+            if data is not None:
+                # .T puts the frames first: (49,2,n) -> (n,2,49)
+                np.save(file_path, np.ascontiguousarray(data.T))
+            elif os.path.isfile(file_path):
+                os.remove(file_path)
+
+        video_info = self.video_info
+        frame_code_path = os.path.join(directory, 'frame_code.npy')
+        if getattr(video_info, 'frame_code', None) is not None:
+            np.save(frame_code_path, np.asarray(video_info.frame_code))
+        elif os.path.isfile(frame_code_path):
+            os.remove(frame_code_path)
+        with open(os.path.join(directory, 'video_info.json'), 'w') as f:
+            json.dump(video_info.get_metadata(), f)
+
+    @classmethod
+    def from_array_store(cls, directory, mmap_mode='r'):
+        """
+        Load a NormalizedWorm saved with save_to_array_store.
+
+        The arrays are memory-mapped, so the data of a frame is only read
+        from disk when it is used (and can be dropped from memory again by
+        the operating system), rather than loading all frames at once.
+
+        Parameters
+        ----------------
+        directory: string
+        mmap_mode: {None, 'r', 'r+', 'c'}
+            Passed to numpy.load.  With 'r' (the default) the arrays are
+            read-only; 'c' allows changes, which are not written back.
+            None loads the arrays fully into memory.
+
+        Returns
+        ----------------
+        An instance of NormalizedWorm
+
+        """
+        if not os.path.isfile(os.path.join(directory, 'video_info.json')):
+            raise Exception("Array store not found: " + directory)
+
+        nw = cls()
+        for a in cls.array_store_attributes:
+            file_path = os.path.join(directory, a.lstrip('_') + '.npy')
+            if os.path.isfile(file_path):
+                # .T is a view, back to the frames last: (n,2,49) -> (49,2,n)
+                setattr(nw, a, np.load(file_path, mmap_mode=mmap_mode).T)
+            elif not a.startswith('_'):
+                setattr(nw, a, None)
+
+        with open(os.path.join(directory, 'video_info.json'), 'r') as f:
+            metadata = json.load(f)
+        frame_code_path = os.path.join(directory, 'frame_code.npy')
+        if os.path.isfile(frame_code_path):
+            frame_code = np.load(frame_code_path)
+        else:
+            frame_code = None
+        nw.video_info = VideoInfo.from_metadata(metadata, frame_code)
+
+        return nw
+
+    # Identifies files written by save_to_HDF5, and the version of their
+    # layout, which is increased whenever the layout changes
+    HDF5_FORMAT = 'open_worm_analysis_toolbox NormalizedWorm'
+    HDF5_FORMAT_VERSION = 1
+
+    def save_to_HDF5(self, file_path, compression=None,
+                     compression_opts=None):
+        """
+        Save this worm to an HDF5 file, to be loaded with
+        from_HDF5_file_factory.
+
+        Each array (see array_store_attributes) is one dataset, in the same
+        shape as in this worm, e.g. the skeleton as (49,2,n).  The
+        VideoInfo metadata is stored as JSON in the 'video_info' attribute
+        of the file, and frame_code as a dataset.
+
+        Parameters
+        ----------------
+        file_path: string
+        compression: {None, 'gzip', 'lzf'}
+            Passed to h5py.  Uncompressed datasets are stored contiguously;
+            compressed datasets are chunked by frames, and use the shuffle
+            filter, which helps compress floating point data.
+        compression_opts:
+            Passed to h5py, e.g. the gzip level 0-9
+
+        """
+        with h5py.File(file_path, 'w') as h:
+            h.attrs['format'] = self.HDF5_FORMAT
+            h.attrs['format_version'] = self.HDF5_FORMAT_VERSION
+            h.attrs['video_info'] = json.dumps(
+                self.video_info.get_metadata())
+
+            frame_code = getattr(self.video_info, 'frame_code', None)
+            if frame_code is not None:
+                h.create_dataset('frame_code', data=np.asarray(frame_code))
+
+            for a in self.array_store_attributes:
+                data = getattr(self, a, None)
+                if data is None:
+                    continue
+                data = np.asarray(data)
+                if compression is not None:
+                    chunks = data.shape[:-1] + \
+                        (max(1, min(data.shape[-1], 4096)),)
+                else:
+                    chunks = None
+                h.create_dataset(a.lstrip('_'), data=data, chunks=chunks,
+                                 compression=compression,
+                                 compression_opts=compression_opts,
+                                 shuffle=compression is not None)
+
+    @classmethod
+    def from_HDF5_file_factory(cls, file_path):
+        """
+        Load a NormalizedWorm saved with save_to_HDF5.
+
+        Parameters
+        ----------------
+        file_path: string
+
+        Returns
+        ----------------
+        An instance of NormalizedWorm
+
+        """
+        if not os.path.isfile(file_path):
+            raise Exception("Data file not found: " + file_path)
+
+        with h5py.File(file_path, 'r') as h:
+            if h.attrs.get('format') != cls.HDF5_FORMAT:
+                raise Exception("Not a NormalizedWorm HDF5 file: " +
+                                file_path)
+            format_version = h.attrs['format_version']
+            if format_version > cls.HDF5_FORMAT_VERSION:
+                raise Exception("NormalizedWorm HDF5 file version %d is "
+                                "newer than the supported version %d: %s" %
+                                (format_version, cls.HDF5_FORMAT_VERSION,
+                                 file_path))
+
+            nw = cls()
+            for a in cls.array_store_attributes:
+                name = a.lstrip('_')
+                if name in h:
+                    setattr(nw, a, h[name][()])
+                elif not a.startswith('_'):
+                    setattr(nw, a, None)
+
+            if 'frame_code' in h:
+                frame_code = h['frame_code'][()]
+            else:
+                frame_code = None
+            nw.video_info = VideoInfo.from_metadata(
+                json.loads(h.attrs['video_info']), frame_code)
+
+        return nw
+
     def get_BasicWorm(self):
         """
         Return an instance of NormalizedSkeletonAndContour containing this
@@ -40,11 +40,18 @@ innervation, and cuticular rigidity (Cronin et al. 2005)."
 
 """
 import warnings
+import multiprocessing
+import multiprocessing.sharedctypes
 import numpy as np
 
 from .. import config, utils
 from .skeleton_calculator1 import SkeletonCalculatorType1
 from .pre_features_helpers import WormParserHelpers
+from .ragged_frames import RaggedFrames
+
+# Contour data shared with the skeletonization worker processes, see
+# WormParsing._h_compute_skeleton_and_widths_parallel
+_h_worker_contours = {}
 
 #%%
 
@@ -62,7 +69,9 @@ class WormParsing(object):
     @staticmethod
     def compute_skeleton_and_widths(h_ventral_contour,
                                     h_dorsal_contour,
-                                    frames_to_plot=[]):
+                                    frames_to_plot=[],
+                                    batch_size=None,
+                                    workers=None):
         """
         Compute widths and a heterocardinal skeleton from a heterocardinal
         contour.
@@ -75,6 +84,13 @@ class WormParsing(object):
         frames_to_plot: list of ints
             Optional list of frames to plot, to show exactly how the
             widths and skeleton were calculated.
+        batch_size: int (optional)
+            If specified, process up to this many frames at a time using
+            array operations. See
+            SkeletonCalculatorType1.compute_skeleton_and_widths
+        workers: int (optional)
+            If greater than 1, the frames are split into chunks which are
+            processed by a pool of this many worker processes.
 
         Returns
         -------------------------
@@ -89,11 +105,109 @@ class WormParsing(object):
         alternative algorithms so this may become the place we swap them in.
 
         """
+        if workers is not None and workers > 1:
+            return WormParsing._h_compute_skeleton_and_widths_parallel(
+                h_ventral_contour, h_dorsal_contour, batch_size, workers)
+
         (h_widths, h_skeleton) = \
             SkeletonCalculatorType1.compute_skeleton_and_widths(
             h_ventral_contour,
             h_dorsal_contour,
-            frames_to_plot=[])
+            frames_to_plot=[],
+            batch_size=batch_size)
+
+        return (h_widths, h_skeleton)
+
+    @staticmethod
+    def _h_compute_skeleton_and_widths_parallel(h_ventral_contour,
+                                                h_dorsal_contour,
+                                                batch_size, workers,
+                                                chunks_per_worker=4):
+        """
+        Compute the skeleton and widths using a pool of worker processes.
+
+        The contours are copied once into a single shared memory buffer, in
+        the layout of RaggedFrames, which the workers read (and smooth in
+        place) rather than receiving pickled copies of the contours. Each
+        worker is given chunks of frame indices and returns the widths and
+        skeleton of those frames, which are put back in frame order.
+
+        The smoothed contours are copied back into the input arrays, since
+        the single process code smooths them in place.
+
+        Parameters
+        -------------------------
+        h_ventral_contour: list of numpy arrays of shape (2,ki), or
+            RaggedFrames
+        h_dorsal_contour: list of numpy arrays of shape (2,ji), or
+            RaggedFrames
+        batch_size: int or None
+            See compute_skeleton_and_widths
+        workers: int
+            The number of worker processes
+        chunks_per_worker: int
+            The frames are split into about this many chunks per worker,
+            so that workers which finish early can pick up more work.
+
+        Returns
+        -------------------------
+        (h_widths, h_skeleton): tuple
+            See compute_skeleton_and_widths
+
+        """
+        h_contours = [h_contour if isinstance(h_contour, RaggedFrames) else
+                      RaggedFrames.from_list(h_contour)
+                      for h_contour in (h_ventral_contour, h_dorsal_contour)]
+
+        num_frames = len(h_ventral_contour)
+        h_widths = [None] * num_frames
+        h_skeleton = [None] * num_frames
+
+        valid_frames = np.flatnonzero(h_contours[0].is_valid)
+        if len(valid_frames) == 0:
+            return (h_widths, h_skeleton)
+
+        # The ventral then the dorsal contour data
+        n_values = [h_contour.data.size for h_contour in h_contours]
+        shared_buffer = multiprocessing.sharedctypes.RawArray(
+            'd', int(sum(n_values)))
+        contour_data = np.frombuffer(shared_buffer, dtype=np.float64)
+        contour_data[:n_values[0]] = h_contours[0].data.ravel()
+        contour_data[n_values[0]:] = h_contours[1].data.ravel()
+
+        chunk_size = int(np.ceil(len(valid_frames) /
+                                 float(workers * chunks_per_worker)))
+        chunks = [valid_frames[start:start + chunk_size]
+                  for start in range(0, len(valid_frames), chunk_size)]
+
+        pool = multiprocessing.Pool(
+            workers,
+            initializer=_h_init_skeleton_worker,
+            initargs=(shared_buffer,
+                      [(h_contour.offsets, h_contour.is_valid)
+                       for h_contour in h_contours],
+                      batch_size))
+        try:
+            chunk_results = pool.map(_h_compute_skeleton_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+        for chunk, (chunk_widths, chunk_skeleton) in zip(chunks,
+                                                         chunk_results):
+            for frame_index, widths, skeleton in zip(chunk, chunk_widths,
+                                                     chunk_skeleton):
+                h_widths[frame_index] = widths
+                h_skeleton[frame_index] = skeleton
+
+        # Copy back the smoothed contours
+        h_contours[0].data[:] = contour_data[:n_values[0]].reshape(2, -1)
+        h_contours[1].data[:] = contour_data[n_values[0]:].reshape(2, -1)
+        for h_contour, h_ragged in zip((h_ventral_contour, h_dorsal_contour),
+                                       h_contours):
+            if h_contour is not h_ragged:
+                for frame_index in valid_frames:
+                    h_contour[frame_index][:] = h_ragged[frame_index]
 
         return (h_widths, h_skeleton)
     #%%
@@ -127,7 +241,8 @@ class WormParsing(object):
         Parameters
         ----------------
         h_skeleton: list of length n, of lists of skeleton coordinate points.
-            The heterocardinal skeleton
+            The heterocardinal skeleton, or a numpy array of shape (k,2,n)
+            such as the normalized skeleton
 
         Returns
         ----------------
@@ -163,68 +278,147 @@ class WormParsing(object):
 
         """
         #%%
-        temp_angle_list = []  # TODO: pre-allocate the space we need
-        
-        #i am changing the skeleton to a list, this function can deal with 3D numpy arrays (like in the case of normalized worm)
-        if not isinstance(h_skeleton, list):
-            h_skeleton = WormParsing._h_array2list(h_skeleton)
-            
-        for frame_index, cur_skeleton in enumerate(h_skeleton):
-            if cur_skeleton is None:
-                temp_angle_list.append([])
-            else:
-                assert cur_skeleton.shape[0] == 2
-                
-                sx = cur_skeleton[0, :]
-                sy = cur_skeleton[1, :]
-                cur_skeleton2 = np.rollaxis(cur_skeleton, 1)
-                cc = WormParserHelpers.chain_code_lengths_cum_sum(
-                    cur_skeleton2)
-
-                # This is from the old code
-                edge_length = cc[-1] / 12
-
-                # We want all vertices to be defined, and if we look starting
-                # at the left_I for a vertex, rather than vertex for left and
-                # right then we could miss all middle points on worms being
-                # vertices
-
-                left_lengths = cc - edge_length
-                right_lengths = cc + edge_length
-
-                valid_vertices_I = utils.find((left_lengths > cc[0]) &
-                                              (right_lengths < cc[-1]))
-
-                left_lengths = left_lengths[valid_vertices_I]
-                right_lengths = right_lengths[valid_vertices_I]
-
-                left_x = np.interp(left_lengths, cc, sx)
-                left_y = np.interp(left_lengths, cc, sy)
-
-                right_x = np.interp(right_lengths, cc, sx)
-                right_y = np.interp(right_lengths, cc, sy)
-
-                d2_y = sy[valid_vertices_I] - right_y
-                d2_x = sx[valid_vertices_I] - right_x
-                d1_y = left_y - sy[valid_vertices_I]
-                d1_x = left_x - sx[valid_vertices_I]
-
-                frame_angles = np.arctan2(d2_y, d2_x) - np.arctan2(d1_y, d1_x)
-
-                frame_angles[frame_angles > np.pi] -= 2 * np.pi
-                frame_angles[frame_angles < -np.pi] += 2 * np.pi
-
-                # Convert to degrees
-                frame_angles *= 180 / np.pi
-
-                all_frame_angles = np.full_like(cc, np.NaN)
-                all_frame_angles[valid_vertices_I] = frame_angles
-
-                temp_angle_list.append(all_frame_angles)
-                
-                
-        return  WormParserHelpers.normalize_all_frames(
-            temp_angle_list, h_skeleton, config.N_POINTS_NORMALIZED)
+        # Frames that all have the same number of points (e.g. the
+        # normalized skeleton) are done together, any others one at a time
+        dense_skeleton, dense_I, h_skeleton, loop_I = \
+            WormParserHelpers.split_frames(h_skeleton)
+
+        angles = np.full([config.N_POINTS_NORMALIZED, len(h_skeleton)],
+                         np.NaN)
+
+        if dense_skeleton is not None:
+            angles[:, dense_I] = \
+                WormParsing._h_compute_angles_all_frames(dense_skeleton)
+
+        if len(loop_I) > 0:
+            loop_skeleton = [None] * len(h_skeleton)
+            temp_angle_list = [[]] * len(h_skeleton)
+            for frame_index in loop_I:
+                cur_skeleton = h_skeleton[frame_index]
+                loop_skeleton[frame_index] = cur_skeleton
+                temp_angle_list[frame_index] = \
+                    WormParsing._h_compute_frame_angles(cur_skeleton)
+
+            angles[:, loop_I] = WormParserHelpers.normalize_all_frames(
+                temp_angle_list, loop_skeleton,
+                config.N_POINTS_NORMALIZED)[:, loop_I]
+
+        return angles
+
+    @staticmethod
+    def _h_compute_frame_angles(cur_skeleton):
+        """
+        The angles of one frame of the skeleton, before normalization.
+        See compute_angles.
+
+        Parameters
+        ----------------
+        cur_skeleton: numpy array of shape (2,k)
+
+        Returns
+        ----------------
+        numpy array of shape (k,)
+
+        """
+        assert cur_skeleton.shape[0] == 2
+
+        sx = cur_skeleton[0, :]
+        sy = cur_skeleton[1, :]
+        cur_skeleton2 = np.rollaxis(cur_skeleton, 1)
+        cc = WormParserHelpers.chain_code_lengths_cum_sum(
+            cur_skeleton2)
+
+        # This is from the old code
+        edge_length = cc[-1] / 12
+
+        # We want all vertices to be defined, and if we look starting
+        # at the left_I for a vertex, rather than vertex for left and
+        # right then we could miss all middle points on worms being
+        # vertices
+
+        left_lengths = cc - edge_length
+        right_lengths = cc + edge_length
+
+        valid_vertices_I = utils.find((left_lengths > cc[0]) &
+                                      (right_lengths < cc[-1]))
+
+        left_lengths = left_lengths[valid_vertices_I]
+        right_lengths = right_lengths[valid_vertices_I]
+
+        left_x = np.interp(left_lengths, cc, sx)
+        left_y = np.interp(left_lengths, cc, sy)
+
+        right_x = np.interp(right_lengths, cc, sx)
+        right_y = np.interp(right_lengths, cc, sy)
+
+        d2_y = sy[valid_vertices_I] - right_y
+        d2_x = sx[valid_vertices_I] - right_x
+        d1_y = left_y - sy[valid_vertices_I]
+        d1_x = left_x - sx[valid_vertices_I]
+
+        frame_angles = np.arctan2(d2_y, d2_x) - np.arctan2(d1_y, d1_x)
+
+        frame_angles[frame_angles > np.pi] -= 2 * np.pi
+        frame_angles[frame_angles < -np.pi] += 2 * np.pi
+
+        # Convert to degrees
+        frame_angles *= 180 / np.pi
+
+        all_frame_angles = np.full_like(cc, np.NaN)
+        all_frame_angles[valid_vertices_I] = frame_angles
+
+        return all_frame_angles
+
+    @staticmethod
+    def _h_compute_angles_all_frames(skeleton):
+        """
+        The normalized angles of many frames with the same number of
+        points, and no NaN values, computed together. The result is the
+        same as computing each frame with _h_compute_frame_angles and then
+        normalizing it.
+
+        Parameters
+        ----------------
+        skeleton: numpy array of shape (k,2,n)
+
+        Returns
+        ----------------
+        numpy array of shape (49,n)
+
+        """
+        cc = WormParserHelpers.chain_code_lengths_cum_sum_all_frames(skeleton)
+
+        # This is from the old code
+        edge_length = cc[-1] / 12
+
+        left_lengths = cc - edge_length
+        right_lengths = cc + edge_length
+
+        is_vertex = (left_lengths > cc[0]) & (right_lengths < cc[-1])
+
+        # Shape (k,2,n). These are also computed for the points that are
+        # not vertices, which are then ignored.
+        left_xy = WormParserHelpers.interp_all_frames(left_lengths, cc,
+                                                      skeleton)
+        right_xy = WormParserHelpers.interp_all_frames(right_lengths, cc,
+                                                       skeleton)
+
+        d2 = skeleton - right_xy
+        d1 = left_xy - skeleton
+
+        angles = np.arctan2(d2[:, 1, :], d2[:, 0, :]) - \
+            np.arctan2(d1[:, 1, :], d1[:, 0, :])
+        angles[~is_vertex] = np.NaN
+
+        with np.errstate(invalid='ignore'):
+            angles[angles > np.pi] -= 2 * np.pi
+            angles[angles < -np.pi] += 2 * np.pi
+
+        # Convert to degrees
+        angles *= 180 / np.pi
+
+        return WormParserHelpers.normalize_parameter_all_frames(
+            angles, cc, config.N_POINTS_NORMALIZED)
         #%%
     #%%
     @staticmethod
@@ -308,3 +502,53 @@ class WormParsing(object):
         # For each frame, sum the chain code lengths to get the total length
         return np.sum(WormParserHelpers.chain_code_lengths(skeleton),
                       axis=0)
+
+
+#%%
+def _h_init_skeleton_worker(shared_buffer, frame_index_data, batch_size):
+    """
+    Pool initializer for WormParsing._h_compute_skeleton_and_widths_parallel
+
+    Parameters
+    -------------------------
+    shared_buffer: RawArray
+        The ventral then the dorsal contour RaggedFrames data
+    frame_index_data: list of two (offsets, is_valid) tuples
+        For the ventral and the dorsal contour RaggedFrames
+    batch_size: int or None
+
+    """
+    data = np.frombuffer(shared_buffer, dtype=np.float64)
+    n_ventral_values = 2 * frame_index_data[0][0][-1]
+
+    _h_worker_contours['h_contours'] = [
+        RaggedFrames(side_data.reshape(2, -1), offsets, is_valid)
+        for side_data, (offsets, is_valid) in
+        zip((data[:n_ventral_values], data[n_ventral_values:]),
+            frame_index_data)]
+    _h_worker_contours['batch_size'] = batch_size
+
+
+def _h_compute_skeleton_chunk(chunk):
+    """
+    Compute the widths and skeleton for a chunk of frames, whose contours
+    are read from the shared buffer set up by _h_init_skeleton_worker.
+
+    Parameters
+    -------------------------
+    chunk: numpy array
+        Indices of (valid) frames
+
+    Returns
+    -------------------------
+    (h_widths, h_skeleton): tuple
+        For the frames in the chunk, in order.
+
+    """
+    h_ventral_contour, h_dorsal_contour = _h_worker_contours['h_contours']
+
+    # These are views into the shared buffer, so smoothing is done in place
+    return SkeletonCalculatorType1.compute_skeleton_and_widths(
+        [h_ventral_contour[frame_index] for frame_index in chunk],
+        [h_dorsal_contour[frame_index] for frame_index in chunk],
+        batch_size=_h_worker_contours['batch_size'])
@@ -6,6 +6,8 @@ Created on Fri Jul  3 17:15:41 2015
 """
 import numpy as np
 
+from .ragged_frames import RaggedFrames
+
 
 class WormParserHelpers:
 
@@ -97,11 +99,17 @@ class WormParserHelpers:
         Normalize a "heterocardinal" skeleton or contour into a "homocardinal"
         one, where each frame has the same number of points.
 
+        If every frame has the same number of points, all frames are
+        normalized at once (see normalize_parameter_all_frames), otherwise
+        they are normalized one frame at a time.
+
         Parameters
         --------------
         heterocardinal_property: list of numpy arrays
             the outermost dimension, that of the lists, has length n
             the numpy arrays are of shape (2,ki)
+            A numpy array of shape (k,2,n) is also accepted, with frames
+            that are all NaN being treated as missing.
         num_norm_points: int
             The number of points to normalize to.
 
@@ -110,22 +118,34 @@ class WormParserHelpers:
         numpy array of shape (49,2,n)
 
         """
-        n_frames = len(heterocardinal_property)
+        dense_data, dense_I, frames, loop_I = \
+            WormParserHelpers.split_frames(heterocardinal_property)
+
+        n_frames = len(frames)
         normalized_data = np.full([num_norm_points, 2, n_frames],
                                   np.NaN)
 
-        for iFrame, cur_frame_value in enumerate(heterocardinal_property):
-            if cur_frame_value is not None:
-                # We need cur_frame_value to have shape (k,2), not (2,k)
-                cur_frame_value2 = np.rollaxis(cur_frame_value, 1)
-                cc = WormParserHelpers.chain_code_lengths_cum_sum(
-                    cur_frame_value2)
+        if dense_data is not None:
+            cc = WormParserHelpers.chain_code_lengths_cum_sum_all_frames(
+                dense_data)
+
+            # Normalize both the x and the y
+            normalized_data[:, :, dense_I] = WormParserHelpers.\
+                normalize_parameter_all_frames(dense_data, cc,
+                                               num_norm_points)
+
+        for iFrame in loop_I:
+            cur_frame_value = frames[iFrame]
+            # We need cur_frame_value to have shape (k,2), not (2,k)
+            cur_frame_value2 = np.rollaxis(cur_frame_value, 1)
+            cc = WormParserHelpers.chain_code_lengths_cum_sum(
+                cur_frame_value2)
 
-                # Normalize both the x and the y
-                normalized_data[:, 0, iFrame] = WormParserHelpers.normalize_parameter(
-                    cur_frame_value[0, :], cc, num_norm_points)
-                normalized_data[:, 1, iFrame] = WormParserHelpers.normalize_parameter(
-                    cur_frame_value[1, :], cc, num_norm_points)
+            # Normalize both the x and the y
+            normalized_data[:, 0, iFrame] = WormParserHelpers.normalize_parameter(
+                cur_frame_value[0, :], cc, num_norm_points)
+            normalized_data[:, 1, iFrame] = WormParserHelpers.normalize_parameter(
+                cur_frame_value[1, :], cc, num_norm_points)
 
         return normalized_data
 
@@ -138,13 +158,17 @@ class WormParserHelpers:
         Normalize a (heterocardinal) array of lists of variable length
         down to a numpy array of shape (num_norm_points,n).
 
+        As in normalize_all_frames_xy, if every frame has the same number
+        of points all frames are normalized at once.
+
         Parameters
         --------------
         property_to_normalize: list of length n, of numpy arrays of shape (ki)
             The property that needs to be evenly sampled
         xy_data: list of length n, of numpy arrays of shape (2, ki)
             The skeleton or contour points corresponding to the location
-            along the worm where the property_to_normalize was recorded
+            along the worm where the property_to_normalize was recorded.
+            A numpy array of shape (k,2,n) is also accepted.
         num_norm_points: int
             The number of points to normalize to.
 
@@ -154,31 +178,262 @@ class WormParserHelpers:
             prop_to_normalize, now normalized down to 49 points per frame
 
         """
-        assert(len(property_to_normalize) == len(xy_data))
+        dense_xy, dense_I, xy_frames, loop_I = \
+            WormParserHelpers.split_frames(xy_data)
+
+        assert(len(property_to_normalize) == len(xy_frames))
 
         # Create a blank array of shape (49,n)
         normalized_data_shape = [num_norm_points, len(property_to_normalize)]
         normalized_data = np.full(normalized_data_shape, np.NaN)
 
+        if dense_xy is not None:
+            n_points = dense_xy.shape[0]
+            if all(np.shape(property_to_normalize[i]) == (n_points,)
+                   for i in dense_I):
+                dense_values = np.stack([property_to_normalize[i]
+                                         for i in dense_I], axis=1)
+                running_lengths = WormParserHelpers.\
+                    chain_code_lengths_cum_sum_all_frames(dense_xy)
+                normalized_data[:, dense_I] = WormParserHelpers.\
+                    normalize_parameter_all_frames(dense_values,
+                                                   running_lengths,
+                                                   num_norm_points)
+            else:
+                loop_I = np.sort(np.concatenate((dense_I, loop_I)))
+
         # Normalize one frame at a time
-        for frame_index, (cur_frame_value, cur_xy) in \
-                enumerate(zip(property_to_normalize, xy_data)):
-            if cur_xy is not None:
-                # We need cur_xy to have shape (k,2), not (2,k)
-                cur_xy_reshaped = np.rollaxis(cur_xy, axis=1)
-                running_lengths = WormParserHelpers.chain_code_lengths_cum_sum(
-                    cur_xy_reshaped)
-
-                # Normalize cur_frame_value over an evenly-spaced set of
-                # 49 values spread from running_lengths[0] to
-                #                       running_lengths[-1]
-                normalized_data[:, frame_index] = \
-                    WormParserHelpers.normalize_parameter(cur_frame_value,
-                                                          running_lengths,
-                                                          num_norm_points)
+        for frame_index in loop_I:
+            cur_frame_value = property_to_normalize[frame_index]
+            cur_xy = xy_frames[frame_index]
+            # We need cur_xy to have shape (k,2), not (2,k)
+            cur_xy_reshaped = np.rollaxis(cur_xy, axis=1)
+            running_lengths = WormParserHelpers.chain_code_lengths_cum_sum(
+                cur_xy_reshaped)
+
+            # Normalize cur_frame_value over an evenly-spaced set of
+            # 49 values spread from running_lengths[0] to
+            #                       running_lengths[-1]
+            normalized_data[:, frame_index] = \
+                WormParserHelpers.normalize_parameter(cur_frame_value,
+                                                      running_lengths,
+                                                      num_norm_points)
 
         return normalized_data
 
+    #%%
+    @staticmethod
+    def split_frames(heterocardinal_property):
+        """
+        Split the frames of a skeleton or contour into those that can be
+        normalized all at once and those that need to be normalized one
+        frame at a time.
+
+        Frames can be normalized at once if all frames have the same number
+        of points, and the frame has no NaN values.
+
+        Parameters
+        --------------
+        heterocardinal_property: list of length n of numpy arrays of
+            shape (2,ki), or None for missing frames, or RaggedFrames, or
+            a numpy array of shape (k,2,n), where frames that are all NaN
+            are missing.
+
+        Returns
+        --------------
+        (dense_data, dense_I, frames, loop_I)
+            dense_data: numpy array of shape (k,2,m), or None
+                The frames that can be normalized at once
+            dense_I: numpy array of shape (m,)
+                The frame indices of dense_data
+            frames: list of length n of numpy arrays of shape (2,ki) or
+                None, or RaggedFrames
+            loop_I: numpy array
+                Indices of the frames to normalize one at a time
+
+        """
+        if isinstance(heterocardinal_property, np.ndarray):
+            data = heterocardinal_property
+            assert data.ndim == 3 and data.shape[1] == 2
+            is_missing = np.all(np.isnan(data), axis=(0, 1))
+            frames = [None if is_missing[i] else data[:, :, i].T
+                      for i in range(data.shape[2])]
+            dense_I = np.flatnonzero(~is_missing)
+            if data.shape[0] < 2:
+                return (None, None, frames, dense_I)
+            dense_data = data[:, :, dense_I]
+        elif isinstance(heterocardinal_property, RaggedFrames):
+            # The frames are already in one array
+            frames = heterocardinal_property
+            dense_data, dense_I = frames.dense_frames()
+            if dense_data is None or dense_data.shape[0] < 2:
+                return (None, None, frames, dense_I)
+        else:
+            frames = heterocardinal_property
+            dense_I = np.array([i for i, x in enumerate(frames)
+                                if x is not None], dtype=int)
+            shapes = set(frames[i].shape for i in dense_I)
+            if len(shapes) != 1 or shapes.pop()[1] < 2:
+                return (None, None, frames, dense_I)
+            dense_data = np.stack([frames[i] for i in dense_I], axis=2)
+            dense_data = np.rollaxis(dense_data, 1)
+
+        # Frames with some NaN values are left to np.interp
+        has_nan = np.any(np.isnan(dense_data), axis=(0, 1))
+        if np.any(has_nan):
+            loop_I = dense_I[has_nan]
+            dense_I = dense_I[~has_nan]
+            dense_data = dense_data[:, :, ~has_nan]
+        else:
+            loop_I = np.array([], dtype=int)
+
+        if len(dense_I) == 0:
+            dense_data = None
+
+        return (dense_data, dense_I, frames, loop_I)
+
+    #%%
+    @staticmethod
+    def chain_code_lengths_cum_sum_all_frames(skeleton):
+        """
+        chain_code_lengths_cum_sum for all frames at once.
+
+        Parameters
+        ----------------
+        skeleton: numpy array of shape (k,2,n)
+
+        Returns
+        ----------------
+        numpy array of shape (k,n)
+
+        """
+        distances = WormParserHelpers.chain_code_lengths(skeleton)
+        distances = np.concatenate([np.zeros((1, skeleton.shape[2])),
+                                    distances])
+
+        return np.cumsum(distances, axis=0)
+
+    #%%
+    @staticmethod
+    def normalize_parameter_all_frames(prop_to_normalize, running_lengths,
+                                       num_norm_points):
+        """
+        normalize_parameter for many frames with the same number of points.
+        See interp_all_frames.
+
+        Parameters
+        -----------
+        prop_to_normalize: numpy array of shape (k,n) or (k,2,n)
+            The parameter to be interpolated, for each of n frames
+        running_lengths: numpy array of shape (k,n)
+            The positions along the worm where the property was
+            calculated, increasing along the first dimension
+        num_norm_points: int
+            The number of points to normalize to.
+
+        Returns
+        -----------
+        Numpy array of shape (num_norm_points,n) or (num_norm_points,2,n)
+        depending on the provided shape of prop_to_normalize
+
+        """
+        # Evenly spaced points between the first and last point, computed
+        # as np.linspace does for a single frame
+        first_lengths = running_lengths[0]
+        last_lengths = running_lengths[-1]
+        step = (last_lengths - first_lengths) / max(num_norm_points - 1, 1)
+        new_lengths = np.arange(num_norm_points)[:, None] * step + \
+            first_lengths
+        if num_norm_points > 1:
+            new_lengths[-1] = last_lengths
+
+        return WormParserHelpers.interp_all_frames(new_lengths,
+                                                   running_lengths,
+                                                   prop_to_normalize)
+
+    #%%
+    @staticmethod
+    def interp_all_frames(new_lengths, running_lengths, values):
+        """
+        np.interp for many frames with the same number of points, i.e.
+        np.interp(new_lengths[:, i], running_lengths[:, i], values[:, i])
+        for each frame i.
+
+        The position of each new length among the old lengths is found
+        for all frames at once rather than with a search for each frame.
+
+        Parameters
+        -----------
+        new_lengths: numpy array of shape (p,n)
+            The positions to interpolate at, which must be sorted along
+            the first dimension
+        running_lengths: numpy array of shape (k,n)
+            The positions of values, increasing along the first dimension
+        values: numpy array of shape (k,n) or (k,2,n)
+
+        Returns
+        -----------
+        Numpy array of shape (p,n) or (p,2,n) depending on the provided
+        shape of values
+
+        """
+        n_points, n_frames = running_lengths.shape
+        n_new_points = new_lengths.shape[0]
+        frame_I = np.arange(n_frames)
+
+        # For each new length, the number of old lengths that are less than
+        # or equal to it, i.e. np.searchsorted(side='right') for each frame.
+        # The new lengths are sorted, so this is the position of the new
+        # length when merged with the old ones, less the number of new
+        # lengths before it. The stable sort keeps old lengths first on ties.
+        merged = np.concatenate((running_lengths, new_lengths))
+        order = np.argsort(merged, axis=0, kind='mergesort')
+        merged_I = np.empty_like(order)
+        merged_I[order, frame_I] = np.arange(merged.shape[0])[:, None]
+        left_I = merged_I[n_points:] - np.arange(n_new_points)[:, None] - 1
+
+        # Linear interpolation between the old points on either side.
+        # Indexing into the flattened arrays is much faster than fancy
+        # indexing with a separate frame index.
+        left_I_used = np.clip(left_I, 0, n_points - 2)
+        flat_I = left_I_used * n_frames + frame_I
+        lengths = running_lengths.ravel()
+        left_lengths = lengths.take(flat_I)
+        right_lengths = lengths.take(flat_I + n_frames)
+        is_at_point = new_lengths == left_lengths
+        is_before = left_I < 0
+        is_after = left_I >= n_points - 1
+
+        flat_values = values.ravel()
+        if values.ndim == 3:
+            # Same positions for x and y, giving shape (p,2,n)
+            new_lengths = new_lengths[:, None, :]
+            left_lengths = left_lengths[:, None, :]
+            right_lengths = right_lengths[:, None, :]
+            flat_I = (2 * left_I_used * n_frames + frame_I)[:, None, :] + \
+                np.array([0, n_frames])[:, None]
+            point_stride = 2 * n_frames
+            is_at_point = is_at_point[:, None, :]
+            is_before = is_before[:, None, :]
+            is_after = is_after[:, None, :]
+        else:
+            point_stride = n_frames
+
+        left_values = flat_values.take(flat_I)
+        right_values = flat_values.take(flat_I + point_stride)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            slope = (right_values - left_values) / \
+                (right_lengths - left_lengths)
+            interp_values = slope * (new_lengths - left_lengths) + \
+                left_values
+
+        interp_values = np.where(is_at_point, left_values, interp_values)
+        interp_values = np.where(is_before, values[:1], interp_values)
+        interp_values = np.where(is_after, values[-1:], interp_values)
+
+        return interp_values
+
     #%%
     @staticmethod
     def normalize_parameter(prop_to_normalize, running_lengths,
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+RaggedFrames: compact storage for "heterocardinal" skeletons and contours
+
+A heterocardinal property has a varying number of points per frame, and
+so cannot be stored as a simple (k,2,n) numpy array. Storing it as a list
+with one small numpy array per frame costs a Python object per frame,
+which adds up for long videos, scatters the data in memory, and makes
+pickling (e.g. to worker processes) slow.
+
+Instead RaggedFrames holds all frames in a single buffer of shape
+(2, total_points), with the points of frame i in the columns
+offsets[i] to offsets[i+1], and a mask of which frames are valid.
+
+It can be used in place of a list of frames: indexing a frame gives a
+numpy array of shape (2,ki) which is a view into the buffer (so changes
+made to it are kept), or None if the frame is missing.
+
+"""
+import numpy as np
+
+
+class RaggedFrames(object):
+    """
+    A list-like container of frames of shape (2,ki), or None, stored in
+    one buffer.
+
+    Attributes
+    ----------
+    data: numpy array of shape (2, total_points)
+        The x and y values of all frames, one frame after another
+    offsets: numpy array of shape (n+1,)
+        Frame i is data[:, offsets[i]:offsets[i+1]]
+    is_valid: numpy array of shape (n,) of bool
+        False for missing frames, which have no points
+
+    """
+
+    def __init__(self, data, offsets, is_valid):
+        self.data = data
+        self.offsets = offsets
+        self.is_valid = is_valid
+
+    @classmethod
+    def from_list(cls, frames):
+        """
+        Parameters
+        ----------
+        frames: list of numpy arrays of shape (2,ki), or None
+            Missing frames should be identified by None.
+
+        """
+        is_valid = np.array([frame is not None for frame in frames],
+                            dtype=bool)
+        n_points = np.array([0 if frame is None else np.shape(frame)[1]
+                             for frame in frames], dtype=int)
+        offsets = np.concatenate(([0], np.cumsum(n_points)))
+
+        valid_frames = [frame for frame in frames if frame is not None]
+        if len(valid_frames) > 0:
+            data = np.concatenate(valid_frames, axis=1).astype(float)
+        else:
+            data = np.empty((2, 0))
+
+        return cls(data, offsets, is_valid)
+
+    @classmethod
+    def from_array(cls, frames):
+        """
+        Parameters
+        ----------
+        frames: numpy array of shape (k,2,n)
+            Frames that are all NaN are treated as missing.
+
+        """
+        assert frames.ndim == 3 and frames.shape[1] == 2
+        n_points = frames.shape[0]
+        is_valid = ~np.all(np.isnan(frames), axis=(0, 1))
+        offsets = np.concatenate(
+            ([0], np.cumsum(np.where(is_valid, n_points, 0))))
+
+        # (k,2,n) -> (2,n,k) -> (2, n_valid * k)
+        data = np.transpose(frames[:, :, is_valid], (1, 2, 0)).reshape(2, -1)
+
+        return cls(np.ascontiguousarray(data, dtype=float), offsets,
+                   is_valid)
+
+    @property
+    def n_points(self):
+        """
+        numpy array of shape (n,), the number of points in each frame
+        """
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.is_valid)
+
+    def __getitem__(self, frame_index):
+        if isinstance(frame_index, slice):
+            return [self[i] for i in range(*frame_index.indices(len(self)))]
+
+        if not self.is_valid[frame_index]:
+            return None
+
+        if frame_index < 0:
+            frame_index += len(self)
+        return self.data[:, self.offsets[frame_index]:
+                         self.offsets[frame_index + 1]]
+
+    def __iter__(self):
+        for frame_index in range(len(self)):
+            yield self[frame_index]
+
+    def to_list(self):
+        """
+        The frames as a list of numpy arrays (views into self.data),
+        with None for missing frames.
+        """
+        return list(self)
+
+    def dense_frames(self):
+        """
+        If all valid frames have the same number of points, return them
+        as one array.
+
+        Returns
+        ----------
+        (dense_data, frame_I)
+            dense_data: numpy array of shape (k,2,m), or None if the frames
+                have different numbers of points
+            frame_I: numpy array of shape (m,), the indices of the
+                valid frames
+
+        """
+        frame_I = np.flatnonzero(self.is_valid)
+        n_points = np.unique(self.n_points[frame_I])
+        if len(n_points) != 1:
+            return (None, frame_I)
+
+        # (2, m * k) -> (2,m,k) -> (k,2,m)
+        dense_data = self.data.reshape(2, len(frame_I), n_points[0])
+        return (np.transpose(dense_data, (2, 0, 1)), frame_I)
+
+    def __repr__(self):
+        return "RaggedFrames(%d frames, %d valid, %d points)" % \
+            (len(self), np.sum(self.is_valid), self.data.shape[1])
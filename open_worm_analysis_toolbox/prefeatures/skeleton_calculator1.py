@@ -4,6 +4,7 @@
 
 
 """
+import math
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -26,11 +27,22 @@ class SkeletonCalculatorType1(object):
     methods are just subfunctions of this main method.
 
     """
+    FRACTION_WORM_SMOOTH = 1.0 / 12.0
+    SMOOTHING_ORDER = 3
+    PERCENT_BACK_SEARCH = 0.3
+    PERCENT_FORWARD_SEARCH = 0.3
+    END_S1_WALK_PCT = 0.15
+
+    # h__getPartnersViaWalk stores its pairs in fixed size buffers
+    MAX_WALK_PAIRS = 200
+
     #%%
     @staticmethod
     def compute_skeleton_and_widths(h_ventral_contour,
                                     h_dorsal_contour,
-                                    frames_to_plot=[]):
+                                    frames_to_plot=[],
+                                    batch_size=None,
+                                    full_distance_matrix=False):
         """
         Compute widths and a heterocardinal skeleton from a heterocardinal
         contour.
@@ -43,6 +55,19 @@ class SkeletonCalculatorType1(object):
         frames_to_plot: list of ints
             Optional list of frames to plot, to show exactly how the
             widths and skeleton were calculated.
+        batch_size: int (optional)
+            If specified, frames are processed together in groups of up to
+            this many frames of similar size, using array operations rather
+            than a loop over the frames. See
+            h__computeSkeletonAndWidthsBatched. Plotting is only supported
+            when this is None (the default).
+        full_distance_matrix: bool (optional)
+            If True, the distance from every point on one side to every
+            point on the other side is computed for each frame, as was
+            originally done. By default only the distances within the search
+            band of each point are computed (see h__getBandedDistances),
+            which gives the same result with much less work for large
+            contours. Ignored when batch_size is specified.
 
 
         Returns
@@ -86,11 +111,15 @@ class SkeletonCalculatorType1(object):
         other sideremains still.
 
         """
-        FRACTION_WORM_SMOOTH = 1.0 / 12.0
-        SMOOTHING_ORDER = 3
-        PERCENT_BACK_SEARCH = 0.3
-        PERCENT_FORWARD_SEARCH = 0.3
-        END_S1_WALK_PCT = 0.15
+        if batch_size is not None and len(frames_to_plot) == 0:
+            return SkeletonCalculatorType1.h__computeSkeletonAndWidthsBatched(
+                h_ventral_contour, h_dorsal_contour, batch_size)
+
+        FRACTION_WORM_SMOOTH = SkeletonCalculatorType1.FRACTION_WORM_SMOOTH
+        SMOOTHING_ORDER = SkeletonCalculatorType1.SMOOTHING_ORDER
+        PERCENT_BACK_SEARCH = SkeletonCalculatorType1.PERCENT_BACK_SEARCH
+        PERCENT_FORWARD_SEARCH = SkeletonCalculatorType1.PERCENT_FORWARD_SEARCH
+        END_S1_WALK_PCT = SkeletonCalculatorType1.END_S1_WALK_PCT
 
         num_frames = len(h_ventral_contour)  # == len(h_dorsal_contour)
 
@@ -100,6 +129,7 @@ class SkeletonCalculatorType1(object):
         profile_times = {'sgolay': 0,
                          'transpose': 0,
                          'h__getBounds': 0,
+                         'distances': 0,
                          'compute_normal_vectors': 0,
                          'h__getMatches': 0,
                          'h__updateEndsByWalking': 0,
@@ -161,49 +191,7 @@ class SkeletonCalculatorType1(object):
                 s2 = np.concatenate([s2, new_last_point], axis=1)
             """
 
-            # UP/DOWNSAMPLE if number of points is not betwen 49 and 250,
-            # which seem like reasonable numbers.
-            if s1.shape[1] < 49 or s1.shape[1] > 250:
-                if s1.shape[1] < 49:
-                    num_norm_points = 75
-                else:
-                    num_norm_points = 200
-                # Upsample if we have too few points
-                s1 = WormParserHelpers.normalize_all_frames_xy(
-                    [s1], num_norm_points=num_norm_points)
-
-                # There is only one frame so let's take that dimension out,
-                # and transform s1 and s2 from having shape (k,2,n) to (k,2)
-                s1 = s1[:, :, 0]
-
-                # normalized_all_frames_xy rolls the axis so let's roll it back
-                s1 = np.rollaxis(s1, 1)
-
-            if s2.shape[1] < 49 or s2.shape[1] > 250:
-                if s1.shape[1] < 49:
-                    num_norm_points = 75
-                else:
-                    num_norm_points = 200
-                # For documentation see the above for s1
-                s2 = WormParserHelpers.normalize_all_frames_xy(
-                    [s2], num_norm_points=num_norm_points)
-                s2 = s2[:, :, 0]
-                s2 = np.rollaxis(s2, 1)
-
-            # Calculation of distances
-            #-----------------------------------
-            # Find the distance from each point in s1 to EVERY point in s2
-            # Thus dx_across[0,5] gives the x-distance from point 0 on s1 to
-            # point 5 on s2. The operation gives us an array of shape
-            # (s1.shape[1],s2.shape[1])
-            dx_across = np.transpose(s1[0, :][None, :]) - s2[0, :]
-            dy_across = np.transpose(s1[1, :][None, :]) - s2[1, :]
-
-            # d_across_partials has shape (ki, ji, 2)
-            d_across_partials = np.dstack([dx_across, dy_across])
-            d_across = np.linalg.norm(d_across_partials, axis=2)
-            dx_across = dx_across / d_across
-            dy_across = dy_across / d_across
+            s1, s2 = SkeletonCalculatorType1.h__resampleSides(s1, s2)
 
             # Determine search bounds for possible "projection pairs"
             #------------------------------------------------
@@ -217,6 +205,33 @@ class SkeletonCalculatorType1(object):
             profile_times['h__getBounds'] += utils.timing_function() - start
             start = utils.timing_function()
 
+            # Calculation of distances
+            #-----------------------------------
+            if full_distance_matrix:
+                # Find the distance from each point in s1 to EVERY point in
+                # s2. Thus dx_across[0,5] gives the x-distance from point 0
+                # on s1 to point 5 on s2. The operation gives us an array of
+                # shape (s1.shape[1],s2.shape[1])
+                dx_across = np.transpose(s1[0, :][None, :]) - s2[0, :]
+                dy_across = np.transpose(s1[1, :][None, :]) - s2[1, :]
+
+                # d_across_partials has shape (ki, ji, 2)
+                d_across_partials = np.dstack([dx_across, dy_across])
+                d_across = np.linalg.norm(d_across_partials, axis=2)
+                dx_across = dx_across / d_across
+                dy_across = dy_across / d_across
+                d_walk = d_across
+            else:
+                # Only the search band of each point is needed for the
+                # matching, the walks compute their distances as they go
+                dx_across, dy_across, d_across = \
+                    SkeletonCalculatorType1.h__getBandedDistances(
+                        s1, s2, left_indices, right_indices)
+                d_walk = None
+
+            profile_times['distances'] += utils.timing_function() - start
+            start = utils.timing_function()
+
             # For each point on side 1, calculate normalized orthogonal values
             norm_x, norm_y = utils.compute_normal_vectors(s1)
 
@@ -231,14 +246,15 @@ class SkeletonCalculatorType1(object):
                                                              dy_across,
                                                              d_across,
                                                              left_indices,
-                                                             right_indices)
+                                                             right_indices,
+                                                             d_walk is None)
 
             profile_times['h__getMatches'] += utils.timing_function() - start
             start = utils.timing_function()
 
             # Pair off the points from one contour to the other
             I_1, I_2 = SkeletonCalculatorType1.h__updateEndsByWalking(
-                d_across,
+                d_walk,
                 match_I1,
                 s1, s2,
                 END_S1_WALK_PCT)
@@ -335,6 +351,52 @@ class SkeletonCalculatorType1(object):
         # print(profile_times)
         return (h_widths, h_skeleton)
 
+    #%%
+    @staticmethod
+    def h__resampleSides(s1, s2):
+        """
+        Up or downsample each side of the contour if its number of points
+        is not betwen 49 and 250, which seem like reasonable numbers.
+
+        Parameters
+        ---------------
+        s1: numpy array of shape (2,ki)
+        s2: numpy array of shape (2,ji)
+
+        Returns
+        ---------------
+        (s1, s2): tuple of numpy arrays of shape (2,ki') and (2,ji')
+
+        """
+        if s1.shape[1] < 49 or s1.shape[1] > 250:
+            if s1.shape[1] < 49:
+                num_norm_points = 75
+            else:
+                num_norm_points = 200
+            # Upsample if we have too few points
+            s1 = WormParserHelpers.normalize_all_frames_xy(
+                [s1], num_norm_points=num_norm_points)
+
+            # There is only one frame so let's take that dimension out,
+            # and transform s1 and s2 from having shape (k,2,n) to (k,2)
+            s1 = s1[:, :, 0]
+
+            # normalized_all_frames_xy rolls the axis so let's roll it back
+            s1 = np.rollaxis(s1, 1)
+
+        if s2.shape[1] < 49 or s2.shape[1] > 250:
+            if s1.shape[1] < 49:
+                num_norm_points = 75
+            else:
+                num_norm_points = 200
+            # For documentation see the above for s1
+            s2 = WormParserHelpers.normalize_all_frames_xy(
+                [s2], num_norm_points=num_norm_points)
+            s2 = s2[:, :, 0]
+            s2 = np.rollaxis(s2, 1)
+
+        return (s1, s2)
+
     #%%
     @staticmethod
     def h__getBounds(n1, n2, percent_left_search, percent_right_search):
@@ -387,12 +449,72 @@ class SkeletonCalculatorType1(object):
 
         return start_indices.astype(np.int), stop_indices.astype(np.int)
 
+    #%%
+    @staticmethod
+    def h__getBandedDistances(s1, s2, left_I, right_I):
+        """
+        Compute the distances from each point on side 1 to the points on
+        side 2 that are within its search band, [left_I, right_I).
+
+        This replaces computing the distances between all pairs of points,
+        most of which are never looked at.
+
+        Parameters
+        ---------------
+        s1: numpy array of shape (2,ki)
+        s2: numpy array of shape (2,ji)
+        left_I: numpy array of shape (ki,)
+        right_I: numpy array of shape (ki,)
+            Search bounds from h__getBounds
+
+        Returns
+        ---------------
+        (dx_across, dy_across, d_across): numpy arrays of shape (ki, w)
+            w is the widest search band. Entry [i, j] is for the point
+            left_I[i] + j on side 2. As with the full matrices, dx_across
+            and dy_across are normalized by d_across. Entries beyond the
+            end of the band of a point are not meaningful.
+
+        """
+        band_width = max(np.max(right_I - left_I), 1)
+        band_columns = np.minimum(left_I[:, None] + np.arange(band_width),
+                                  s2.shape[1] - 1)
+
+        dx_across = s1[0, :, None] - s2[0, band_columns]
+        dy_across = s1[1, :, None] - s2[1, band_columns]
+        d_across = np.sqrt(dx_across * dx_across + dy_across * dy_across)
+        dx_across = dx_across / d_across
+        dy_across = dy_across / d_across
+
+        return (dx_across, dy_across, d_across)
+
+    #%%
+    @staticmethod
+    def h__getDistance(xy1, xy2, I1, I2):
+        """
+        The distance between point I1 on side 1 and point I2 on side 2,
+        i.e. d_across[I1, I2] without computing d_across.
+
+        Parameters
+        ---------------
+        xy1: list of two lists, the x and y values of side 1
+        xy2: list of two lists, the x and y values of side 2
+            As given by numpy's tolist(). For single values plain floats
+            are much faster than indexing numpy arrays.
+        I1: int
+        I2: int
+
+        """
+        dx = xy1[0][I1] - xy2[0][I2]
+        dy = xy1[1][I1] - xy2[1][I2]
+        return math.sqrt(dx * dx + dy * dy)
+
     #%%
     @staticmethod
     def h__getMatches(s1, s2,
                       norm_x, norm_y,
                       dx_across, dy_across, d_across,
-                      left_I, right_I):
+                      left_I, right_I, is_banded=False):
         """
         For a given frame,
         For each point on side 1, find which side 2 the point pairs with
@@ -413,6 +535,9 @@ class SkeletonCalculatorType1(object):
             of the contour to any point on the other side.
         left_I:
         right_I:
+        is_banded: bool (optional)
+            If True, dx_across, dy_across and d_across only hold the
+            search band of each point, see h__getBandedDistances.
 
         Returns
         ---------------
@@ -428,14 +553,23 @@ class SkeletonCalculatorType1(object):
         dp_values = np.zeros(n_s1)
         all_signs_used = np.zeros(n_s1)
 
+        # Columns of the distance arrays at which the search bands start
+        if is_banded:
+            column_offsets = left_I
+        else:
+            column_offsets = np.zeros(n_s1, dtype=int)
+
         # There is no need to do the first and last point
         for I, (lb, rb) in enumerate(zip(left_I[1:-1], right_I[1:-1])):
             I = I + 1
+            c_lb = lb - column_offsets[I]
+            c_rb = rb - column_offsets[I]
             [abs_dp_value, dp_I, sign_used] = SkeletonCalculatorType1.\
                 h__getProjectionIndex(norm_x[I], norm_y[I],
-                                      dx_across[I, lb:rb], dy_across[I, lb:rb],
+                                      dx_across[I, c_lb:c_rb],
+                                      dy_across[I, c_lb:c_rb],
                                       lb,
-                                      d_across[I, lb:rb], 0)
+                                      d_across[I, c_lb:c_rb], 0)
             all_signs_used[I] = sign_used
             dp_values[I] = abs_dp_value
             match_I[I] = dp_I
@@ -450,12 +584,14 @@ class SkeletonCalculatorType1(object):
 
             for I in I_bad:
                 lb = left_I[I]
-                rb = right_I[I]
+                c_lb = lb - column_offsets[I]
+                c_rb = right_I[I] - column_offsets[I]
                 [abs_dp_value, dp_I, sign_used] = SkeletonCalculatorType1.\
                     h__getProjectionIndex(norm_x[I], norm_y[I],
-                                          dx_across[I, lb:rb], dy_across[I, lb:rb],
+                                          dx_across[I, c_lb:c_rb],
+                                          dy_across[I, c_lb:c_rb],
                                           lb,
-                                          d_across[I, lb:rb], sign_use)
+                                          d_across[I, c_lb:c_rb], sign_use)
                 all_signs_used[I] = sign_used
                 dp_values[I] = abs_dp_value
                 match_I[I] = dp_I
@@ -535,9 +671,10 @@ class SkeletonCalculatorType1(object):
 
         Parameters
         ----------
-        d_across: 2d numpy array of shape (ki, ji)
+        d_across: 2d numpy array of shape (ki, ji), or None
             A lookup table giving the distance from a point on one
-            of the contour to any point on the other side.
+            of the contour to any point on the other side. If None the
+            distances are computed as needed.
         match_I1: numpy array of shape (ki,)
             current list of matches
         s1: list of numpy arrays, with the arrays having shape (2,ki)
@@ -662,6 +799,7 @@ class SkeletonCalculatorType1(object):
         s2: start index for side 2
         e2: end index for side 2 (inclusive)
         d: distance from I1 to I2 is d(I1,I2)
+            If None, the distances are computed from xy1 and xy2
 
         Returns
         -------
@@ -673,8 +811,13 @@ class SkeletonCalculatorType1(object):
         """
 
         # TODO: remove hardcode, base on max of e1-s1+1
-        p1_I = np.zeros(200, dtype=np.int)
-        p2_I = np.zeros(200, dtype=np.int)
+        p1_I = np.zeros(SkeletonCalculatorType1.MAX_WALK_PAIRS, dtype=np.int)
+        p2_I = np.zeros(SkeletonCalculatorType1.MAX_WALK_PAIRS, dtype=np.int)
+
+        get_distance = SkeletonCalculatorType1.h__getDistance
+        if d is None:
+            xy1_list = xy1.tolist()
+            xy2_list = xy2.tolist()
 
         c1 = s1  # Current 1 index
         c2 = s2  # Current 2 index
@@ -704,9 +847,14 @@ class SkeletonCalculatorType1(object):
             v_n2c2 = xy2[:, next2] - xy2[:, c2]
 
             # 216,231
-            d_n1n2 = d[next1, next2]
-            d_n1c2 = d[next1, c2]
-            d_n2c1 = d[c1, next2]
+            if d is None:
+                d_n1n2 = get_distance(xy1_list, xy2_list, next1, next2)
+                d_n1c2 = get_distance(xy1_list, xy2_list, next1, c2)
+                d_n2c1 = get_distance(xy1_list, xy2_list, c1, next2)
+            else:
+                d_n1n2 = d[next1, next2]
+                d_n1c2 = d[next1, c2]
+                d_n2c1 = d[c1, next2]
 
             if d_n1c2 == d_n2c1 or (d_n1n2 <= d_n1c2 and d_n1n2 <= d_n2c1):
                 # Advance along both contours
@@ -742,6 +890,10 @@ class SkeletonCalculatorType1(object):
 
                 if cur_p_I == 1:
                     prev_width = 0
+                elif d is None:
+                    prev_width = get_distance(xy1_list, xy2_list,
+                                              p1_I[cur_p_I - 1],
+                                              p2_I[cur_p_I - 1])
                 else:
                     prev_width = d[p1_I[cur_p_I - 1], p2_I[cur_p_I - 1]]
 
@@ -766,3 +918,464 @@ class SkeletonCalculatorType1(object):
         return (p1_I, p2_I)
         #p1_I[cur_p_I+1:] = []
         #p2_I[cur_p_I+1:] = []
+
+    #%%
+    @staticmethod
+    def h__computeSkeletonAndWidthsBatched(h_ventral_contour,
+                                           h_dorsal_contour,
+                                           batch_size):
+        """
+        Batched version of compute_skeleton_and_widths.
+
+        The frames are sorted by their number of contour points and split
+        into batches of up to batch_size frames. Each batch is padded with
+        NaN to the largest frame in the batch so that the smoothing,
+        distance calculations, projection matching and end walking can be
+        done with array operations over all the frames in the batch at once.
+
+        The results are the same as those of the frame by frame loop,
+        including smoothing the contours in place.
+
+        Parameters
+        -------------------------
+        h_ventral_contour: list of numpy arrays of shape (2,ki)
+        h_dorsal_contour: list of numpy arrays of shape (2,ji)
+        batch_size: int
+            The maximum number of frames to process at once.
+
+        Returns
+        -------------------------
+        (h_widths, h_skeleton): tuple
+            See compute_skeleton_and_widths
+
+        """
+        num_frames = len(h_ventral_contour)
+
+        h_skeleton = [None] * num_frames
+        h_widths = [None] * num_frames
+
+        valid_frames = [frame_index for frame_index, s1 in
+                        enumerate(h_ventral_contour) if s1 is not None]
+
+        if len(valid_frames) == 0:
+            return (h_widths, h_skeleton)
+
+        for s1 in h_ventral_contour:
+            if s1 is not None:
+                assert s1.shape[0] == 2  # x-y must be in the first dimension
+
+        # Smoothing of the contour (in place, like the frame by frame code)
+        #------------------------------------------
+        SkeletonCalculatorType1.h__smoothSidesBatched(
+            [h_ventral_contour[i] for i in valid_frames])
+        SkeletonCalculatorType1.h__smoothSidesBatched(
+            [h_dorsal_contour[i] for i in valid_frames])
+
+        sides = [SkeletonCalculatorType1.h__resampleSides(
+                 h_ventral_contour[i], h_dorsal_contour[i])
+                 for i in valid_frames]
+
+        n1_all = np.array([s1.shape[1] for s1, s2 in sides])
+        n2_all = np.array([s2.shape[1] for s1, s2 in sides])
+
+        # Group frames of similar size to minimize the padding
+        frame_order = np.argsort(n1_all + n2_all, kind='mergesort')
+
+        for batch_start in range(0, len(frame_order), batch_size):
+            batch_I = frame_order[batch_start:batch_start + batch_size]
+            batch_sides = [sides[i] for i in batch_I]
+
+            I_1_list, I_2_list = SkeletonCalculatorType1.h__getPairsBatched(
+                batch_sides, n1_all[batch_I], n2_all[batch_I])
+
+            for I, (s1, s2), I_1, I_2 in \
+                    zip(batch_I, batch_sides, I_1_list, I_2_list):
+                # See compute_skeleton_and_widths for documentation
+                is_good = np.hstack((True,
+                                     np.array((I_2[1:-1] <= I_2[2:]) &
+                                              (I_2[1:-1] >= I_2[:-2])),
+                                     True))
+                I_1 = I_1[is_good]
+                I_2 = I_2[is_good]
+
+                s1 = s1[:, I_1]
+                s1_p = s2[:, I_2]
+                frame_index = valid_frames[I]
+                h_widths[frame_index] = np.linalg.norm(s1_p - s1, axis=0)
+                h_skeleton[frame_index] = (s1 + s1_p) / 2
+
+        return (h_widths, h_skeleton)
+
+    #%%
+    @staticmethod
+    def h__smoothSidesBatched(sides):
+        """
+        Savitzky-Golay smoothing of one side of the contour for many frames,
+        with one filter call per distinct number of points.
+
+        Parameters
+        ---------------
+        sides: list of numpy arrays of shape (2,ki)
+            These are smoothed in place.
+
+        """
+        n_points = np.array([s.shape[1] for s in sides])
+        for cur_n_points in np.unique(n_points):
+            cur_I = utils.find(n_points == cur_n_points)
+            filter_width = utils.round_to_odd(
+                cur_n_points * SkeletonCalculatorType1.FRACTION_WORM_SMOOTH)
+            try:
+                smoothed = sgolay(np.stack([sides[i] for i in cur_I]),
+                                  window_length=filter_width,
+                                  polyorder=SkeletonCalculatorType1.SMOOTHING_ORDER,
+                                  axis=-1)
+            except ValueError:
+                continue
+
+            for i, cur_smoothed in zip(cur_I, smoothed):
+                sides[i][:] = cur_smoothed
+
+    #%%
+    @staticmethod
+    def h__getPairsBatched(sides, n1, n2):
+        """
+        For a batch of frames, pair off the points from one side of the
+        contour with the other side.
+
+        Parameters
+        ---------------
+        sides: list of (s1, s2) tuples
+            s1 and s2 are numpy arrays of shape (2,ki) and (2,ji)
+        n1: numpy array of shape (m,)
+            The number of points in each s1
+        n2: numpy array of shape (m,)
+            The number of points in each s2
+
+        Returns
+        ---------------
+        (I_1_list, I_2_list): tuple of lists of numpy arrays
+            For each frame, the (I_1, I_2) output of h__updateEndsByWalking
+
+        """
+        n_frames = len(sides)
+        max_n1 = np.max(n1)
+        max_n2 = np.max(n2)
+
+        # Frame x 2 x point, padded with NaN
+        s1 = np.full((n_frames, 2, max_n1), np.NaN)
+        s2 = np.full((n_frames, 2, max_n2), np.NaN)
+        for frame_index, (cur_s1, cur_s2) in enumerate(sides):
+            s1[frame_index, :, :n1[frame_index]] = cur_s1
+            s2[frame_index, :, :n2[frame_index]] = cur_s2
+
+        # Determine search bounds for possible "projection pairs"
+        #------------------------------------------------
+        left_I = np.zeros((n_frames, max_n1), dtype=int)
+        right_I = np.zeros((n_frames, max_n1), dtype=int)
+        for cur_n1, cur_n2 in set(zip(n1, n2)):
+            cur_I = utils.find((n1 == cur_n1) & (n2 == cur_n2))
+            cur_left_I, cur_right_I = SkeletonCalculatorType1.h__getBounds(
+                cur_n1, cur_n2,
+                SkeletonCalculatorType1.PERCENT_BACK_SEARCH,
+                SkeletonCalculatorType1.PERCENT_FORWARD_SEARCH)
+            left_I[cur_I, :cur_n1] = cur_left_I
+            right_I[cur_I, :cur_n1] = cur_right_I
+
+        # The padding produces NaN values which are never used
+        with np.errstate(invalid='ignore', divide='ignore'):
+            norm_x, norm_y = \
+                SkeletonCalculatorType1.h__getNormalVectorsBatched(s1, n1)
+
+            match_I1 = SkeletonCalculatorType1.h__getMatchesBatched(
+                s1, s2, n1, n2, norm_x, norm_y, left_I, right_I)
+
+        return SkeletonCalculatorType1.h__updateEndsByWalkingBatched(
+            match_I1, s1, s2, n1, n2)
+
+    #%%
+    @staticmethod
+    def h__getNormalVectorsBatched(s1, n1):
+        """
+        utils.compute_normal_vectors, for padded frames of varying length
+
+        Parameters
+        ---------------
+        s1: numpy array of shape (m, 2, max_n1)
+        n1: numpy array of shape (m,)
+            The number of (non-padded) points in each frame
+
+        Returns
+        ---------------
+        (norm_x, norm_y): numpy arrays of shape (m, max_n1)
+
+        """
+        frame_I = np.arange(s1.shape[0])
+        last_I = n1 - 1
+
+        # Match np.gradient, which uses one-sided differences at the ends
+        gradient = np.empty(s1.shape)
+        gradient[:, :, 1:-1] = (s1[:, :, 2:] - s1[:, :, :-2]) / 2.0
+        gradient[:, :, 0] = s1[:, :, 1] - s1[:, :, 0]
+        gradient[frame_I, :, last_I] = s1[frame_I, :, last_I] - \
+            s1[frame_I, :, last_I - 1]
+
+        dx = gradient[:, 0, :]
+        dy = gradient[:, 1, :]
+        magnitude = np.sqrt(dy * dy + dx * dx)
+
+        return (dy / magnitude, -dx / magnitude)
+
+    #%%
+    @staticmethod
+    def h__getMatchesBatched(s1, s2, n1, n2, norm_x, norm_y,
+                             left_I, right_I):
+        """
+        h__getMatches and h__getProjectionIndex for a batch of padded frames.
+
+        The distances from every point on side 1 to the points in its
+        search window are computed as an array of shape
+        (m, max_n1, max_window_width), as in h__getBandedDistances, and the
+        projection logic is applied to all windows at once.
+
+        The frame by frame code first picks a sign for each point and then
+        recomputes the points whose sign disagrees with the majority, using
+        the majority sign. The end result is that every point in a frame
+        uses the same sign, which is what is computed here directly.
+
+        Parameters
+        ---------------
+        s1: numpy array of shape (m, 2, max_n1)
+        s2: numpy array of shape (m, 2, max_n2)
+        n1: numpy array of shape (m,)
+        n2: numpy array of shape (m,)
+        norm_x: numpy array of shape (m, max_n1)
+        norm_y: numpy array of shape (m, max_n1)
+        left_I: numpy array of shape (m, max_n1)
+        right_I: numpy array of shape (m, max_n1)
+
+        Returns
+        ---------------
+        match_I: numpy array of shape (m, max_n1)
+
+        """
+        n_frames, max_n1 = left_I.shape
+        point_I = np.arange(max_n1)
+
+        # There is no need to do the first and last point
+        is_searched = (point_I >= 1) & (point_I < (n1 - 1)[:, None])
+        window_width = np.where(is_searched, right_I - left_I, 0)
+        window_I = np.arange(max(np.max(window_width), 3))
+        in_window = window_I < window_width[:, :, None]
+
+        window_columns = np.minimum(left_I[:, :, None] + window_I,
+                                    s2.shape[2] - 1)
+        window_frames = np.arange(n_frames)[:, None, None]
+
+        dx_window = s1[:, 0, :, None] - s2[window_frames, 0, window_columns]
+        dy_window = s1[:, 1, :, None] - s2[window_frames, 1, window_columns]
+        d_window = np.sqrt(dx_window * dx_window + dy_window * dy_window)
+
+        # dp = dx / d * norm_x + dy / d * norm_y, in place to limit the
+        # number of window sized arrays
+        dp = dx_window
+        dp /= d_window
+        dp *= norm_x[:, :, None]
+        dy_window /= d_window
+        dy_window *= norm_y[:, :, None]
+        dp += dy_window
+        del dy_window
+
+        # Signs, see h__getProjectionIndex and h__getMatches
+        #--------------------------------------------------------
+        sign_used = np.where(np.sum(np.where(in_window, dp, 0), axis=2) > 0,
+                             1, -1)
+        sign_used[~is_searched] = 0
+        # All frames have at least 49 points, so point 1 is always searched
+        is_same_sign = np.all((sign_used == sign_used[:, 1:2]) |
+                              ~is_searched, axis=1)
+        use_flip = np.where(is_same_sign,
+                            sign_used[:, 1] == 1,
+                            np.sum(sign_used, axis=1) > 0)
+        dp[use_flip] = -1 * dp[use_flip]
+
+        # Projection index, see h__getProjectionIndex
+        #--------------------------------------------------------
+        possible = (dp[:, :, 1:-2] < dp[:, :, 2:-1]) & \
+                   (dp[:, :, 1:-2] < dp[:, :, 0:-3]) & \
+                   (window_I[:-3] < (window_width - 3)[:, :, None])
+        n_possible = np.sum(possible, axis=2)
+
+        first_possible_I = np.argmax(possible, axis=2)
+        closest_possible_I = np.argmin(
+            np.where(possible, d_window[:, :, :-3], np.inf), axis=2)
+        min_dp_I = np.argmin(np.where(in_window, dp, np.inf), axis=2)
+
+        dp_I = np.where(n_possible == 1, first_possible_I + 1,
+                        np.where(n_possible > 1, closest_possible_I + 1,
+                                 min_dp_I))
+
+        match_I = np.where(is_searched, left_I + dp_I, 0)
+        match_I[np.arange(n_frames), n1 - 1] = n2
+
+        return match_I
+
+    #%%
+    @staticmethod
+    def h__updateEndsByWalkingBatched(match_I1, s1, s2, n1, n2):
+        """
+        h__updateEndsByWalking for a batch of padded frames.
+
+        Parameters
+        ----------
+        match_I1: numpy array of shape (m, max_n1)
+        s1: numpy array of shape (m, 2, max_n1)
+        s2: numpy array of shape (m, 2, max_n2)
+        n1: numpy array of shape (m,)
+        n2: numpy array of shape (m,)
+
+        Returns
+        -------
+        (I_1_list, I_2_list): tuple of lists of numpy arrays
+            For each frame, the (I_1, I_2) output of h__updateEndsByWalking
+
+        """
+        n_frames, max_n1 = match_I1.shape
+        frame_I = np.arange(n_frames)
+        point_I = np.arange(max_n1)
+
+        end_s1_walk_I = np.ceil(
+            n1 * SkeletonCalculatorType1.END_S1_WALK_PCT).astype(np.int)
+        end_s2_walk_I = 2 * end_s1_walk_I
+
+        end_s1_walk_backwards = n1 - end_s1_walk_I + 1
+        end_s2_walk_backwards = n2 - end_s2_walk_I + 1
+
+        keep_mask = np.zeros(match_I1.shape, dtype=np.bool)
+
+        walks = [(np.zeros(n_frames, dtype=int), end_s1_walk_I,
+                  np.zeros(n_frames, dtype=int), end_s2_walk_I),
+                 (n1 - 1, end_s1_walk_backwards,
+                  n2 - 1, end_s2_walk_backwards)]
+
+        for walk_s1, walk_e1, walk_s2, walk_e2 in walks:
+            p1_I, p2_I, n_pairs = \
+                SkeletonCalculatorType1.h__getPartnersViaWalkBatched(
+                    walk_s1, walk_e1, walk_s2, walk_e2, s1, s2)
+
+            # Later pairs overwrite earlier ones, as in the frame by frame
+            # code, since boolean indexing keeps the pairs in order
+            is_pair = np.arange(p1_I.shape[1]) < n_pairs[:, None]
+            pair_frame_I = np.broadcast_to(frame_I[:, None], p1_I.shape)
+            match_I1[pair_frame_I[is_pair], p1_I[is_pair]] = p2_I[is_pair]
+            keep_mask[pair_frame_I[is_pair], p1_I[is_pair]] = True
+
+        # Anything in between we'll use the projection approach
+        keep_mask[(point_I > end_s1_walk_I[:, None]) &
+                  (point_I < end_s1_walk_backwards[:, None])] = True
+
+        # Always keep ends
+        keep_mask[:, 0] = True
+        keep_mask[frame_I, n1 - 1] = True
+        keep_mask[point_I >= n1[:, None]] = False
+
+        match_I1[:, 0] = 0
+        match_I1[frame_I, n1 - 1] = n2 - 1
+
+        I_1_list = [utils.find(cur_keep_mask) for cur_keep_mask in keep_mask]
+        I_2_list = [cur_match_I1[cur_I_1] for cur_match_I1, cur_I_1 in
+                    zip(match_I1, I_1_list)]
+
+        return (I_1_list, I_2_list)
+
+    #%%
+    @staticmethod
+    def h__getPartnersViaWalkBatched(s1, e1, s2, e2, xy1, xy2):
+        """
+        h__getPartnersViaWalk for a batch of padded frames.
+
+        Every frame takes one step of its walk per iteration, until all
+        walks have finished. The few distances that are needed are computed
+        from xy1 and xy2 at each step.
+
+        Parameters
+        ----------
+        s1: numpy array of shape (m,), start index for side 1
+        e1: numpy array of shape (m,), end index for side 1 (inclusive)
+        s2: numpy array of shape (m,), start index for side 2
+        e2: numpy array of shape (m,), end index for side 2 (inclusive)
+        xy1: numpy array of shape (m, 2, max_n1)
+        xy2: numpy array of shape (m, 2, max_n2)
+
+        Returns
+        -------
+        (p1_I, p2_I, n_pairs) tuple
+            p1_I: numpy array of shape (m, MAX_WALK_PAIRS)
+            p2_I: numpy array of shape (m, MAX_WALK_PAIRS)
+            n_pairs: numpy array of shape (m,)
+                The number of pairs in p1_I and p2_I for each frame
+
+        """
+        n_frames = len(s1)
+        max_pairs = SkeletonCalculatorType1.MAX_WALK_PAIRS
+
+        def get_distance(I, I1, I2):
+            dx = xy1[I, 0, I1] - xy2[I, 0, I2]
+            dy = xy1[I, 1, I1] - xy2[I, 1, I2]
+            return np.sqrt(dx * dx + dy * dy)
+
+        p1_I = np.zeros((n_frames, max_pairs), dtype=np.int)
+        p2_I = np.zeros((n_frames, max_pairs), dtype=np.int)
+
+        c1 = s1.copy()  # Current 1 index
+        c2 = s2.copy()  # Current 2 index
+        cur_p_I = np.full(n_frames, -1)  # Current pair index
+
+        # We are either going up or down based on which end we are
+        # starting from (beggining or end)
+        step = np.where(e1 < s1, -1, 1)
+
+        is_walking = (c1 != e1) & (c2 != e2)
+        while np.any(is_walking):
+            I = utils.find(is_walking)
+            cur_c1 = c1[I]
+            cur_c2 = c2[I]
+            next1 = cur_c1 + step[I]
+            next2 = cur_c2 + step[I]
+            cur_p_I[I] += 1
+            pair_I = cur_p_I[I]
+
+            v_n1c1 = xy1[I, :, next1] - xy1[I, :, cur_c1]
+            v_n2c2 = xy2[I, :, next2] - xy2[I, :, cur_c2]
+
+            d_n1n2 = get_distance(I, next1, next2)
+            d_n1c2 = get_distance(I, next1, cur_c2)
+            d_n2c1 = get_distance(I, cur_c1, next2)
+
+            # Note that for the first pair this looks at the end of the
+            # buffers, like the frame by frame code
+            prev_width = np.where(pair_I == 1, 0,
+                                  get_distance(I, p1_I[I, pair_I - 1],
+                                               p2_I[I, pair_I - 1]))
+
+            is_similar_direction = np.any((v_n1c1 * v_n2c2) > 0, axis=1)
+
+            advance_both = \
+                (d_n1c2 == d_n2c1) | \
+                ((d_n1n2 <= d_n1c2) & (d_n1n2 <= d_n2c1)) | \
+                (~is_similar_direction &
+                 (d_n1c2 > prev_width) & (d_n2c1 > prev_width))
+            advance_1 = advance_both | (d_n1c2 < d_n2c1)
+            advance_2 = advance_both | ~advance_1
+
+            new_c1 = np.where(advance_1, next1, cur_c1)
+            new_c2 = np.where(advance_2, next2, cur_c2)
+
+            p1_I[I, pair_I] = new_c1
+            p2_I[I, pair_I] = new_c2
+            c1[I] = new_c1
+            c2[I] = new_c2
+
+            is_walking = (c1 != e1) & (c2 != e2)
+
+        # As in the frame by frame code, the last pair is not returned
+        return (p1_I, p2_I, cur_p_I)
@@ -95,6 +95,40 @@ class VideoInfo(object):
         self.ventral_mode = config.DEFAULT_VENTRAL_MODE
         self.video_type = 'Not specified'
 
+    # The attributes other than frame_code, which are kept when saving
+    metadata_attributes = ['video_name', 'fps', 'height', 'width',
+                           'microns_per_pixel_x', 'microns_per_pixel_y',
+                           'fourcc', 'length_in_seconds', 'length_in_frames',
+                           'ventral_mode', 'video_type']
+
+    def get_metadata(self):
+        """
+        The metadata attributes (all but frame_code), as a dictionary of
+        JSON serializable values.
+
+        """
+        metadata = {}
+        for a in self.metadata_attributes:
+            value = getattr(self, a, None)
+            if isinstance(value, np.generic):
+                value = value.item()
+            metadata[a] = value
+        return metadata
+
+    @classmethod
+    def from_metadata(cls, metadata, frame_code=None):
+        """
+        Create a VideoInfo from the dictionary returned by get_metadata.
+
+        """
+        video_info = cls()
+        for a in cls.metadata_attributes:
+            if a in metadata:
+                setattr(video_info, a, metadata[a])
+        if frame_code is not None:
+            video_info.frame_code = frame_code
+        return video_info
+
     def set_ventral_mode(self, ventral_side):
         '''
         Set the ventral side mode. Valid options are "clockwise", "anticlockwise" and "unknown".
@@ -7,15 +7,16 @@ that are the equivalent of the same-named functions in Matlab, e.g. gausswin
 
 """
 from __future__ import division
-from itertools import groupby
 
 import os
 import sys
 import time
 import csv
+import threading
 
 import numpy as np
 import scipy as sp
+import scipy.ndimage.filters as filters
 
 import matplotlib.pyplot as plt
 
@@ -25,10 +26,12 @@ __ALL__ = ['scatter',
            'plotx',
            'imagesc',
            'separated_peaks',
+           'separated_peaks_2D',
            'gausswin',
            'colon',
            'print_object'
            'write_to_CSV',
+           'get_runs',
            'interpolate_with_threshold',
            'interpolate_with_threshold_2D',
            'gausswin',
@@ -147,80 +150,27 @@ def separated_peaks(x, dist, use_max, value_cutoff):
         temp_I = np.argmax(x)
         return (x[temp_I], temp_I)
 
-    # xt - "x for testing" in some places in the code below
-    # it will be quicker (and/or easier) to assume that we want the largest
-    # value. By negating the data we can look for maxima (which will tell us
-    # where the minima are)
-    if not use_max:
-        xt = -1 * x
-    else:
-        xt = x
-
     # NOTE: I added left/right neighbor comparisions which really helped with
     # the fft ..., a point can't be a peak if it is smaller than either of its
     # neighbors
+    could_be_a_peak = _h_peak_candidates(x, use_max, value_cutoff)
 
-    np_true = np.ones(1, dtype=np.bool)
+    I1 = could_be_a_peak.nonzero()[0]
     if use_max:
-        #                                           %> left                     > right
-        # Matlab version:
-        # could_be_a_peak = x > value_cutoff & [true x(2:end) > x(1:end-1)] &
-        # [x(1:end-1) > x(2:end) true];
-
-        # greater than values to the left
-        could_be_a_peak = (
-            x > value_cutoff) & np.concatenate(
-            (np_true, x[
-                1:] > x[
-                0:-1]))
-        # could_be_a_peak = np.logical_and(
-        # x > value_cutoff, np.concatenate((np.ones(1, dtype=np.bool), x[1:] >
-        # x[0:-1])))
-
-        # greater than values to the right
-        could_be_a_peak = could_be_a_peak & np.concatenate(
-            (x[0:-1] > x[1:], np_true))
-
-        # could_be_a_peak = np.logical_and(
-        # could_be_a_peak, np.concatenate((x[0:-1] > x[1:], np.ones(1,
-        # dtype=np.bool))))
-
-        I1 = could_be_a_peak.nonzero()[0]
         I2 = np.argsort(-1 * x[I1])  # -1 => we want largest first
-        I = I1[I2]
     else:
-        #raise Exception("Not yet implemented")
-        # pdb.set_trace()
-        # could_be_a_peak = x < value_cutoff & [true x(2:end) < x(1:end-1)] & [x(1:end-1) < x(2:end) true];
-        #I1     = find(could_be_a_peak);
-        #[~,I2] = sort(x(I1));
-        #I = I1(I2);
-
-        could_be_a_peak = (
-            x < value_cutoff) & np.concatenate(
-            (np_true, x[
-                1:] < x[
-                0:-1]))
-        could_be_a_peak = could_be_a_peak & np.concatenate(
-            (x[0:-1] < x[1:], np_true))
-
-        I1 = could_be_a_peak.nonzero()[0]
         I2 = np.argsort(x[I1])
-        I = I1[I2]
+    I = I1[I2]
 
     n_points = x.size
 
     # This code would need to be fixed if real distances
     # are input ...
-    too_close = dist - 1
-
-    temp_I = colon(0, 1, n_points - 1)
-    start_I = temp_I - too_close  # Note, separated by dist is ok
-    # This sets the off limits area, so we go in by 1
-    end_I = temp_I + too_close
+    too_close = int(dist) - 1
 
-    start_I[start_I < 0] = 0
-    end_I[end_I > n_points] = n_points
+    # The maximum (or minimum) of the window of each point, which is NaN if
+    # there is a NaN in the window
+    window_extreme = _h_window_extremes(x, too_close, use_max)
 
     is_peak_mask = np.zeros(n_points, dtype=bool)
     # A peak and thus can not be used as a peak
@@ -236,13 +186,10 @@ def separated_peaks(x, dist, use_max, value_cutoff):
             # whether they are the min or max within their
             # else from being used, so we might as well mark those indices
             # within it's distance as taken as well
-            temp_indices = slice(int(start_I[cur_index]), int(end_I[cur_index]))
-            could_be_a_peak[temp_indices] = False
+            could_be_a_peak[max(cur_index - too_close, 0):
+                            cur_index + too_close] = False
 
-            # This line is really slow ...
-            # It would be better to precompute the max within a window
-            # for all windows ...
-            is_peak_mask[cur_index] = np.max(xt[temp_indices]) == xt[cur_index]
+            is_peak_mask[cur_index] = window_extreme[cur_index] == x[cur_index]
 
     indices = is_peak_mask.nonzero()[0]
     peaks = x[indices]
@@ -250,6 +197,115 @@ def separated_peaks(x, dist, use_max, value_cutoff):
     return (peaks, indices)
 
 
+def separated_peaks_2D(x, dist, use_max, value_cutoff, axis=-1):
+    """
+    Find the peaks of each row (or column etc.) of an array, as
+    separated_peaks does for one vector.
+
+    Parameters
+    ---------------------------------------
+    x: numpy array
+    dist: int
+      The minimum distance between peaks
+    use_max: boolean
+      True: find the maximum peaks
+      False: find the minimum peaks
+    value_cutoff: float or numpy array
+      For each vector, the peaks must be greater (or less) than this
+      value. An array has the shape of x without axis.
+    axis: int
+      The axis along which to find peaks
+
+    Returns
+    ---------------------------------------
+    numpy array of bool, the shape of x
+      Whether each value is a peak
+
+    Notes
+    ---------------------------------------
+    The possible peaks of all vectors are visited at once: the largest of
+    each vector first, then the second largest, etc. Possible peaks with
+    the same value may be visited in a different order than by
+    separated_peaks, which can change which of them is a peak.
+
+    Unlike separated_peaks, a vector shorter than the search window is
+    searched in the same way as longer vectors.
+
+    """
+    x = np.moveaxis(np.asarray(x), axis, -1)
+    value_cutoff = np.asarray(value_cutoff)[..., None]
+    n_points = x.shape[-1]
+    too_close = int(dist) - 1
+
+    # Each vector is a row
+    xt = x.reshape(-1, n_points)
+    if not use_max:
+        xt = -xt
+    value_cutoff = np.broadcast_to(value_cutoff if use_max else
+                                   -value_cutoff, x.shape).reshape(xt.shape)
+
+    could_be_a_peak = _h_peak_candidates(xt, True, value_cutoff)
+    window_max = _h_window_extremes(xt, too_close, True)
+
+    # Visiting the largest possible peak of each row, then the second
+    # largest, etc.
+    n_candidates = np.sum(could_be_a_peak, axis=1)
+    candidate_I = np.argsort(np.where(could_be_a_peak, -xt, np.inf), axis=1)
+    window_I = np.arange(-too_close, too_close)
+
+    is_peak = np.zeros(xt.shape, dtype=bool)
+    for rank in range(np.max(n_candidates, initial=0)):
+        row_I = np.flatnonzero(n_candidates > rank)
+        cur_I = candidate_I[row_I, rank]
+        is_visited = could_be_a_peak[row_I, cur_I]
+        row_I = row_I[is_visited]
+        cur_I = cur_I[is_visited]
+
+        could_be_a_peak[row_I[:, None], np.clip(
+            cur_I[:, None] + window_I, 0, n_points - 1)] = False
+        is_peak[row_I, cur_I] = window_max[row_I, cur_I] == xt[row_I, cur_I]
+
+    return np.moveaxis(is_peak.reshape(x.shape), -1, axis)
+
+
+def _h_peak_candidates(x, use_max, value_cutoff):
+    """
+    The points that could be a peak of separated_peaks: those beyond the
+    cutoff and beyond their neighbors, along the last axis.
+    """
+    if use_max:
+        could_be_a_peak = x > value_cutoff
+        could_be_a_peak[..., 1:] &= x[..., 1:] > x[..., :-1]
+        could_be_a_peak[..., :-1] &= x[..., :-1] > x[..., 1:]
+    else:
+        could_be_a_peak = x < value_cutoff
+        could_be_a_peak[..., 1:] &= x[..., 1:] < x[..., :-1]
+        could_be_a_peak[..., :-1] &= x[..., :-1] < x[..., 1:]
+    return could_be_a_peak
+
+
+def _h_window_extremes(x, too_close, use_max):
+    """
+    The maximum (or minimum) of the window of each point along the last
+    axis, from too_close points before it to too_close - 1 points after
+    it, or NaN if there is a NaN in the window.
+    """
+    size = max(2 * too_close, 1)
+    is_nan = np.isnan(x)
+    # NaN values are replaced as they would confuse the filters
+    if use_max:
+        window_extreme = filters.maximum_filter1d(
+            np.where(is_nan, -np.inf, x), size, mode='nearest')
+    else:
+        window_extreme = filters.minimum_filter1d(
+            np.where(is_nan, np.inf, x), size, mode='nearest')
+
+    has_nan = filters.maximum_filter1d(is_nan.astype(np.uint8), size,
+                                       mode='nearest')
+    window_extreme[has_nan.astype(bool)] = np.NaN
+    return window_extreme
+
+
 def colon(r1, inc, r2):
     """
       Matlab's colon operator, althought it doesn't although inc is required
@@ -439,6 +495,47 @@ def write_to_CSV(data_dict, filename):
     csv_file.close()
 
 
+def get_runs(mask):
+    """
+    Find the runs of True values of a boolean array, i.e. its run length
+    encoding.
+
+    For example:
+
+      0 1 2 3 4 5 6 7   <- indices
+      F T T F F T T T   <- mask
+
+    has the runs [1,3) and [5,8), so starts = [1, 5], stops = [3, 8] and
+    lengths = [2, 3]
+
+    Parameters
+    ---------------------------------------
+    mask: 1-d boolean numpy array
+
+    Returns
+    ---------------------------------------
+    starts: 1-d int numpy array
+      The index of the first value of each run
+    stops: 1-d int numpy array
+      The index after the last value of each run, i.e. each run is
+      mask[starts[i]:stops[i]]. These are slice values, NOT indices.
+    lengths: 1-d int numpy array
+      stops - starts
+
+    """
+    # We pad with Falses so that the runs at the edges start and stop
+    # within the array, then every start is a change from False to True
+    # and every stop a change from True to False
+    padded_mask = np.concatenate(([False], np.asarray(mask, dtype=bool),
+                                  [False]))
+    changes_I = np.flatnonzero(padded_mask[1:] != padded_mask[:-1])
+
+    starts = changes_I[::2]
+    stops = changes_I[1::2]
+
+    return starts, stops, stops - starts
+
+
 def interpolate_with_threshold(array,
                                threshold=None,
                                make_copy=True,
@@ -488,8 +585,10 @@ def interpolate_with_threshold(array,
 
     Notes
     ---------------------------------------
-    TODO: Extrapolation currently not implemented.  Perhaps try
-    http://stackoverflow.com/questions/2745329/
+    Extrapolation uses the line through the first two (or last two) data
+    points, like interp1(...,'linear','extrap') in Matlab. It is only done
+    for runs of NaNs at the ends within the threshold, and if there are at
+    least two data points.
 
     """
 
@@ -524,65 +623,65 @@ def interpolate_with_threshold(array,
     x = np.flatnonzero(np.isnan(new_array))
 
     # (If we weren't using a threshold and just interpolating all NaNs,
-    # we could skip the next four lines.)
+    # we could skip the next lines.)
     if(threshold is not None):
-        # Group these together using a fancy trick from
-        # http://stackoverflow.com/questions/2154249/, since
-        # the lambda function x:x[0]-x[1] on an enumerated list will
-        # group consecutive integers together
-        # e.g. [[(0, 3)], [(1, 5), (2, 6), (3, 7)]]
-        x_grouped = [
-            list(group) for key,
-            group in groupby(
-                enumerate(x),
-                lambda i:i[0] -
-                i[1])]
-
-        # We want to know the first element from each "run", and the run's length
-        # e.g. [(3, 1), (5, 3)]
-        x_runs = [(i[0][1], len(i)) for i in x_grouped]
+        # Find the runs of NaNs, e.g. starting at [3, 5] and of
+        # lengths [1, 3]
+        starts, stops, lengths = get_runs(np.isnan(new_array))
 
         # We need only interpolate on runs of length <= threshold
-        # e.g. if threshold = 2, then we have only [(3, 1)]
-        x_runs = [i for i in x_runs if i[1] <= threshold]
-
-        # now expand the remaining runs
-        # e.g. if threshold was 5, then x_runs would be [(3,1), (5,3)] so
-        #      x would be [3, 5, 6, 7]
-        # this give us the x-coordinates of the values to be interpolated:
+        # e.g. if threshold = 2, then we have only the run at 3 of length 1
+        is_short_run = lengths <= threshold
+        starts = starts[is_short_run]
+        lengths = lengths[is_short_run]
 
-        if x_runs:
-            x = np.concatenate([(i[0] + list(range(i[1]))) for i in x_runs])
-        else:
+        if starts.size == 0:
             # consider th case that there where not valid groups remaining to
             # interpolate
             return new_array
 
+        # now expand the remaining runs
+        # e.g. if threshold was 5, then x would be [3, 5, 6, 7]
+        # this give us the x-coordinates of the values to be interpolated:
+        x = np.arange(np.sum(lengths)) + \
+            np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+
     # The x-coordinates of the data points, must be increasing.
     xp = np.flatnonzero(~np.isnan(new_array))
     # The y-coordinates of the data points, same length as xp
     yp = array[~np.isnan(new_array)]
 
-    if extrapolate:
-        # TODO
-        # :/  Might need to use scipy
-        # also, careful of the "left" and "right" settings below
-        pass
-
     # Place the interpolated values into the array
     # the "left" and "right" here mean that we want to leave NaNs in place
     # if the array begins and/or ends with a sequence of NaNs (i.e. don't
     # try to extrapolate)
     new_array[x] = np.interp(x, xp, yp, left=np.NaN, right=np.NaN)
 
+    if extrapolate and xp.size >= 2:
+        x_left = x[x < xp[0]]
+        new_array[x_left] = _h_extend_line(x_left, xp[0], yp[0],
+                                           xp[1], yp[1])
+        x_right = x[x > xp[-1]]
+        new_array[x_right] = _h_extend_line(x_right, xp[-2], yp[-2],
+                                            xp[-1], yp[-1])
+
     return new_array
 
 
+def _h_extend_line(x, x0, y0, x1, y1):
+    """
+    The values at x of the line through (x0,y0) and (x1,y1), computed the
+    same way as by np.interp
+    """
+    slope = (y1 - y0) / (x1 - x0)
+    return slope * (x - x0) + y0
+
+
 def interpolate_with_threshold_2D(array, threshold=None, extrapolate=False):
     """
     Interpolate two-dimensional data along the second axis.  Each "row"
-    is treated as a separate interpolation.  So if the first axis has 4
-    rows of n frames in the second axis, we are interpolating 4 times.
+    is treated as a separate interpolation, but all rows are interpolated
+    at once.
 
     Parameters
     ---------------------------------------
@@ -597,25 +696,124 @@ def interpolate_with_threshold_2D(array, threshold=None, extrapolate=False):
       If yes, values are extrapolated to the start and end, along the second
       axis (the axis being interpolated)
 
+    Returns
+    ---------------------------------------
+    numpy array [m x n_frames]
+      A new array, with the same values as interpolate_with_threshold
+      of each row
+
     Notes
     ---------------------------------------
-    This could be optimized with a specialized function for the case
-    when all the NaN entries line up along the first dimension.  We'd
-    only need to calculate the mask once rather than m times.
+    The rows often have the same NaN entries (e.g. when all the points of
+    a frame are missing), in which case the runs of NaNs are only found
+    once, for the first row, and applied to all rows.
+
+    Rows that are all NaN are left alone, rather than raising an error.
 
     """
     new_array = array.copy()
 
-    # NOTE: This version is a bit weird because the size of y is not 1d
-    for i1 in range(np.shape(array)[0]):
-        new_array[i1, :] = interpolate_with_threshold(array[i1, :],
-                                                      threshold,
-                                                      make_copy=True,
-                                                      extrapolate=extrapolate)
+    if(threshold == 0):  # everything gets left as NaN
+        return new_array
+
+    is_nan = np.isnan(array)
+    if not np.any(is_nan):
+        return new_array
+
+    if np.all(is_nan == is_nan[0]):
+        # All rows are interpolated at the same columns, from the same
+        # columns
+        x, x0, x1 = _h_get_interpolation_points(is_nan[:1], threshold,
+                                                extrapolate)[1:]
+        row_I = slice(None)
+    else:
+        row_I, x, x0, x1 = _h_get_interpolation_points(is_nan, threshold,
+                                                       extrapolate)
+
+    new_array[row_I, x] = _h_extend_line(x, x0, array[row_I, x0],
+                                         x1, array[row_I, x1])
 
     return new_array
 
 
+def _h_get_interpolation_points(is_nan, threshold, extrapolate):
+    """
+    For each NaN entry that should be interpolated, the columns of the two
+    data points of its row whose line gives its value.
+
+    Parameters
+    ---------------------------------------
+    is_nan: [m x n_frames]
+    threshold: int or None
+    extrapolate: bool
+
+    Returns
+    ---------------------------------------
+    (row_I, x, x0, x1): 1-d int numpy arrays
+      The row and column of each entry to be interpolated, and the
+      columns of the data points before and after it (for interpolation)
+      or the two data points nearest to it (for extrapolation)
+
+    """
+    n_rows, n_frames = is_nan.shape
+
+    # The runs of NaNs of all rows, with a column of data points after
+    # each row so that no run goes from one row to the next
+    padded_is_nan = np.zeros((n_rows, n_frames + 1), dtype=bool)
+    padded_is_nan[:, :n_frames] = is_nan
+    starts, stops, lengths = get_runs(padded_is_nan.ravel())
+
+    row_I, starts = np.divmod(starts, n_frames + 1)
+    stops = starts + lengths
+
+    # The data points before and after the runs, if they are not at the
+    # ends of their row
+    x0 = starts - 1
+    x1 = stops.copy()
+
+    is_first = starts == 0
+    is_last = stops == n_frames
+    use_run = ~(is_first | is_last)
+    if extrapolate:
+        # The second data point of the row, after the first one, is just
+        # after it unless a run of NaNs starts there
+        run_I = np.arange(starts.size)
+        next_run_I = np.minimum(run_I + 1, starts.size - 1)
+        has_nan_after = (row_I[next_run_I] == row_I) & \
+            (starts[next_run_I] == stops + 1)
+        second_x = np.where(has_nan_after, stops[next_run_I], stops + 1)
+
+        # Similarly for the data point before the last one
+        previous_run_I = np.maximum(run_I - 1, 0)
+        has_nan_before = (row_I[previous_run_I] == row_I) & \
+            (stops[previous_run_I] == starts - 1)
+        second_to_last_x = np.where(has_nan_before,
+                                    starts[previous_run_I] - 1, starts - 2)
+
+        # Extrapolation needs two data points
+        is_first = is_first & ~is_last & (second_x < n_frames)
+        is_last = is_last & ~(starts == 0) & (second_to_last_x >= 0)
+        x0[is_first] = stops[is_first]
+        x1[is_first] = second_x[is_first]
+        x0[is_last] = second_to_last_x[is_last]
+        x1[is_last] = starts[is_last] - 1
+        use_run |= is_first | is_last
+
+    # We need only interpolate on runs of length <= threshold
+    if threshold is not None:
+        use_run &= lengths <= threshold
+
+    starts = starts[use_run]
+    lengths = lengths[use_run]
+
+    # Expand the runs into the columns of their entries
+    x = np.arange(np.sum(lengths)) + \
+        np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+
+    return (np.repeat(row_I[use_run], lengths), x,
+            np.repeat(x0[use_run], lengths), np.repeat(x1[use_run], lengths))
+
+
 def gausswin(L, alpha=2.5):
     """
     An N-point Gaussian window with alpha proportional to the
@@ -926,6 +1124,10 @@ class ElementTimer(object):
     # Run the feature processing code, or some other code
     timer.toc('name of feature being processed')
 
+    tic() and toc() calls can be nested (e.g. a feature which computes
+    another feature), and made from several threads at once: each toc()
+    is matched with the latest tic() of the same thread.
+
     #TODO: Consider
 
     """
@@ -933,16 +1135,56 @@ class ElementTimer(object):
     def __init__(self):
         self.names = []
         self.times = []
+        self._thread_state = threading.local()
+
+    def _start_times(self):
+        """
+        The stack of start times of the calling thread
+        """
+        try:
+            return self._thread_state.start_times
+        except AttributeError:
+            self._thread_state.start_times = []
+            return self._thread_state.start_times
 
     def tic(self):
+        """
+        Returns
+        -------
+        int
+            The nesting depth before this tic, which can be passed to
+            cancel() if the timed code fails before calling toc()
+        """
+        start_times = self._start_times()
         self.start_time = timing_function()
+        start_times.append(self.start_time)
+        return len(start_times) - 1
 
     def toc(self, name):
-        elapsed_time = timing_function() - self.start_time
+        start_times = self._start_times()
+        start_time = start_times.pop() if start_times else self.start_time
+        elapsed_time = timing_function() - start_time
         self.times.append(elapsed_time)
         self.names.append(name)
         return elapsed_time
 
+    def cancel(self, depth):
+        """
+        Drop the tic() calls of this thread made at or after the nesting
+        depth returned by a tic(), without logging them.
+        """
+        del self._start_times()[depth:]
+
+    def __getstate__(self):
+        # threading.local can't be pickled
+        state = self.__dict__.copy()
+        del state['_thread_state']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._thread_state = threading.local()
+
     # def get_time(self,name):
     #    return self.times[self.names.index(name)]
 
@@ -5,6 +5,8 @@ Some unit tests of the open-worm-analysis-toolbox package
 """
 import sys
 import os
+import copy
+import numpy as np
 
 # We must add .. to the path so that we can perform the
 # import of open_worm_analysis_toolbox while running this as
@@ -37,6 +39,780 @@ def test_round_to_odd():
     assert(round_to_odd(-12) in (-11, -13))
 
 
+def _example_h_contour(n_frames=30):
+    """
+    A heterocardinal contour of a sinusoidal worm, with a varying number
+    of points per frame and a few missing frames.
+
+    """
+    h_ventral_contour = []
+    h_dorsal_contour = []
+    for frame_index in range(n_frames):
+        if frame_index % 7 == 3:
+            h_ventral_contour.append(None)
+            h_dorsal_contour.append(None)
+            continue
+        for h_contour, sign, n_points in \
+                ((h_ventral_contour, 1, 60 + 3 * frame_index),
+                 (h_dorsal_contour, -1, 90 + 2 * frame_index)):
+            s = np.linspace(0, 1, n_points)
+            x = 1000 * s + frame_index
+            y = 80 * np.sin(2 * np.pi * (1.5 * s - frame_index / 25.)) + \
+                sign * 30 * np.sin(np.pi * s)
+            h_contour.append(np.vstack((x, y)))
+
+    return h_ventral_contour, h_dorsal_contour
+
+
+def test_batched_skeleton():
+    # The batched skeletonization should match the frame by frame version
+    compute = mv.prefeatures.pre_features.WormParsing.\
+        compute_skeleton_and_widths
+    h_ventral_contour, h_dorsal_contour = _example_h_contour()
+
+    h_widths, h_skeleton = compute(copy.deepcopy(h_ventral_contour),
+                                   copy.deepcopy(h_dorsal_contour))
+    h_widths_b, h_skeleton_b = compute(copy.deepcopy(h_ventral_contour),
+                                       copy.deepcopy(h_dorsal_contour),
+                                       batch_size=8)
+
+    for w, w_b, s, s_b in zip(h_widths, h_widths_b, h_skeleton, h_skeleton_b):
+        if w is None:
+            assert(w_b is None and s_b is None)
+        else:
+            assert(np.allclose(w, w_b))
+            assert(np.allclose(s, s_b))
+
+
+def test_parallel_skeleton():
+    # Splitting the frames across worker processes should not change
+    # the skeleton, the widths, or the (smoothed in place) contours
+    compute = mv.prefeatures.pre_features.WormParsing.\
+        compute_skeleton_and_widths
+    h_ventral_contour, h_dorsal_contour = _example_h_contour()
+    h_ventral_contour_p = copy.deepcopy(h_ventral_contour)
+    h_dorsal_contour_p = copy.deepcopy(h_dorsal_contour)
+
+    h_widths, h_skeleton = compute(h_ventral_contour, h_dorsal_contour)
+    h_widths_p, h_skeleton_p = compute(h_ventral_contour_p,
+                                       h_dorsal_contour_p, workers=2)
+
+    for w, w_p, s, s_p in zip(h_widths, h_widths_p, h_skeleton, h_skeleton_p):
+        if w is None:
+            assert(w_p is None and s_p is None)
+        else:
+            assert(np.allclose(w, w_p))
+            assert(np.allclose(s, s_p))
+
+    for c, c_p in zip(h_ventral_contour + h_dorsal_contour,
+                      h_ventral_contour_p + h_dorsal_contour_p):
+        if c is not None:
+            assert(np.array_equal(c, c_p))
+
+
+def test_normalize_all_frames_dense():
+    # Normalizing frames that all have the same number of points, which
+    # is done for all frames at once, should match normalizing each frame
+    helpers = mv.prefeatures.pre_features_helpers.WormParserHelpers
+    h_skeleton, _ = _example_h_contour()
+    h_skeleton = [None if s is None else s[:, :30] for s in h_skeleton]
+    # Repeated points and NaN values
+    h_skeleton[1][:, 5] = h_skeleton[1][:, 4]
+    h_skeleton[2][0, 5] = np.NaN
+    widths = [None if s is None else np.linspace(50, 60, 30)
+              for s in h_skeleton]
+
+    skeleton = helpers.normalize_all_frames_xy(h_skeleton, 49)
+    norm_widths = helpers.normalize_all_frames(widths, h_skeleton, 49)
+
+    for frame_index, s in enumerate(h_skeleton):
+        if s is None:
+            assert(np.all(np.isnan(skeleton[:, :, frame_index])))
+            continue
+        cc = helpers.chain_code_lengths_cum_sum(s.T)
+        for i in range(2):
+            np.testing.assert_array_equal(
+                skeleton[:, i, frame_index],
+                helpers.normalize_parameter(s[i], cc, 49))
+        np.testing.assert_array_equal(
+            norm_widths[:, frame_index],
+            helpers.normalize_parameter(widths[frame_index], cc, 49))
+
+
+def test_compute_angles_dense():
+    # Angles of a (49,2,n) skeleton, which are computed for all frames at
+    # once, should match the angles computed one frame at a time
+    helpers = mv.prefeatures.pre_features_helpers.WormParserHelpers
+    parsing = mv.prefeatures.pre_features.WormParsing
+    h_skeleton, _ = _example_h_contour()
+    skeleton = helpers.normalize_all_frames_xy(h_skeleton, 49)
+    skeleton[10, 1, 2] = np.NaN
+
+    angles = parsing.compute_angles(skeleton)
+
+    for frame_index in range(skeleton.shape[2]):
+        cur_skeleton = skeleton[:, :, frame_index].T
+        if np.all(np.isnan(cur_skeleton)):
+            assert(np.all(np.isnan(angles[:, frame_index])))
+            continue
+        frame_angles = parsing._h_compute_frame_angles(cur_skeleton)
+        cc = helpers.chain_code_lengths_cum_sum(cur_skeleton.T)
+        np.testing.assert_array_equal(
+            angles[:, frame_index],
+            helpers.normalize_parameter(frame_angles, cc, 49))
+
+
+def test_ragged_frames():
+    RaggedFrames = mv.prefeatures.ragged_frames.RaggedFrames
+    h_ventral_contour, h_dorsal_contour = _example_h_contour()
+
+    frames = RaggedFrames.from_list(h_ventral_contour)
+    assert(len(frames) == len(h_ventral_contour))
+    for frame, h_frame in zip(frames, h_ventral_contour):
+        if h_frame is None:
+            assert(frame is None)
+        else:
+            assert(np.array_equal(frame, h_frame))
+
+    # Frames are views into the buffer
+    frames[1][0, 0] = -1
+    assert(frames.data[0, frames.offsets[1]] == -1)
+
+    # Skeletonizing RaggedFrames, which smooths the contours in place
+    compute = mv.prefeatures.pre_features.WormParsing.\
+        compute_skeleton_and_widths
+    h_ventral_contour = RaggedFrames.from_list(h_ventral_contour)
+    h_dorsal_contour = RaggedFrames.from_list(h_dorsal_contour)
+    h_ventral_contour_l = copy.deepcopy(h_ventral_contour.to_list())
+    h_dorsal_contour_l = copy.deepcopy(h_dorsal_contour.to_list())
+    h_widths, h_skeleton = compute(h_ventral_contour, h_dorsal_contour,
+                                   workers=2)
+    h_widths_l, h_skeleton_l = compute(h_ventral_contour_l,
+                                       h_dorsal_contour_l)
+    for s, s_l in zip(h_skeleton, h_skeleton_l):
+        assert((s is None and s_l is None) or np.allclose(s, s_l))
+    for c, c_l in zip(h_ventral_contour, h_ventral_contour_l):
+        assert((c is None and c_l is None) or np.array_equal(c, c_l))
+
+    # (k,2,n) arrays, with missing frames
+    skeleton = mv.prefeatures.pre_features_helpers.WormParserHelpers.\
+        normalize_all_frames_xy(h_skeleton, 49)
+    frames = RaggedFrames.from_array(skeleton)
+    dense_skeleton, frame_I = frames.dense_frames()
+    assert(np.array_equal(frame_I, [i for i, s in enumerate(h_skeleton)
+                                    if s is not None]))
+    assert(np.array_equal(dense_skeleton, skeleton[:, :, frame_I]))
+
+
+def test_schafer_file_frames(tmpdir):
+    # Frames stored as HDF5 references, as in the Schafer lab files, read
+    # all at once or lazily
+    import h5py
+    hdf5_frames = mv.prefeatures.hdf5_frames
+    h_ventral_contour, _ = _example_h_contour()
+    is_valid = np.array([c is not None for c in h_ventral_contour])
+    file_path = str(tmpdir.join('frames.hdf5'))
+
+    with h5py.File(file_path, 'w') as h:
+        refs = np.empty((len(is_valid), 1), dtype=object)
+        empty_ref = h.create_dataset('empty', data=np.zeros(2)).ref
+        # Stored in the file in reverse order
+        for frame_index in reversed(range(len(is_valid))):
+            c = h_ventral_contour[frame_index]
+            refs[frame_index, 0] = empty_ref if c is None else \
+                h.create_dataset('frame_%d' % frame_index, data=c).ref
+        h.create_dataset('refs', data=refs,
+                         dtype=h5py.special_dtype(ref=h5py.Reference))
+
+    with h5py.File(file_path, 'r') as h:
+        frames = hdf5_frames.read_referenced_frames(h, h['refs'][()],
+                                                    is_valid, batch_size=4)
+    for frame, c in zip(frames, h_ventral_contour):
+        assert((frame is None and c is None) or np.array_equal(frame, c))
+
+    h = h5py.File(file_path, 'r')
+    lazy_frames = hdf5_frames.LazyReferencedFrames(h, h['refs'][()],
+                                                   is_valid)
+    assert(np.array_equal(lazy_frames[-1], h_ventral_contour[-1]))
+    lazy_frames[1][0, 0] = -1
+    assert(lazy_frames[1][0, 0] == -1)
+    frames = lazy_frames.load()
+    assert(frames[1][0, 0] == -1)
+    assert(np.array_equal(frames[2], h_ventral_contour[2]))
+    lazy_frames.close()
+
+
+def test_array_store(tmpdir):
+    # A NormalizedWorm saved to an array store, and loaded back with the
+    # arrays memory-mapped
+    h_ventral_contour, h_dorsal_contour = _example_h_contour()
+    bw = mv.BasicWorm.from_contour_factory(h_ventral_contour,
+                                           h_dorsal_contour)
+    nw = mv.NormalizedWorm.from_BasicWorm_factory(bw)
+    nw.video_info.fps = 30
+    directory = str(tmpdir.join('nw'))
+
+    nw.save_to_array_store(directory)
+    nw2 = mv.NormalizedWorm.from_array_store(directory)
+
+    assert(isinstance(nw2.skeleton, np.memmap))
+    assert(nw2.skeleton.shape == nw.skeleton.shape)
+    for a in ['skeleton', 'ventral_contour', 'dorsal_contour', 'widths']:
+        np.testing.assert_array_equal(getattr(nw2, a), getattr(nw, a))
+    np.testing.assert_array_equal(nw2.video_info.frame_code,
+                                  nw.video_info.frame_code)
+    assert(nw2.video_info.fps == 30)
+    np.testing.assert_array_equal(nw2.angles, nw.angles)
+
+
+def test_normalized_worm_HDF5(tmpdir):
+    import h5py
+    h_ventral_contour, h_dorsal_contour = _example_h_contour()
+    bw = mv.BasicWorm.from_contour_factory(h_ventral_contour,
+                                           h_dorsal_contour)
+    nw = mv.NormalizedWorm.from_BasicWorm_factory(bw)
+    nw.video_info.video_name = 'example'
+
+    for compression in [None, 'gzip']:
+        file_path = str(tmpdir.join('nw_%s.hdf5' % compression))
+        nw.save_to_HDF5(file_path, compression=compression)
+        nw2 = mv.NormalizedWorm.from_HDF5_file_factory(file_path)
+        for a in ['skeleton', 'ventral_contour', 'dorsal_contour', 'widths']:
+            np.testing.assert_array_equal(getattr(nw2, a), getattr(nw, a))
+        np.testing.assert_array_equal(nw2.video_info.frame_code,
+                                      nw.video_info.frame_code)
+        assert(nw2.video_info.video_name == 'example')
+
+    # Files from a newer version of the format are refused
+    with h5py.File(file_path, 'r+') as h:
+        h.attrs['format_version'] = mv.NormalizedWorm.HDF5_FORMAT_VERSION + 1
+    try:
+        mv.NormalizedWorm.from_HDF5_file_factory(file_path)
+        assert(False)
+    except Exception as e:
+        assert('newer' in str(e))
+
+
+def test_binary_serializer(tmpdir):
+    # The binary format keeps the same nested objects as the JSON format,
+    # and load_from_binary also reads JSON files
+    from collections import namedtuple, OrderedDict
+    h_ventral_contour, h_dorsal_contour = _example_h_contour()
+    bw = mv.BasicWorm.from_contour_factory(h_ventral_contour,
+                                           h_dorsal_contour)
+    bw.video_info.frame_code = np.arange(len(h_ventral_contour))
+    Point = namedtuple('Point', ['x', 'y'])
+    bw.extra = OrderedDict([('b', (1, np.arange(3.))),
+                            ('a', Point(np.eye(2), [None, 'z']))])
+
+    bw.save_to_JSON(str(tmpdir.join('bw.json')))
+    for compress in [False, True]:
+        bw.save_to_binary(str(tmpdir.join('bw.npz')), compress=compress)
+        for file_name in ['bw.json', 'bw.npz']:
+            bw2 = mv.BasicWorm()
+            bw2.load_from_binary(str(tmpdir.join(file_name)))
+            for c, c2 in zip(bw.h_ventral_contour, bw2._h_ventral_contour):
+                assert((c is None and c2 is None) or np.array_equal(c, c2))
+            np.testing.assert_array_equal(bw2.video_info.frame_code,
+                                          bw.video_info.frame_code)
+            assert(list(bw2.extra.keys()) == ['b', 'a'])
+            assert(mv.prefeatures.basic_worm.nested_equal(bw2.extra,
+                                                          bw.extra))
+            assert(bw2.extra['a'].y == [None, 'z'])
+
+
+def _example_nw(n_frames=300):
+    """
+    A NormalizedWorm of a worm moving forward with a travelling wave,
+    with a few dropped frames.
+
+    """
+    s = np.linspace(0, 1, 49)[:, None]
+    t = np.arange(n_frames)[None, :]
+    x = 1000 * s + 2.0 * t
+    y = 80 * np.sin(2 * np.pi * (1.5 * s - t / 25.))
+    skeleton = np.stack((x, y), axis=1)
+    widths = 60 * np.sin(np.pi * s) ** 0.5 * np.ones((1, n_frames)) + 1e-3
+
+    normal = np.stack((-np.gradient(y, axis=0), np.gradient(x, axis=0)),
+                      axis=1)
+    normal /= np.sqrt(np.sum(normal ** 2, axis=1))[:, None, :]
+    ventral_contour = skeleton + normal * widths[:, None, :] / 2
+    dorsal_contour = skeleton - normal * widths[:, None, :] / 2
+
+    for a in (skeleton, widths, ventral_contour, dorsal_contour):
+        a[..., 50:55] = np.NaN
+
+    return mv.NormalizedWorm.from_normalized_array_factory(
+        skeleton, widths, ventral_contour, dorsal_contour)
+
+
+def _assert_same_value(value1, value2):
+    if hasattr(value1, '__dict__'):
+        # e.g. an EventListWithFeatures
+        assert(sorted(vars(value1)) == sorted(vars(value2)))
+        for key in vars(value1):
+            _assert_same_value(getattr(value1, key), getattr(value2, key))
+    elif value1 is None:
+        assert(value2 is None)
+    else:
+        np.testing.assert_array_equal(value1, value2)
+
+
+def _assert_same_features(wf1, wf2):
+    assert(list(wf1._features) == list(wf2._features))
+    for name in wf1._features:
+        _assert_same_value(getattr(wf1._features[name], 'value', None),
+                           getattr(wf2._features[name], 'value', None))
+
+
+def test_parallel_features():
+    import warnings
+    nw = _example_nw()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        wf = mv.WormFeatures(nw)
+        wf_p = mv.WormFeatures(nw, workers=4)
+    _assert_same_features(wf, wf_p)
+
+    graph = wf.get_dependency_graph()
+    assert('locomotion.velocity.midbody' in
+           graph['locomotion.velocity.midbody.speed'])
+
+    feature_names, critical_time, total_time = wf_p.get_critical_path()
+    assert(0 < critical_time <= total_time)
+    for name, next_name in zip(feature_names[:-1], feature_names[1:]):
+        assert(name in graph[next_name])
+
+
+def test_compute_many(tmpdir):
+    # Worms given as objects or paths, with one that fails to load
+    import warnings
+    nw = _example_nw()
+    file_path = str(tmpdir.join('nw.hdf5'))
+    nw.save_to_HDF5(file_path)
+    inputs = [file_path, str(tmpdir.join('missing.hdf5')), nw]
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        wf = mv.WormFeatures(nw)
+        results = list(mv.WormFeatures.compute_many(inputs, workers=2))
+
+    assert(sorted(index for index, _, _ in results) == [0, 1, 2])
+    for index, wf_i, error in results:
+        if index == 1:
+            assert(wf_i is None and 'not found' in error)
+        else:
+            assert(error is None)
+            _assert_same_features(wf, wf_i)
+            assert(wf_i.nw is (nw if index == 2 else None))
+
+
+def test_feature_cache(tmpdir):
+    # Features taken from the cache should be the same as those computed,
+    # and a change in the options should not use the cached features
+    import warnings
+    nw = _example_nw()
+    cache = mv.FeatureCache(str(tmpdir.join('cache')))
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        wf = mv.WormFeatures(nw, cache=cache)
+        n_entries = len(os.listdir(cache.directory))
+        assert(n_entries > 0)
+        wf_c = mv.WormFeatures(nw, cache=cache)
+        assert(len(os.listdir(cache.directory)) == n_entries)
+        _assert_same_features(wf, wf_c)
+
+        options = mv.FeatureProcessingOptions()
+        options.posture.n_eigenworms_use = 5
+        mv.WormFeatures(nw, options, cache=cache)
+        assert(len(os.listdir(cache.directory)) > n_entries)
+
+    # Evicting the least recently used entries
+    cache.max_size = cache.size // 2
+    key = wf.specs['morphology.length'].name
+    cache.put('recent', wf._features[key])
+    assert(cache.size <= cache.max_size)
+    assert(cache.get('recent') is not None)
+    assert(cache.get('missing') is None)
+
+    # Clearing also removes the temporary files of crashed writers, but
+    # not those being written
+    stale_path = os.path.join(cache.directory, 'stale.tmp')
+    writing_path = os.path.join(cache.directory, 'writing.tmp')
+    for path in (stale_path, writing_path):
+        open(path, 'wb').close()
+    old = os.path.getmtime(stale_path) - 2 * cache.max_temp_age
+    os.utime(stale_path, (old, old))
+    cache.clear()
+    assert(os.listdir(cache.directory) == ['writing.tmp'])
+    assert(cache.size == 0)
+
+
+def test_lazy_features():
+    # Only the requested feature and its dependencies are computed
+    import warnings
+    nw = _example_nw()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        wf = mv.WormFeatures(nw)
+        wf_l = mv.WormFeatures(nw, lazy=True)
+        assert(len(wf_l._features) == 0)
+
+        motion_mode = wf_l.get_features('locomotion.motion_mode')
+        computed = set(wf_l.timer.names)
+        assert('locomotion.motion_mode' in computed)
+        assert('posture.eigen_projection' not in computed)
+        assert(computed == set(wf_l._features))
+        _assert_same_value(motion_mode.value,
+                           wf._features['locomotion.motion_mode'].value)
+
+        # Iterating computes the remaining features
+        names = [f.name for f in wf_l]
+    assert(names == [f.name for f in wf])
+
+
+def test_select_features():
+    select = mv.select_feature_specs
+    names = list(select(names='locomotion.velocity.*.speed').feature_name)
+    assert('locomotion.velocity.midbody.speed' in names)
+    assert(all(name.endswith('.speed') for name in names))
+    assert(list(select(regex=r'^posture\.eccentricity$').feature_name) ==
+           ['posture.eccentricity'])
+    specs = select(query="category == 'posture'")
+    assert(len(specs) > 0 and all(specs.category == 'posture'))
+    assert(not any(specs.is_temporary))
+
+    # Only the selected features, and the features they need, are computed
+    import warnings
+    nw = _example_nw()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        wf = mv.WormFeatures(nw, specs=['locomotion.velocity.*.speed',
+                                        'posture.eccentricity'])
+    assert(sorted(f.name for f in wf) ==
+           sorted(names + ['posture.eccentricity']))
+    assert('posture.eccentricity_and_orientation' in wf._features)
+    assert('posture.eigen_projection' not in wf._features)
+
+
+def test_contour_moments():
+    # The central moments of rotated rectangles, in either orientation
+    posture_features = mv.features.posture_features
+    length, width = 10.0, 2.0
+    corners = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]]) * \
+        [length / 2, width / 2]
+    angles = np.array([0, 0.3, 1.2])
+    rotations = np.array([[np.cos(angles), -np.sin(angles)],
+                          [np.sin(angles), np.cos(angles)]])
+    # (4,2,3)
+    contour = np.einsum('ij...,kj->ki...', rotations, corners) + \
+        np.array([5, -3])[:, None]
+
+    for c in [contour, contour[::-1]]:
+        mu11, mu20, mu02 = posture_features._h_contour_moments(c)
+        major = length ** 3 * width / 12
+        minor = length * width ** 3 / 12
+        assert(np.allclose(mu20, major * np.cos(angles) ** 2 +
+                           minor * np.sin(angles) ** 2))
+        assert(np.allclose(mu02, major * np.sin(angles) ** 2 +
+                           minor * np.cos(angles) ** 2))
+        assert(np.allclose(mu11, (major - minor) * np.sin(angles) *
+                           np.cos(angles)))
+
+    mu11, mu20, mu02 = posture_features._h_points_moments(contour)
+    for i in range(contour.shape[2]):
+        cov = np.cov(contour[:, :, i].T)
+        assert(np.allclose([mu11[i], mu20[i], mu02[i]],
+                           [cov[0, 1], cov[0, 0], cov[1, 1]]))
+
+
+def test_resample_evenly():
+    # The batched resampling used for the wavelengths should match
+    # resampling each frame on its own
+    posture_features = mv.features.posture_features
+    rng = np.random.RandomState(0)
+    x = np.cumsum(rng.rand(49, 20) + 0.01, axis=0) - 10
+    x[:, ::3] = x[::-1, ::3]
+    y = rng.randn(49, 20)
+    ds = np.abs(x[-1] - x[0]) / 48
+
+    samples, n_samples = posture_features._h_resample_evenly(x, y, ds)
+    for frame_index in range(x.shape[1]):
+        xx = x[:, frame_index]
+        yy = y[:, frame_index]
+        if xx[0] > xx[-1]:
+            xx = xx[::-1]
+            yy = yy[::-1]
+        iwwx = mv.utils.colon(xx[0], ds[frame_index], xx[-1])
+        n = n_samples[frame_index]
+        np.testing.assert_array_equal(samples[frame_index, :n],
+                                      np.interp(iwwx, xx, yy))
+        assert(np.all(samples[frame_index, n:] == 0))
+
+
+def test_separated_peaks():
+    # Peaks of each row of an array, found one row at a time or all at
+    # once, for maxima and minima, with NaN values
+    rng = np.random.RandomState(0)
+    x = rng.rand(20, 100)
+    x[3, 10:13] = np.NaN
+    for use_max, value_cutoff in [(True, np.percentile(x, 30, axis=1)),
+                                  (False, np.full(20, np.inf))]:
+        is_peak = mv.utils.separated_peaks_2D(x.T, 5, use_max,
+                                              value_cutoff, axis=0).T
+        for row_index in range(x.shape[0]):
+            peaks, indices = mv.utils.separated_peaks(
+                x[row_index], 5, use_max, value_cutoff[row_index])
+            indices = np.sort(indices)
+            np.testing.assert_array_equal(np.flatnonzero(is_peak[row_index]),
+                                          indices)
+            # No other point of the window of a peak is beyond it
+            for i in indices:
+                window = x[row_index, max(i - 4, 0):i + 4]
+                extreme = np.max(window) if use_max else np.min(window)
+                assert(extreme == x[row_index, i])
+
+
+def _bend_data_frame_by_frame(avg_bend_angles, bound_info, options, fps):
+    """
+    The bend amplitudes and frequencies computed one frame at a time, as
+    BendHelper.h__getBendData used to.
+    """
+    fps = int(fps)
+    max_freq = options.max_frequency(fps)
+    fft_max_I = int(options.fft_n_samples / 2)
+    freq_scalar = (fps / 2) * 1 / (fft_max_I - 1)
+    INIT_MAX_I_FOR_BANDWIDTH = \
+        round(options.initial_max_I_pct * max_freq / freq_scalar)
+
+    def get_bandwidth(data_win_length, fft_data, max_peak_I):
+        peakWinSize = round(np.sqrt(data_win_length))
+        peak_start_I = peak_end_I = np.array([])
+        if max_peak_I < INIT_MAX_I_FOR_BANDWIDTH:
+            min_peaks_I = mv.utils.separated_peaks(
+                fft_data[:INIT_MAX_I_FOR_BANDWIDTH], peakWinSize,
+                use_max=False, value_cutoff=np.inf)[1]
+            peak_start_I = min_peaks_I[min_peaks_I < max_peak_I][:1]
+            peak_end_I = min_peaks_I[min_peaks_I > max_peak_I][:1]
+        # An empty peak_end_I is never rerun
+        if (peak_end_I.size == 0) | \
+                (peak_end_I + peakWinSize >= INIT_MAX_I_FOR_BANDWIDTH):
+            min_peaks_I = mv.utils.separated_peaks(
+                fft_data, peakWinSize, use_max=False, value_cutoff=np.inf)[1]
+            peak_start_I = min_peaks_I[min_peaks_I < max_peak_I][:1]
+            peak_end_I = min_peaks_I[min_peaks_I > max_peak_I][:1]
+        if peak_start_I.size == 0 or peak_end_I.size == 0:
+            return None
+        return int(peak_start_I[0]), int(peak_end_I[0])
+
+    amps = np.full(len(avg_bend_angles), np.NaN)
+    freqs = np.full(len(avg_bend_angles), np.NaN)
+    for iFrame in np.flatnonzero(~bound_info.is_bad_mask):
+        windowed_data = avg_bend_angles[
+            int(bound_info.left_bounds[iFrame]):
+            int(bound_info.right_bounds[iFrame])]
+        fft_data = abs(np.fft.rfft(windowed_data, options.fft_n_samples))
+        maxPeakI = np.argmax(fft_data)
+        maxPeak = fft_data[maxPeakI]
+        unsigned_freq = freq_scalar * maxPeakI
+        if maxPeakI == 0 or \
+                not (options.min_frequency <= unsigned_freq <= max_freq):
+            continue
+        bandwidth = get_bandwidth(len(windowed_data), fft_data, maxPeakI)
+        if bandwidth is None:
+            continue
+        peakStartI, peakEndI = bandwidth
+        fenergy = fft_data**2
+        peak_amplitud_treshold = options.max_amplitude_pct_bandwidth * maxPeak
+        if not (fft_data[peakStartI] > peak_amplitud_treshold or
+                fft_data[peakEndI] > peak_amplitud_treshold or
+                np.sum(fenergy[peakStartI:peakEndI]) <
+                options.peak_energy_threshold * np.sum(fenergy)):
+            dataSign = np.sign(np.nanmean(windowed_data))
+            amps[iFrame] = (2 * maxPeak / len(windowed_data)) * dataSign
+            freqs[iFrame] = unsigned_freq * dataSign
+
+    return amps, freqs
+
+
+def test_bend_data():
+    # The STFTs of many frames at once should give the same bends as
+    # computing them one frame at a time, on noisy data with frames whose
+    # peaks can't be bounded
+    class BoundInfo(object):
+        pass
+
+    rng = np.random.RandomState(0)
+    n_frames = 600
+    t = np.arange(n_frames) / 25.
+    avg_bend_angles = 20 * np.sin(2 * np.pi * 0.4 * t) + \
+        15 * rng.randn(n_frames)
+    bound_info = BoundInfo()
+    half_widths = rng.randint(5, 60, n_frames)
+    bound_info.left_bounds = np.arange(n_frames) - half_widths
+    bound_info.right_bounds = np.arange(n_frames) + half_widths + 1
+    bound_info.is_bad_mask = (bound_info.left_bounds < 0) | \
+        (bound_info.right_bounds > n_frames)
+    options = mv.FeatureProcessingOptions().locomotion.crawling_bends
+
+    amps, freqs = mv.features.locomotion_bends.BendHelper().h__getBendData(
+        avg_bend_angles, bound_info, options, 25)
+    expected_amps, expected_freqs = _bend_data_frame_by_frame(
+        avg_bend_angles, bound_info, options, 25)
+
+    assert(np.sum(~np.isnan(expected_amps)) > 0)
+    np.testing.assert_allclose(amps, expected_amps, rtol=1e-12)
+    np.testing.assert_allclose(freqs, expected_freqs, rtol=1e-12)
+
+
+def test_count_kinks():
+    # Stretches of the same sign of each frame, with NaN values at the
+    # ends counting towards the first and last stretches
+    count_kinks = mv.features.posture_features._h_count_kinks
+    x = np.ones((10, 7))
+    x[5:, 0] = -1                       # 5 and 5 + 1
+    x[:3, 1] = np.NaN                   # 10 + 1
+    x[:3, 2] = np.NaN                   # 3 + 3 and 4 + 1
+    x[3:6, 2] = -1
+    x[8:, 3] = np.NaN                   # 8 + 2
+    x[5, 4] = np.NaN                    # NaN in the middle, not handled
+    x[5, 5] = 0                         # zero, not handled
+    x[:, 6] = np.NaN                    # no stretches
+    n_kinks = count_kinks(x, 5)
+    np.testing.assert_array_equal(n_kinks, [2, 1, 2, 1, np.NaN, np.NaN, 0])
+    n_kinks = count_kinks(x, 6)
+    np.testing.assert_array_equal(n_kinks, [1, 1, 1, 1, np.NaN, np.NaN, 0])
+
+
+def test_get_runs():
+    for mask, expected_starts, expected_stops in [
+            ([], [], []),
+            ([False, False], [], []),
+            ([True], [0], [1]),
+            ([False, True, True, False, False, True, True, True],
+             [1, 5], [3, 8]),
+            ([True, False, True], [0, 2], [1, 3])]:
+        starts, stops, lengths = mv.utils.get_runs(np.array(mask, dtype=bool))
+        np.testing.assert_array_equal(starts, expected_starts)
+        np.testing.assert_array_equal(stops, expected_stops)
+        np.testing.assert_array_equal(lengths, stops - starts)
+
+    # Events, with the NaN frames at the ends swallowed into the first
+    # and last events
+    event_data = np.array([np.NaN, 1, 0, 1, 1, 0, 0, 1, np.NaN])
+    event_candidates = mv.features.events.EventFinder().\
+        get_start_stop_indices(event_data, event_data > 0.5)
+    np.testing.assert_array_equal(event_candidates,
+                                  [[0, 1], [3, 4], [7, 8]])
+
+    # Only runs of at most 2 NaN values are interpolated
+    a = np.array([10, 12, 15, np.NaN, 17, np.NaN, np.NaN, np.NaN, -5])
+    np.testing.assert_array_equal(
+        mv.utils.interpolate_with_threshold(a, 2),
+        [10, 12, 15, 16, 17, np.NaN, np.NaN, np.NaN, -5])
+
+
+def test_interpolate_with_threshold_2D():
+    # All rows at once should match each row on its own, whether the rows
+    # have the same NaN values or not, with and without extrapolation
+    interpolate_with_threshold = mv.utils.interpolate_with_threshold
+    rng = np.random.RandomState(0)
+    shared = rng.randn(3, 40)
+    shared[:, rng.rand(40) < 0.4] = np.NaN
+    mixed = rng.randn(3, 40)
+    mixed[rng.rand(3, 40) < 0.4] = np.NaN
+    for array in [shared, mixed]:
+        for threshold in [None, 2]:
+            for extrapolate in [False, True]:
+                new_array = mv.utils.interpolate_with_threshold_2D(
+                    array, threshold, extrapolate)
+                for row_index in range(array.shape[0]):
+                    np.testing.assert_array_equal(
+                        new_array[row_index],
+                        interpolate_with_threshold(array[row_index],
+                                                   threshold,
+                                                   extrapolate=extrapolate))
+
+    a = np.array([np.NaN, np.NaN, 1, 2, np.NaN, 5, np.NaN])
+    np.testing.assert_allclose(
+        interpolate_with_threshold(a, extrapolate=True),
+        [-1, 0, 1, 2, 3.5, 5, 6.5])
+    np.testing.assert_allclose(
+        interpolate_with_threshold(a, 1, extrapolate=True),
+        [np.NaN, np.NaN, 1, 2, 3.5, 5, 6.5])
+
+
+def test_event_distances():
+    # The distances during and between events, from the cumulative
+    # distance, should match summing the distance of their frames
+    rng = np.random.RandomState(0)
+    distance_per_frame = rng.randn(200)
+    distance_per_frame[rng.rand(200) < 0.2] = np.NaN
+    starts = np.sort(rng.choice(200, 20, replace=False))
+    ends = np.minimum(starts + rng.randint(0, 15, 20), 199)
+    event_list = mv.features.events.EventList(np.column_stack((starts,
+                                                               ends)))
+    events = mv.features.events.EventListWithFeatures(
+        30, event_list, distance_per_frame, compute_distance_during_event=True)
+
+    for i in range(20):
+        np.testing.assert_allclose(
+            events.distance_during_events[i],
+            np.nansum(distance_per_frame[starts[i]:ends[i] + 1]), atol=1e-12)
+    for i in range(19):
+        # Overlapping events have nothing in between
+        np.testing.assert_allclose(
+            events.distance_between_events[i],
+            np.nansum(distance_per_frame[ends[i] + 1:starts[i + 1]]),
+            atol=1e-12)
+
+
+def test_load_eigen_worms(tmpdir):
+    import h5py
+    load_eigen_worms = mv.features.posture_features.load_eigen_worms
+
+    eigen_worms = load_eigen_worms()
+    assert(eigen_worms.shape == (7, 48))
+    # Only read once
+    assert(load_eigen_worms() is eigen_worms)
+    assert(not eigen_worms.flags.writeable)
+
+    # Eigenworms of another strain
+    file_path = str(tmpdir.join('eigen_worms.mat'))
+    other_eigen_worms = np.random.RandomState(0).randn(3, 48)
+    with h5py.File(file_path, 'w') as h:
+        h.create_dataset('eigenWorms', data=other_eigen_worms.T)
+    np.testing.assert_array_equal(load_eigen_worms(file_path),
+                                  other_eigen_worms)
+    assert(load_eigen_worms(file_path) is load_eigen_worms(file_path))
+
+
+def test_sparse_arena():
+    # Counting the time spent in only the occupied cells of the arena
+    # should give the same durations as counting it in all cells
+    import warnings
+    nw = _example_nw()
+    options = mv.FeatureProcessingOptions()
+    options.path.sparse_arena = True
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        duration = mv.WormFeatures(nw, specs='path.duration*').\
+            get_features('path.duration')
+        duration_s = mv.WormFeatures(nw, options, specs='path.duration*').\
+            get_features('path.duration')
+
+    for name in ['worm', 'head', 'midbody', 'tail']:
+        element = getattr(duration, name)
+        element_s = getattr(duration_s, name)
+        np.testing.assert_array_equal(element.indices, element_s.indices)
+        np.testing.assert_array_equal(element.times, element_s.times)
+        # Each cell at most once per frame
+        assert(np.max(element.times) * nw.video_info.fps <=
+               nw.skeleton.shape[2])
+
+
 def test_ttest():
     # From http://docs.scipy.org/doc/scipy-0.15.1/reference/generated/
     # scipy.stats.ttest_ind.html
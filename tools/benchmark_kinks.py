@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the posture.kinks feature.
+
+Compares smoothing the bend angles and counting the kinks one frame at a
+time (how posture_features.Kinks used to compute them) against
+posture_features.Kinks, which processes all frames at once, and checks
+that both give the same number of kinks.
+
+Synthetic bend angles are used so that no example data is needed. They
+include frames with NaN values at the ends of the worm, in the middle of
+the worm and everywhere.
+
+Usage:
+    python benchmark_kinks.py [n_frames]
+
+"""
+import sys
+import time
+
+import numpy as np
+import scipy.ndimage.filters as filters
+
+# We must add .. to the path so that we can perform the
+# import of open_worm_analysis_toolbox while running this as
+# a top-level script (i.e. with __name__ = '__main__')
+sys.path.append('..')
+from open_worm_analysis_toolbox import utils
+from open_worm_analysis_toolbox.features.feature_processing_options import \
+    FeatureProcessingOptions
+from open_worm_analysis_toolbox.features.posture_features import Kinks
+
+
+class FakeWormFeatures(object):
+    """
+    The parts of a WormFeatures that Kinks uses.
+    """
+
+    def __init__(self, angles):
+        self.nw = type('FakeNormalizedWorm', (object,), {})()
+        self.nw.angles = angles
+        self.options = FeatureProcessingOptions()
+        self.timer = utils.ElementTimer()
+
+
+def make_angles(n_frames, n_angles=49):
+    """
+    A travelling wave of bend angles, with the first and last angles NaN
+    as in NormalizedWorm.angles, some noise and some damaged frames.
+    """
+    rng = np.random.RandomState(0)
+    t = np.arange(n_frames)[None, :]
+    s = np.linspace(0, 1, n_angles)[:, None]
+    angles = 40 * np.sin(2 * np.pi * (rng.uniform(0.5, 3, (1, n_frames)) *
+                                      s + 0.02 * t)) + \
+        10 * rng.randn(n_angles, n_frames)
+    angles[0] = np.nan
+    angles[-1] = np.nan
+
+    # Longer stretches of NaN values at the ends
+    n_head = rng.randint(0, 6, n_frames) * (rng.rand(n_frames) < 0.1)
+    n_tail = rng.randint(0, 6, n_frames) * (rng.rand(n_frames) < 0.1)
+    angles[np.arange(n_angles)[:, None] < n_head] = np.nan
+    angles[np.arange(n_angles)[::-1, None] < n_tail] = np.nan
+
+    # NaN values in the middle of the worm, and missing frames
+    angles[20, rng.rand(n_frames) < 0.01] = np.nan
+    angles[:, rng.rand(n_frames) < 0.05] = np.nan
+    return angles
+
+
+def kinks_frame_by_frame(angles, options):
+    """
+    The number of kinks, smoothing and counting one frame at a time.
+    """
+    n_angles = angles.shape[0]
+    length_threshold = np.round(
+        n_angles * options.posture.kink_length_threshold_pct)
+    half_length_thr = np.round(length_threshold / 2)
+    gauss_filter = utils.gausswin(
+        half_length_thr * 2 + 1) / half_length_thr
+
+    n_frames = angles.shape[1]
+    n_kinks_all = np.full(n_frames, np.nan, dtype=float)
+    for iFrame in (~np.all(np.isnan(angles), axis=0)).nonzero()[0]:
+        smoothed_bend_angles = filters.convolve1d(
+            angles[:, iFrame], gauss_filter, cval=0, mode='constant')
+        n = smoothed_bend_angles.shape[0]
+
+        with np.errstate(invalid='ignore'):
+            dataSign = np.sign(smoothed_bend_angles)
+        if np.any(np.equal(dataSign, 0)):
+            continue
+
+        sign_change_I = (
+            np.not_equal(dataSign[1:], dataSign[0:-1])).nonzero()[0]
+        end_I = np.concatenate((sign_change_I, [n]))
+        start_I = np.concatenate(([0], sign_change_I + 1))
+
+        keep_mask = np.logical_not(np.isnan(smoothed_bend_angles[start_I]))
+        start_I = start_I[keep_mask]
+        end_I = end_I[keep_mask]
+
+        if start_I.size != 0 and \
+           np.any(np.isnan(smoothed_bend_angles[start_I[0]:end_I[-1]])):
+            continue
+
+        lengths = end_I - start_I + 1
+        if lengths.size != 0:
+            if start_I[0] != 0:
+                lengths[0] = end_I[0] + 1
+            if end_I[-1] != n:
+                lengths[-1] = n - start_I[-1]
+
+        n_kinks_all[iFrame] = np.sum(lengths >= length_threshold)
+
+    return n_kinks_all
+
+
+def main():
+    n_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    angles = make_angles(n_frames)
+    wf = FakeWormFeatures(angles)
+
+    print("%d frames" % n_frames)
+
+    start = time.time()
+    expected = kinks_frame_by_frame(angles, wf.options)
+    elapsed_old = time.time() - start
+    print("%-24s %8.3f s" % ('frame by frame', elapsed_old))
+
+    start = time.time()
+    n_kinks = Kinks(wf, 'posture.kinks').value
+    elapsed_new = time.time() - start
+    print("%-24s %8.3f s" % ('all frames at once', elapsed_new))
+    print("speedup: %.1fx" % (elapsed_old / elapsed_new))
+
+    np.testing.assert_array_equal(n_kinks, expected)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of loading a BasicWorm from a Schafer lab (MATLAB 7.3) file.
+
+Compares resolving the HDF5 reference of each frame through the high level
+h5py interface (how BasicWorm.from_schafer_file_factory used to read the
+frames) against BasicWorm.from_schafer_file_factory, which resolves all
+references with the low level interface, and against its lazy mode.
+
+A synthetic file with the same layout as the Schafer files is written to
+a temporary directory, so that no example data is needed.
+
+Usage:
+    python benchmark_schafer_load.py [n_frames]
+
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+import h5py
+
+# We must add .. to the path so that we can perform the
+# import of open_worm_analysis_toolbox while running this as
+# a top-level script (i.e. with __name__ = '__main__')
+sys.path.append('..')
+from open_worm_analysis_toolbox.prefeatures.basic_worm import BasicWorm
+
+
+def write_schafer_file(file_path, n_frames):
+    """
+    Each frame of the skeleton and of the two sides of the contour is
+    its own dataset in the '#refs#' group, pointed to by the reference
+    arrays 'all_skeletons', 'all_vulva_contours' and
+    'all_non_vulva_contours', of shape (n_frames,1).
+    """
+    rng = np.random.RandomState(0)
+    is_valid = rng.rand(n_frames) > 0.05
+    names = ['all_skeletons', 'all_vulva_contours', 'all_non_vulva_contours']
+
+    with h5py.File(file_path, 'w') as h:
+        refs_group = h.create_group('#refs#')
+        empty_ref = refs_group.create_dataset('empty',
+                                              data=np.zeros(2)).ref
+        refs = dict((name, np.empty((n_frames, 1), dtype=object))
+                    for name in names)
+        for frame_index in range(n_frames):
+            for name in names:
+                if not is_valid[frame_index]:
+                    refs[name][frame_index, 0] = empty_ref
+                    continue
+                n_points = 49 if name == 'all_skeletons' else \
+                    90 + rng.randint(20)
+                t = np.linspace(0, 1, n_points)
+                frame = np.vstack((1000 * t + frame_index,
+                                   80 * np.sin(6 * t + frame_index / 25.)))
+                dataset = refs_group.create_dataset(
+                    '%s_%d' % (name, frame_index), data=frame)
+                refs[name][frame_index, 0] = dataset.ref
+
+        ref_dtype = h5py.special_dtype(ref=h5py.Reference)
+        for name in names:
+            h.create_dataset(name, data=refs[name], dtype=ref_dtype)
+        h.create_dataset('is_valid', data=is_valid[None, :].astype(float))
+        h.create_dataset('is_stage_movement',
+                         data=np.zeros((1, n_frames + 1)))
+
+
+def load_frame_by_frame(file_path):
+    """
+    Read each frame through the high level h5py interface.
+    """
+    frames = {}
+    with h5py.File(file_path, 'r') as h:
+        is_valid = h['is_valid'][()][0]
+        for name in ['all_skeletons', 'all_vulva_contours',
+                     'all_non_vulva_contours']:
+            refs = h[name][()]
+            frames[name] = [h[refs[i][0]][()] if is_valid[i] else None
+                            for i in range(is_valid.size)]
+    return frames
+
+
+def main():
+    n_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        file_path = os.path.join(temp_dir, 'schafer.hdf5')
+        write_schafer_file(file_path, n_frames)
+        print("%d frames, %.1f MB file" %
+              (n_frames, os.path.getsize(file_path) / 1e6))
+
+        start = time.time()
+        frames = load_frame_by_frame(file_path)
+        print("%-32s %8.3f s" % ('frame by frame', time.time() - start))
+
+        start = time.time()
+        bw = BasicWorm.from_schafer_file_factory(file_path)
+        print("%-32s %8.3f s" % ('from_schafer_file_factory',
+                                 time.time() - start))
+        assert all(np.array_equal(a, b) for a, b in
+                   zip(frames['all_vulva_contours'], bw.h_ventral_contour)
+                   if a is not None)
+
+        start = time.time()
+        bw = BasicWorm.from_schafer_file_factory(file_path, lazy=True)
+        print("%-32s %8.3f s" % ('lazy, open', time.time() - start))
+        start = time.time()
+        bw.h_ventral_contour[n_frames // 2]
+        print("%-32s %8.3f s" % ('lazy, read one frame',
+                                 time.time() - start))
+        start = time.time()
+        h_ventral_contour = bw.h_ventral_contour.load()
+        print("%-32s %8.3f s" % ('lazy, load one contour side',
+                                 time.time() - start))
+        assert all(np.array_equal(a, b) for a, b in
+                   zip(frames['all_vulva_contours'], h_ventral_contour)
+                   if a is not None)
+        bw.h_ventral_contour.close()
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the contour to skeleton calculation in SkeletonCalculatorType1.
+
+Compares the time and peak memory of computing the distances between
+all pairs of contour points for each frame (full_distance_matrix=True)
+against only computing the distances within the search band of each point
+(the default), for the frame by frame and the batched code.
+
+Synthetic contours are used so that no example data is needed.
+
+Usage:
+    python benchmark_skeleton.py [n_frames] [n_points_per_side]
+
+"""
+import sys
+import copy
+import time
+import tracemalloc
+
+import numpy as np
+
+# We must add .. to the path so that we can perform the
+# import of open_worm_analysis_toolbox while running this as
+# a top-level script (i.e. with __name__ = '__main__')
+sys.path.append('..')
+from open_worm_analysis_toolbox.prefeatures.skeleton_calculator1 import \
+    SkeletonCalculatorType1
+
+
+def make_contours(n_frames, n_points):
+    """
+    A worm shaped contour, bending over time, with each side having about
+    n_points points.
+    """
+    rng = np.random.RandomState(0)
+    h_ventral_contour = []
+    h_dorsal_contour = []
+    for frame_index in range(n_frames):
+        cur_n_points = n_points + rng.randint(-n_points // 10,
+                                              n_points // 10 + 1)
+        t = np.linspace(0, 1, cur_n_points)
+        x = 1000 * t
+        y = 80 * np.sin(2 * np.pi * (t + 0.01 * frame_index))
+        width = 40 * np.sin(np.pi * t)
+        dy = np.gradient(y, x)
+        norm = np.sqrt(1 + dy**2)
+        h_ventral_contour.append(np.vstack((x - width * dy / norm,
+                                            y + width / norm)))
+        h_dorsal_contour.append(np.vstack((x + width * dy / norm,
+                                           y - width / norm)))
+    return h_ventral_contour, h_dorsal_contour
+
+
+def run(name, h_ventral_contour, h_dorsal_contour, **kwargs):
+    # The contours are smoothed in place
+    h_ventral_contour = copy.deepcopy(h_ventral_contour)
+    h_dorsal_contour = copy.deepcopy(h_dorsal_contour)
+
+    tracemalloc.start()
+    start = time.time()
+    result = SkeletonCalculatorType1.compute_skeleton_and_widths(
+        h_ventral_contour, h_dorsal_contour, **kwargs)
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    print("%-32s %8.3f s %10.2f MB" % (name, elapsed, peak / 1e6))
+    return result
+
+
+def main():
+    n_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    n_points = int(sys.argv[2]) if len(sys.argv) > 2 else 250
+
+    h_ventral_contour, h_dorsal_contour = make_contours(n_frames, n_points)
+
+    print("%d frames, about %d points per side" % (n_frames, n_points))
+    print("%-32s %10s %13s" % ('', 'time', 'peak memory'))
+    widths_full, skeleton_full = run('frame by frame, full matrix',
+                                     h_ventral_contour, h_dorsal_contour,
+                                     full_distance_matrix=True)
+    widths, skeleton = run('frame by frame, band',
+                           h_ventral_contour, h_dorsal_contour)
+    assert all(np.array_equal(a, b) for a, b in zip(skeleton_full, skeleton))
+    assert all(np.array_equal(a, b) for a, b in zip(widths_full, widths))
+
+    for batch_size in (16, 64):
+        widths, skeleton = run('batched (%d frames), band' % batch_size,
+                               h_ventral_contour, h_dorsal_contour,
+                               batch_size=batch_size)
+        assert all(np.allclose(a, b) for a, b in zip(skeleton_full,
+                                                     skeleton))
+
+
+if __name__ == '__main__':
+    main()